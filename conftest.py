@@ -0,0 +1,14 @@
+"""
+pytest configuration for pypuppetdb-daily-report
+
+async_backend (and its tests) use ``async def``, which doesn't even parse
+before Python 3.5; don't collect them (for tests, pep8 or flakes) there.
+"""
+
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.extend(['pypuppetdb_daily_report/async_backend.py',
+                           'pypuppetdb_daily_report/tests/test_async_backend.py',
+                           ])
@@ -0,0 +1,318 @@
+"""
+async_backend.py
+asyncio PuppetDB client backend for pypuppetdb-daily-report, selected with
+``--backend async``. Rather than one blocking pypuppetdb request at a time
+(or one thread per request), every nodes, reports, events, facts and metric
+request for a time period is issued from a single event loop, with the
+number of requests in flight bounded by a semaphore.
+
+The data returned is exactly what
+:py:func:`pypuppetdb_daily_report.query_data_for_timespan` returns, so
+aggregation, caching and the templates are unchanged.
+
+Requirements:
+- Python 3.5+
+- aiohttp
+
+##################################################################################
+Copyright 2013 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of pypuppetdb-daily-report.
+
+    pypuppetdb-puppet-report is licensed under the Apache License version 2.0.
+    please see LICENSE file for full text.
+##################################################################################
+While not legally required, I sincerely request that anyone who finds
+bugs please submit them at <https://github.com/jantman/pypuppetdb-daily-report> or
+to me via email, and that you send any contributions or improvements
+either as a pull request on GitHub, or to me via email.
+##################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+"""
+
+import asyncio
+import json
+import logging
+import ssl
+
+import aiohttp
+
+from . import pypuppetdb_daily_report as pdr
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPuppetDB(object):
+    """
+    Minimal asyncio client for the PuppetDB v3 API. Holds connection
+    configuration; the aiohttp session and the concurrency semaphore only
+    exist inside ``async with client:``, since they're bound to a loop.
+    """
+
+    def __init__(self, host='localhost', port=8080, ssl_verify=True, ssl_key=None, ssl_cert=None,
+                 connect_timeout=10, read_timeout=60, concurrency=100):
+        """
+        :param host: PuppetDB hostname
+        :type host: string
+        :param port: PuppetDB port
+        :type port: int
+        :param ssl_verify: whether to verify the PuppetDB server certificate
+        :type ssl_verify: boolean
+        :param ssl_key: path to client SSL key
+        :type ssl_key: string
+        :param ssl_cert: path to client SSL certificate
+        :type ssl_cert: string
+        :param connect_timeout: connect timeout, in seconds
+        :type connect_timeout: float
+        :param read_timeout: max time to wait for each read of a response
+          (not the whole request, so large responses can take longer), in
+          seconds
+        :type read_timeout: float
+        :param concurrency: max number of requests in flight
+        :type concurrency: int
+        """
+        self.host = host
+        self.port = port
+        self.ssl_verify = ssl_verify
+        self.ssl_key = ssl_key
+        self.ssl_cert = ssl_cert
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.concurrency = concurrency
+        # run state, as on pypuppetdb_daily_report.PooledAPI
+        self.reports_range_query = True
+        self.event_cache = None
+        self.cache_manifest = None
+        if ssl_key is not None and ssl_cert is not None:
+            self.protocol = 'https'
+        else:
+            self.protocol = 'http'
+        self.session = None
+        self.semaphore = None
+
+    @property
+    def base_url(self):
+        return '{proto}://{host}:{port}/v3'.format(proto=self.protocol, host=self.host, port=self.port)
+
+    def _ssl_context(self):
+        """ return the SSL argument for the aiohttp connector """
+        if self.protocol != 'https':
+            return None
+        ctx = ssl.create_default_context()
+        if not self.ssl_verify:
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        ctx.load_cert_chain(self.ssl_cert, self.ssl_key)
+        return ctx
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ssl=self._ssl_context())
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout,
+                                                                           sock_read=self.read_timeout))
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+        self.session = None
+        self.semaphore = None
+
+    async def query(self, endpoint, path=None, **params):
+        """
+        GET an API endpoint and return the decoded JSON response. Extra
+        keyword arguments are sent as query parameters, with underscores in
+        their names changed to dashes (i.e. order_by becomes order-by).
+
+        :param endpoint: API endpoint, i.e. 'nodes' or 'metrics/mbean'
+        :type endpoint: string
+        :param path: optional path below the endpoint
+        :type path: string
+        """
+        url = '{base}/{endpoint}'.format(base=self.base_url, endpoint=endpoint)
+        if path is not None:
+            url = '{url}/{path}'.format(url=url, path=path)
+        payload = {}
+        for k, v in params.items():
+            if v is not None:
+                payload[k.replace('_', '-')] = v
+        headers = {'accept': 'application/json', 'accept-charset': 'utf-8'}
+        async with self.semaphore:
+            async with self.session.get(url, params=payload, headers=headers) as resp:
+                resp.raise_for_status()
+                return await resp.json(content_type=None)
+
+
+def query_data_for_timespan(client, start, end, facts=None):
+    """
+    Retrieve all desired data for one day, from PuppetDB, using the async
+    client. Returns the same structure as
+    :py:func:`pypuppetdb_daily_report.query_data_for_timespan`.
+
+    :param client: async PuppetDB client
+    :type client: AsyncPuppetDB
+    :param start: beginning of time period to get data for
+    :type start: Datetime
+    :param end: end of time period to get data for
+    :type end: Datetime
+    :param facts: names of the facts to snapshot; default FACTS
+    :type facts: list
+    """
+    logger.info("querying data for timespan (async): {start} to {end}".format(start=start.strftime('%Y-%m-%d_%H-%M-%S'),
+                                                                              end=end.strftime('%Y-%m-%d_%H-%M-%S'),
+                                                                              ))
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_query_data_for_timespan(client, start, end, facts=facts))
+    finally:
+        loop.close()
+
+
+async def _query_data_for_timespan(client, start, end, facts=None):
+    """ coroutine behind query_data_for_timespan() """
+    res = {}
+    async with client:
+        coros = [_query_nodes(client, start, end)]
+        # if we're getting for yesterday, also snapshot dashboard metrics
+        if pdr.is_yesterday(end):
+            coros.append(get_dashboard_metrics(client))
+            coros.append(get_facts(client, facts))
+        results = await asyncio.gather(*coros)
+    res['nodes'] = results[0]
+    if len(results) > 1:
+        res['metrics'] = results[1]
+        res['facts'] = results[2]
+    logger.debug("got {num} nodes".format(num=len(res['nodes'])))
+    res['aggregate'] = pdr.aggregate_data_for_timespan(res)
+    return res
+
+
+async def _query_nodes(client, start, end):
+    """ query all nodes concurrently, return dict of node name to data """
+    nodes, with_events = await asyncio.gather(client.query('nodes'), get_nodes_with_events(client, start, end))
+    names = [node['name'] for node in nodes]
+    results = await asyncio.gather(*[query_data_for_node(client, name, start, end, has_events=(name in with_events))
+                                     for name in names])
+    res = dict(zip(names, results))
+    pdr.log_skipped_events(dict((name, res[name]['reports']['run_count']) for name in res), with_events)
+    return res
+
+
+async def get_nodes_with_events(client, start, end):
+    """
+    Return the set of names of the nodes that had any events in the given
+    time period; see :py:func:`pypuppetdb_daily_report.get_nodes_with_events`
+    """
+    rows = await client.query('event-counts', query=pdr.nodes_with_events_query(start, end), summarize_by='certname')
+    return pdr.nodes_with_events(rows)
+
+
+async def query_data_for_node(client, certname, start, end, has_events=True):
+    """
+    Retrieve all desired data for a given node in a given time period; the
+    async equivalent of :py:func:`pypuppetdb_daily_report.query_data_for_node`.
+
+    :param client: async PuppetDB client
+    :type client: AsyncPuppetDB
+    :param certname: the name of the node to query for
+    :type certname: string
+    :param start: beginning of time period to get data for
+    :type start: Datetime
+    :param end: end of time period to get data for
+    :type end: Datetime
+    :param has_events: whether the node may have any events in the time
+      period; if not, only reports still running after it are queried
+    :type has_events: boolean
+    """
+    reports = await get_reports_for_node(client, certname, start, end)
+    hashes = pdr.hashes_needing_events(reports, has_events=has_events, until=end + pdr.EVENTS_TIMESTAMP_GRACE)
+    events = []
+    if client.event_cache is not None:
+        events, hashes = client.event_cache.lookup(hashes)
+    queries = pdr.get_events_queries(hashes)
+    pages = await asyncio.gather(*[client.query('events', query=query_s) for query_s in queries])
+    fetched = [pdr.event_from_json(e) for page in pages for e in page]
+    if client.event_cache is not None and len(hashes) > 0:
+        client.event_cache.store(hashes, fetched)
+    return pdr.node_data_from_reports(reports, events + fetched)
+
+
+async def get_reports_for_node(client, certname, start, end):
+    """
+    Return a list of the node's reports that started within the given time
+    period, newest first. Uses the same start-time range query as
+    :py:func:`pypuppetdb_daily_report.query_reports_for_node`, falling back
+    to filtering the full report history if PuppetDB rejects it.
+    """
+    if client.reports_range_query:
+        query_s = json.dumps(["and",
+                              ["=", "certname", certname],
+                              [">=", "start-time", pdr.datetime_to_json(start)],
+                              ["<=", "start-time", pdr.datetime_to_json(end)],
+                              ])
+        order_by = json.dumps([{"field": "start-time", "order": "desc"}])
+        try:
+            reports = []
+            offset = 0
+            while True:
+                page = await client.query('reports', query=query_s, order_by=order_by,
+                                          limit=pdr.REPORTS_PAGE_SIZE, offset=offset)
+                reports.extend(pdr.report_from_json(r) for r in page)
+                if len(page) < pdr.REPORTS_PAGE_SIZE:
+                    return reports
+                offset += pdr.REPORTS_PAGE_SIZE
+        except aiohttp.ClientResponseError:
+            logger.warning("PuppetDB rejected reports start-time range query; falling back to full report history")
+            client.reports_range_query = False
+    page = await client.query('reports', query=json.dumps(["=", "certname", certname]))
+    reports = [pdr.report_from_json(r) for r in page]
+    return [rep for rep in reports if rep.start >= start and rep.start <= end]
+
+
+async def get_facts(client, facts=None):
+    """
+    return a dict of the values of the given facts (default FACTS) and the
+    counts of each value; see :py:func:`pypuppetdb_daily_report.get_facts`
+    """
+    logger.debug("querying facts")
+    if facts is None:
+        facts = pdr.FACTS
+    rows = await client.query('facts', query=pdr.facts_query(facts))
+    res = {}
+    for fact in facts:
+        res[fact] = {}
+    for row in rows:
+        if row['name'] not in res:
+            continue
+        if row['value'] not in res[row['name']]:
+            res[row['name']][row['value']] = 0
+        res[row['name']][row['value']] += 1
+    logger.debug("done with facts")
+    return res
+
+
+async def get_dashboard_metrics(client):
+    """
+    return a dict of the metrics displayed on the PuppetDB dashboard; see
+    :py:func:`pypuppetdb_daily_report.get_dashboard_metrics`
+    """
+    logger.debug("getting dashboard metrics...")
+    metrics = pdr.dashboard_metrics()
+    # some metrics share an MBean; only read each once
+    paths = sorted(set(metrics[m]['path'] for m in metrics))
+    results = await asyncio.gather(*[client.query('metrics/mbean', path=path) for path in paths],
+                                   return_exceptions=True)
+    values = dict(zip(paths, results))
+    for metric in metrics:
+        result = values[metrics[metric]['path']]
+        if isinstance(result, aiohttp.ClientResponseError):
+            logger.debug("unable to get value for metric: %s" % metric)
+            continue
+        if isinstance(result, Exception):
+            raise result
+        metrics[metric]['api_response'] = result
+        metrics[metric]['formatted'] = pdr.metric_value(result)
+    logger.info("got dashboard metrics")
+    return metrics
@@ -35,25 +35,55 @@ Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
 import sys
 import optparse
 import logging
+import re
+import calendar
 from . import VERSION
-from pypuppetdb import connect
+from pypuppetdb.api.v3 import API as v3API
+from pypuppetdb.errors import EmptyResponseError
+from pypuppetdb.utils import json_to_datetime
 import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import urlencode, quote_plus
 import datetime
 import os
 from math import floor, ceil
+from bisect import bisect_right
 from jinja2 import Environment, PackageLoader
 import pytz
 import tzlocal
 from ago import delta2dict
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, OrderedDict, namedtuple
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 from platform import node as platform_node
 from getpass import getuser
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import smtplib
+import json
+import sqlite3
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from functools import partial
+import struct
+import zlib
+import errno
 
 import pickle
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 FORMAT = "[%(levelname)s %(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s"
 logging.basicConfig(level=logging.ERROR, format=FORMAT)
 logger = logging.getLogger(__name__)
@@ -62,9 +92,106 @@ logger = logging.getLogger(__name__)
 NUM_RESULT_ROWS = 10
 RUNS_PER_DAY = 40
 FACTS = ['puppetversion', 'facterversion', 'lsbdistdescription']
+# max number of reports to fetch events for in a single events query
+EVENTS_BATCH_SIZE = 30
+# max length of a single events query's URL parameter (query=..., URL-encoded,
+# which roughly triples the brackets, quotes and commas); it's sent in a GET
+EVENTS_QUERY_MAX_LEN = 2048
+# with --workers, split the node list into this many chunks per worker
+NODE_CHUNKS_PER_WORKER = 4
+# number of reports to request per page of a reports query
+REPORTS_PAGE_SIZE = 500
+# event status to the resources key it is tallied under
+EVENT_STATUS_KEYS = {'skipped': 'skipped', 'success': 'changed', 'failure': 'failed'}
+# event-counts response field to the event status it counts
+EVENT_COUNTS_STATUSES = {'skips': 'skipped', 'successes': 'success', 'failures': 'failure'}
+# how far past the end of a time period get_nodes_with_events() looks for
+# events, for reports that started in the period but ran past its end
+EVENTS_TIMESTAMP_GRACE = datetime.timedelta(hours=1)
+# size in bytes of the chunks streamed responses are read and decoded in
+STREAM_CHUNK_SIZE = 65536
+# with --adaptive, back off when an endpoint's smoothed request latency
+# exceeds its baseline latency by this factor
+ADAPTIVE_LATENCY_TOLERANCE = 2.0
+# with --adaptive, weight of the newest smoothed latency in an endpoint's
+# baseline; much less than ADAPTIVE_LATENCY_SMOOTHING, so the baseline is a
+# long-run average that only follows lasting changes
+ADAPTIVE_BASELINE_DECAY = 0.02
+# with --adaptive, multiply the concurrency limit by this when backing off
+ADAPTIVE_BACKOFF = 0.5
+# with --adaptive, weight of the newest sample in the smoothed latency
+ADAPTIVE_LATENCY_SMOOTHING = 0.2
+# with --command-queue-limit, seconds between reads of the Command Queue depth
+COMMAND_QUEUE_CHECK_INTERVAL = 30
+# with the event-counts and counters engines, checkpoint after every this many nodes
+CHECKPOINT_CHUNK_SIZE = 100
+# version of the layout of the data in day cache files; bump it whenever
+# that changes, and files written with any other version (except version 1,
+# which loads_cache() can still read) are re-queried
+CACHE_SCHEMA_VERSION = 2
+# compression for new day cache files: 'zstd' (if the zstandard package is
+# installed; gzip otherwise), 'gzip' or None
+CACHE_COMPRESSION = 'zstd'
+# version of the SQLite cache tables (--cache-backend sqlite); bump it
+# whenever they change, and they're dropped and recreated
+SQLITE_SCHEMA_VERSION = 4
+# default for --cache-max-age; cached days older than this many days are
+# pruned at the end of each run. PuppetDB usually no longer has the reports
+# for them, so they can't be re-queried
+CACHE_MAX_AGE = 365
+# default for --cache-bucket-max-age; cached buckets (see BUCKET_LENGTH)
+# older than this many days are pruned at the end of each run. With the
+# files backend each host has 24 bucket files per day, and days older than
+# this are rarely rebuilt from them rather than read whole from the cache
+CACHE_BUCKET_MAX_AGE = 31
+# default for --cache-compact-after; cached days older than this many days
+# are compacted (see compact_day_data()) at the end of each run
+CACHE_COMPACT_AFTER = 14
+# number of resources of each status kept in each aggregate of a compacted day
+COMPACT_TOP_RESOURCES = 100
+# length of the buckets that --since/--until windows (and days, with
+# --cache-granularity hour) are merged from; windows must start and end on
+# a bucket boundary (in UTC)
+BUCKET_LENGTH = datetime.timedelta(hours=1)
+# max number of uncached buckets to query PuppetDB for in one pass
+BUCKETS_PER_QUERY = 168
+# buckets ending less than this long ago are queried but not cached, since
+# reports for them may still be on their way to PuppetDB
+BUCKET_CACHE_GRACE = datetime.timedelta(hours=1)
+# formats accepted for --since and --until, in --timezone
+WINDOW_TIME_FORMATS = ['%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d']
+# temporary and lock files left in the cache dir by a crashed run are
+# removed by prune_cache() once they're this many seconds old
+CACHE_STALE_SECONDS = 86400
+
+# day cache file header: magic, schema version and compression
+CACHE_MAGIC = b'PDRC'
+CACHE_HEADER = struct.Struct('>4sHB')
+CACHE_COMPRESSION_CODES = {None: 0, 'gzip': 1, 'zstd': 2}
+# length of the section index that follows CACHE_HEADER
+CACHE_INDEX_LENGTH = struct.Struct('>I')
+# names of the files prune_cache() manages: day cache files (current and
+# legacy format, and their checkpoints), backfill checkpoints and event caches
+DAY_CACHE_FILE_RE = re.compile(r'^data_(?P<host>.+)_(?P<start>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})_'
+                               r'(?P<end>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\.((cache|pickle)(\.partial)?|backfill\.partial)$')
+EVENT_CACHE_FILE_RE = re.compile(r'^events_(?P<host>.+)\.pickle$')
+# temporary files written by write_file_atomic() and CacheLock lock files
+CACHE_STALE_FILE_RE = re.compile(r'^(data_|events_|manifest).*\.(tmp|lock)$')
+
+# the only parts of a report and of an event that the report uses; built
+# straight from the decoded JSON instead of pypuppetdb's Report and Event
+# (event_counts is the report's event counts by status, from its embedded
+# metrics, or None if PuppetDB didn't include them)
+ReportSummary = namedtuple('ReportSummary', ['hash_', 'start', 'run_time', 'event_counts'])
+EventSummary = namedtuple('EventSummary', ['hash_', 'status', 'type_', 'title'])
 
 
-def main(hostname, to=None, num_days=7, cache_dir=None, dry_run=False):
+def main(hostname, to=None, num_days=7, cache_dir=None, dry_run=False, workers=1, backend='sync', concurrency=100,
+         backfill=True, pool_size=10, connect_timeout=10, read_timeout=60, engine='events', facts=None,
+         parallel_days=1, adaptive=False, command_queue_limit=None, cache_backend='files',
+         cache_max_age=CACHE_MAX_AGE, cache_max_bytes=None, cache_max_files=None,
+         cache_compact_after=CACHE_COMPACT_AFTER, window=None, timezone=None, cache_granularity='day',
+         cache_bucket_max_age=CACHE_BUCKET_MAX_AGE):
     """
     main entry point
 
@@ -78,35 +205,180 @@ def main(hostname, to=None, num_days=7, cache_dir=None, dry_run=False):
     :type cache_dir: string
     :param dry_run: whether to actually send, or just print what would be sent
     :type dry_run: boolean
+    :param workers: number of nodes to query PuppetDB for concurrently
+    :type workers: int
+    :param backend: 'sync' to query with pypuppetdb, or 'async' to use the
+      asyncio client in async_backend
+    :type backend: string
+    :param concurrency: max number of requests in flight with the async backend
+    :type concurrency: int
+    :param backfill: whether to query all uncached days in a single pass
+      (sync backend only)
+    :type backfill: boolean
+    :param pool_size: max number of pooled HTTP connections to PuppetDB
+    :type pool_size: int
+    :param connect_timeout: PuppetDB connect timeout, in seconds
+    :type connect_timeout: float
+    :param read_timeout: PuppetDB read timeout, in seconds
+    :type read_timeout: float
+    :param engine: how node data is collected; 'events' to tally every event
+      client-side, 'event-counts' to use PuppetDB's event-counts summaries, or
+      'counters' for report counters only (sync backend only). The counters
+      engine reads each report's flags from its metrics, which the v3
+      reports API doesn't include; against v3 it falls back to batched
+      event-counts queries, so it only saves the resource queries
+    :type engine: string
+    :param facts: names of the facts to report values of; default FACTS
+    :type facts: list
+    :param parallel_days: number of days to get data for concurrently (sync
+      backend only); requests in flight are still capped at pool_size
+    :type parallel_days: int
+    :param adaptive: whether to adapt the number of requests in flight (up to
+      pool_size) to PuppetDB's response times and errors (sync backend only)
+    :type adaptive: boolean
+    :param command_queue_limit: with adaptive, drop to one request at a time
+      while PuppetDB's command queue is deeper than this; None to not watch it
+    :type command_queue_limit: int
+    :param cache_backend: how to store the data for each day in cache_dir;
+      'files' (one file per day) or 'sqlite' (one SQLite database)
+    :type cache_backend: string
+    :param cache_max_age: at the end of the run, prune cached days older than
+      this many days (never fewer than num_days); None for no limit
+    :type cache_max_age: int
+    :param cache_max_bytes: at the end of the run, prune the least recently
+      used cache entries until cache_dir holds at most this many bytes; None
+      for no limit
+    :type cache_max_bytes: int
+    :param cache_max_files: at the end of the run, prune the least recently
+      used cache entries of each PuppetDB host beyond this many; None for no
+      limit
+    :type cache_max_files: int
+    :param cache_compact_after: at the end of the run, compact cached days
+      older than this many days; None to never compact them
+    :type cache_compact_after: int
+    :param window: if given, report on this single (start, end) window, from
+      get_window(), instead of on num_days days (sync backend and events
+      engine only)
+    :type window: tuple
+    :param timezone: name of the timezone that days start at midnight in and
+      are labelled in; default the local timezone
+    :type timezone: string
+    :param cache_granularity: 'day' to query and cache each day whole, or
+      'hour' to build each day by merging cached BUCKET_LENGTH buckets, and
+      query only the buckets not cached (sync backend and events engine only)
+    :type cache_granularity: string
+    :param cache_bucket_max_age: at the end of the run, prune cached buckets
+      older than this many days (never fewer than the report reaches back);
+      None to prune them with cache_max_age
+    :type cache_bucket_max_age: int
     """
-    pdb = connect(host=hostname)
+    event_cache = None
+    manifest = None
+    if cache_dir is not None:
+        event_cache = EventCache(event_cache_path(cache_dir, hostname))
+        manifest = CacheManifest(cache_dir)
+    if backend == 'async':
+        async_backend = get_async_backend()
+        pdb = async_backend.AsyncPuppetDB(host=hostname, concurrency=concurrency, connect_timeout=connect_timeout,
+                                          read_timeout=read_timeout)
+    else:
+        limiter = None
+        if adaptive:
+            limiter = AdaptiveLimiter(pool_size, command_queue_limit=command_queue_limit)
+        pdb = PooledAPI(host=hostname, pool_size=pool_size, connect_timeout=connect_timeout,
+                        read_timeout=read_timeout, limiter=limiter)
+    # shared by every query this run makes, through the client
+    pdb.event_cache = event_cache
+    pdb.cache_manifest = manifest
 
     # essentially figure out all these for yesterday, build the tables, serialize the result as JSON somewhere. then just keep the last ~7 days json files
     date_data = {}
     dates = []  # ordered
-    date_list = get_date_list(num_days)
-    localtz = tzlocal.get_localzone()
-    start_date = date_list[0]
-    end_date = date_list[-1] - datetime.timedelta(hours=23, minutes=59, seconds=59)
-    for query_date in date_list:
-        end = query_date
-        start = query_date - datetime.timedelta(days=1) + datetime.timedelta(seconds=1)
-        date_s = (query_date - datetime.timedelta(hours=1)).astimezone(localtz).strftime('%a %m/%d')
-        date_data[date_s] = get_data_for_timespan(hostname, pdb, start, end, cache_dir=cache_dir)
-        dates.append(date_s)
+    if timezone is None:
+        localtz = tzlocal.get_localzone()
+    else:
+        localtz = pytz.timezone(timezone)
+    timespans = []
+    if window is not None:
+        start_date = window[1]
+        end_date = window[0]
+        timespans.append(window)
+        dates.append('{start} - {end}'.format(start=window[0].astimezone(localtz).strftime('%m/%d %H:%M'),
+                                              end=(window[1] + datetime.timedelta(seconds=1)).astimezone(localtz).strftime('%m/%d %H:%M')))
+    else:
+        timespans = get_day_timespans(num_days, tz=localtz)
+        start_date = timespans[0][1]
+        end_date = timespans[-1][0]
+        for start, end in timespans:
+            dates.append((end - datetime.timedelta(hours=1)).astimezone(localtz).strftime('%a %m/%d'))
+    if window is not None or cache_granularity == 'hour':
+        windows = get_data_for_windows(hostname, pdb, timespans, cache_dir=cache_dir, workers=workers,
+                                       cache_backend=cache_backend, facts=facts)
+        for date_s, data in zip(dates, windows):
+            date_data[date_s] = data
+    else:
+        prefetched = {}
+        if cache_dir is not None and cache_backend == 'sqlite':
+            # every cached day in one indexed range read
+            prefetched = SQLiteCache(sqlite_cache_path(cache_dir)).read_days(hostname, timespans)
+            for start, end in prefetched:
+                manifest.record_hit(hostname, start, end, 'sqlite')
+        if backfill and backend != 'async' and engine == 'events':
+            prefetched.update(backfill_timespans(hostname, pdb, [timespan for timespan in timespans if timespan not in prefetched],
+                                                 cache_dir=cache_dir, workers=workers, cache_backend=cache_backend,
+                                                 facts=facts))
+        remaining = [timespan for timespan in timespans if timespan not in prefetched]
+        fetched = get_data_for_timespans(hostname, pdb, remaining, parallel_days=parallel_days, cache_dir=cache_dir,
+                                         workers=workers, backend=backend, engine=engine, cache_backend=cache_backend,
+                                         facts=facts)
+        fetched = dict(zip(remaining, fetched))
+        for date_s, timespan in zip(dates, timespans):
+            if timespan in prefetched:
+                date_data[date_s] = prefetched[timespan]
+            else:
+                date_data[date_s] = fetched[timespan]
+    if cache_dir is not None:
+        if cache_compact_after:
+            compact_cache(cache_dir, cache_compact_after)
+        if cache_max_age:
+            cache_max_age = max(cache_max_age, min_cache_age(num_days, window))
+        event_cache.compact(max_age=cache_max_age)
+        event_cache.close()
+        if cache_bucket_max_age:
+            cache_bucket_max_age = max(cache_bucket_max_age, min_cache_age(num_days, window))
+        # never evict what was just reported on
+        keep = cache_keep(hostname, timespans, buckets=(window is not None or cache_granularity == 'hour'))
+        prune_cache(cache_dir, max_age=cache_max_age, max_bytes=cache_max_bytes, max_files=cache_max_files, keep=keep,
+                    bucket_max_age=cache_bucket_max_age)
+        manifest.save()
+    if backend != 'async':
+        stats = pdb.connection_stats()
+        logger.info("PuppetDB HTTP connections: {opened} opened, {reused} reused for {requests} requests".format(
+            opened=stats['opened'], reused=stats['reused'], requests=stats['requests']))
+        if pdb.limiter is not None:
+            logger.info("adaptive concurrency limit ended at {limit} of {max_limit}; backed off {num} times".format(
+                limit=pdb.limiter.current_limit(), max_limit=pdb.limiter.max_limit, num=pdb.limiter.backoffs))
     html = format_html(hostname, dates, date_data, start_date, end_date)
     subject = 'daily puppet(db) run summary for {host}'.format(host=hostname)
     send_mail(to, subject, html, dry_run=dry_run)
     return True
 
 
-def get_date_list(num_days):
+def get_date_list(num_days, tz=None):
     """
     For an integer number of days (num_days), get an ordered list of
     DateTime objects to report on.
+
+    :param num_days: number of days
+    :type num_days: int
+    :param tz: timezone the days start at midnight in; default the local timezone
+    :type tz: pytz timezone
     """
-    local_tz = tzlocal.get_localzone()
-    local_start_date = local_tz.localize(datetime.datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(seconds=1)
+    local_tz = tz
+    if local_tz is None:
+        local_tz = tzlocal.get_localzone()
+    local_now = pytz.utc.localize(datetime.datetime.utcnow()).astimezone(local_tz).replace(tzinfo=None)
+    local_start_date = localize(local_tz, local_now).replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(seconds=1)
     logger.debug("local_start_date={d}".format(d=local_start_date.strftime("%Y-%m-%d %H:%M:%S%z %Z")))
     start_date = local_start_date.astimezone(pytz.utc)
     logger.debug("start_date={d}".format(d=start_date.strftime("%Y-%m-%d %H:%M:%S%z %Z")))
@@ -116,6 +388,111 @@ def get_date_list(num_days):
     return dates
 
 
+def get_day_timespans(num_days, tz=None):
+    """
+    Return the list of (start, end) tuples of the days to report on, most
+    recent first, for the days from get_date_list().
+
+    :param num_days: number of days
+    :type num_days: int
+    :param tz: timezone the days start at midnight in; default the local timezone
+    :type tz: pytz timezone
+    """
+    return [(end - datetime.timedelta(days=1) + datetime.timedelta(seconds=1), end) for end in get_date_list(num_days, tz=tz)]
+
+
+def min_cache_age(num_days, window=None):
+    """
+    Return the number of days back the report reaches, which cache pruning
+    must keep whatever --cache-max-age says.
+
+    :param num_days: number of days reported on
+    :type num_days: int
+    :param window: the (start, end) window reported on instead, if any
+    :type window: tuple
+    """
+    if window is not None:
+        return int(ceil((time.time() - calendar.timegm(window[0].utctimetuple())) / 86400.0))
+    return num_days
+
+
+def cache_keep(hostname, timespans, buckets=False):
+    """
+    Return the list of (hostname, start, end) tuples of the cache entries a
+    report on the given timespans uses, for prune_cache()'s ``keep``.
+
+    :param hostname: name of the puppetdb host, or None for every host
+    :type hostname: string
+    :param timespans: list of (start, end) tuples reported on
+    :type timespans: list
+    :param buckets: whether the timespans are built from buckets (see
+      get_data_for_windows()), which are kept too
+    :type buckets: boolean
+    """
+    keep = [(hostname, start, end) for start, end in timespans]
+    if buckets:
+        keep.extend((hostname, b_start, b_end) for start, end in timespans for b_start, b_end in get_buckets(start, end))
+    return keep
+
+
+def localize(tz, dt):
+    """
+    Return a naive datetime as a time in a timezone; for pytz timezones and
+    the zoneinfo timezones newer tzlocal versions return.
+
+    :param tz: the timezone
+    :param dt: the naive datetime
+    :type dt: Datetime
+    """
+    if hasattr(tz, 'localize'):
+        return tz.localize(dt)
+    return dt.replace(tzinfo=tz)
+
+
+def get_window(since, until=None, tz=None):
+    """
+    Return the (start, end) tuple of the UTC window to report on for --since
+    and --until. Each is a time in one of WINDOW_TIME_FORMATS in ``tz``;
+    ``since`` may also be a number of hours before ``until`` (i.e. '24h'),
+    and ``until`` defaults to the start of the current hour. Like the days
+    reported on, the end is inclusive, one second before ``until``. Raises
+    ValueError if either can't be parsed or the window isn't made of whole
+    buckets (see get_buckets()).
+
+    :param since: start of the window
+    :type since: string
+    :param until: end of the window
+    :type until: string
+    :param tz: timezone the times are in; default the local timezone
+    :type tz: pytz timezone
+    """
+    if tz is None:
+        tz = tzlocal.get_localzone()
+
+    def parse(s):
+        for fmt in WINDOW_TIME_FORMATS:
+            try:
+                return localize(tz, datetime.datetime.strptime(s, fmt)).astimezone(pytz.utc)
+            except ValueError:
+                pass
+        raise ValueError("unable to parse time '{s}'; use YYYY-MM-DD HH:MM".format(s=s))
+
+    if until is None:
+        end = pytz.utc.localize(datetime.datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+    else:
+        end = parse(until)
+    m = re.match(r'^(\d+)h$', since)
+    if m is not None:
+        start = end - datetime.timedelta(hours=int(m.group(1)))
+    else:
+        start = parse(since)
+    if end <= start:
+        raise ValueError("--until must be after --since")
+    end = end - datetime.timedelta(seconds=1)
+    get_buckets(start, end)
+    return start, end
+
+
 def format_html(hostname, dates, date_data, start_date, end_date):
     """
     format the HTML report using the raw per-date dicts
@@ -207,14 +584,16 @@ def filter_report_metric_format(o):
     return str(o)
 
 
-def get_data_for_timespan(hostname, pdb, start, end, cache_dir=None):
+def get_data_for_timespan(hostname, pdb, start, end, cache_dir=None, workers=1, backend='sync', engine='events',
+                          cache_backend='files', facts=None):
     """
     Get the data for a specified timespan, from cache (if possible) or else
     from PuppetDB directly.
 
     :param hostname: name of the puppetdb host we're connected to
     :type hostname: string
-    :param pdb: object representing a connected pypuppetdb instance
+    :param pdb: object representing a connected pypuppetdb instance, or an
+      async_backend.AsyncPuppetDB if backend is 'async'
     :type pdb: one of the pypuppetdb.API classes
     :param start: beginning of time period to get data for
     :type start: Datetime
@@ -222,264 +601,3150 @@ def get_data_for_timespan(hostname, pdb, start, end, cache_dir=None):
     :type end: Datetime
     :param cache_dir: absolute path to where to cache data from PuppetDB
     :type cache_dir: string
+    :param workers: number of nodes to query PuppetDB for concurrently
+    :type workers: int
+    :param backend: 'sync' or 'async'
+    :type backend: string
+    :param engine: 'events', 'event-counts' or 'counters'; see
+      query_data_for_timespan()
+    :type engine: string
+    :param cache_backend: 'files' or 'sqlite'; see main()
+    :type cache_backend: string
+    :param facts: names of the facts to snapshot; default FACTS
+    :type facts: list
     """
     logger.debug("getting data for timespan: {start} to {end} (cache_dir={cache_dir})".format(cache_dir=cache_dir,
                                                                                               start=start.strftime('%Y-%m-%d_%H-%M-%S'),
                                                                                               end=end.strftime('%Y-%m-%d_%H-%M-%S'),
                                                                                               ))
+    lock = None
     if cache_dir is not None:
-        cache_filename = "data_{host}_{start}_{end}.pickle".format(host=hostname,
-                                                                   start=start.strftime('%Y-%m-%d_%H-%M-%S'),
-                                                                   end=end.strftime('%Y-%m-%d_%H-%M-%S'))
-        cache_fpath = os.path.join(cache_dir, cache_filename)
+        cache_fpath = cache_path(cache_dir, hostname, start, end)
         logger.debug("cache file: {fpath}".format(fpath=cache_fpath))
         if not os.path.exists(cache_dir):
             logger.info("creating dir: {cache_dir}".format(cache_dir=cache_dir))
-            os.makedirs(cache_dir)
-        if os.path.exists(cache_fpath):
-            with open(cache_fpath, 'r') as fh:
-                logger.debug("reading cache file")
-                raw = fh.read()
-            data = pickle.loads(raw)
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # another thread may have just created it
+                if not os.path.isdir(cache_dir):
+                    raise
+        data = read_cached_timespan(cache_dir, hostname, start, end, cache_backend)
+        if data is None:
+            # only one process (or thread) builds each day; any other waits
+            # for it to finish, then uses what it cached
+            lock = CacheLock(lock_path(cache_fpath))
+            if not lock.acquire(blocking=False):
+                logger.info("waiting for another process to cache {f}".format(f=cache_fpath))
+                lock.acquire()
+            data = read_cached_timespan(cache_dir, hostname, start, end, cache_backend)
+            if data is not None:
+                lock.release()
+        if data is not None:
             logger.info("returning cached data for timespan: {start} to {end}".format(start=start.strftime('%Y-%m-%d_%H-%M-%S'),
                                                                                       end=end.strftime('%Y-%m-%d_%H-%M-%S'),
                                                                                       ))
+            manifest = getattr(pdb, 'cache_manifest', None)
+            if manifest is not None:
+                manifest.record_hit(hostname, start, end, cache_backend)
             return data
-    data = query_data_for_timespan(pdb, start, end)
+    try:
+        return build_timespan(hostname, pdb, start, end, cache_dir=cache_dir, workers=workers, backend=backend,
+                              engine=engine, cache_backend=cache_backend, facts=facts)
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+def build_timespan(hostname, pdb, start, end, cache_dir=None, workers=1, backend='sync', engine='events',
+                   cache_backend='files', facts=None):
+    """
+    Query the data for a specified timespan from PuppetDB and, if there's a
+    cache_dir, cache it; called by get_data_for_timespan() (which takes
+    the same arguments) on a cache miss, holding the timespan's CacheLock.
+    """
+    if cache_dir is not None:
+        cache_fpath = cache_path(cache_dir, hostname, start, end)
+    started = time.time()
+    if backend == 'async':
+        data = get_async_backend().query_data_for_timespan(pdb, start, end, facts=facts)
+    elif cache_dir is None:
+        data = query_data_for_timespan(pdb, start, end, workers=workers, engine=engine, facts=facts)
+    else:
+        # record each node as it's done, so an interrupted run can resume
+        checkpoint = NodeCheckpoint(checkpoint_path(cache_fpath))
+        try:
+            data = query_data_for_timespan(pdb, start, end, workers=workers, engine=engine, checkpoint=checkpoint,
+                                           facts=facts)
+        finally:
+            checkpoint.close()
     if cache_dir is None:
         return data
-    with open(cache_fpath, 'w') as fh:
-        logger.debug("writing data to cache")
-        fh.write(pickle.dumps(data))
+    if cache_backend == 'sqlite':
+        SQLiteCache(sqlite_cache_path(cache_dir)).write_day(hostname, start, end, data)
+    else:
+        write_cache(cache_fpath, data)
+    manifest = getattr(pdb, 'cache_manifest', None)
+    if manifest is not None:
+        manifest.record_build(hostname, start, end, cache_backend, time.time() - started)
+    if backend != 'async':
+        checkpoint.remove()
     return data
 
 
-def query_data_for_timespan(pdb, start, end):
+def read_cached_timespan(cache_dir, hostname, start, end, cache_backend='files'):
     """
-    Retrieve all desired data for one day, from PuppetDB
+    Return the cached data for a specified timespan, or None if it isn't
+    cached (converting a legacy pickle cache file, if there is one).
+
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    :param hostname: name of the puppetdb host we're connected to
+    :type hostname: string
+    :param start: beginning of time period
+    :type start: Datetime
+    :param end: end of time period
+    :type end: Datetime
+    :param cache_backend: 'files' or 'sqlite'; see main()
+    :type cache_backend: string
+    """
+    if cache_backend == 'sqlite':
+        return SQLiteCache(sqlite_cache_path(cache_dir)).read_day(hostname, start, end)
+    cache_fpath = cache_path(cache_dir, hostname, start, end)
+    data = read_cache(cache_fpath)
+    if data is None:
+        data = migrate_legacy_cache(legacy_cache_path(cache_dir, hostname, start, end), cache_fpath)
+    return data
 
+
+def get_data_for_timespans(hostname, pdb, timespans, parallel_days=1, **kwargs):
+    """
+    Call get_data_for_timespan() for each of a list of timespans, up to
+    ``parallel_days`` of them at a time on a pool of threads, and return the
+    list of results in the same order as ``timespans``. Other keyword
+    arguments are passed through to get_data_for_timespan().
+
+    All the threads share ``pdb``; a PooledAPI's connection pool blocks when
+    all of its connections are in use, so the number of PuppetDB requests in
+    flight stays capped at its pool size, however many days and workers run.
+
+    :param hostname: name of the puppetdb host we're connected to
+    :type hostname: string
     :param pdb: object representing a connected pypuppetdb instance
     :type pdb: one of the pypuppetdb.API classes
-    :param start: beginning of time period to get data for
+    :param timespans: list of (start, end) tuples
+    :type timespans: list
+    :param parallel_days: max number of timespans to get data for concurrently
+    :type parallel_days: int
+    """
+    def get_data(timespan):
+        return get_data_for_timespan(hostname, pdb, timespan[0], timespan[1], **kwargs)
+
+    if parallel_days < 2 or len(timespans) < 2:
+        return [get_data(timespan) for timespan in timespans]
+    logger.debug("getting data for {num} timespans, {days} at a time".format(num=len(timespans), days=parallel_days))
+    pool = ThreadPool(min(parallel_days, len(timespans)))
+    try:
+        return pool.map(get_data, timespans)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def cache_path(cache_dir, hostname, start, end):
+    """
+    Return the path to the cache file for a given PuppetDB host and timespan
+
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    :param hostname: name of the puppetdb host we're connected to
+    :type hostname: string
+    :param start: beginning of time period
     :type start: Datetime
-    :param end: end of time period to get data for
+    :param end: end of time period
     :type end: Datetime
     """
-    logger.info("querying data for timespan: {start} to {end}".format(start=start.strftime('%Y-%m-%d_%H-%M-%S'),
-                                                                      end=end.strftime('%Y-%m-%d_%H-%M-%S'),
-                                                                      ))
-    res = {}
+    cache_filename = "data_{host}_{start}_{end}.cache".format(host=hostname,
+                                                              start=start.strftime('%Y-%m-%d_%H-%M-%S'),
+                                                              end=end.strftime('%Y-%m-%d_%H-%M-%S'))
+    return os.path.join(cache_dir, cache_filename)
 
-    # if we're getting for yesterday, also snapshot dashboard metrics
-    if end >= pytz.utc.localize(datetime.datetime.now()) - datetime.timedelta(days=1):
-        logger.debug("requested yesterday, getting dashboard metrics")
-        res['metrics'] = get_dashboard_metrics(pdb)
-        res['facts'] = get_facts(pdb)
 
-    logger.debug("querying nodes")
-    nodes = pdb.nodes()
-    res['nodes'] = {}
-    for node in nodes:
-        logger.debug("working node {node}".format(node=node.name))
-        node_data = query_data_for_node(pdb, node, start, end)
-        res['nodes'][node.name] = node_data
+def legacy_cache_path(cache_dir, hostname, start, end):
+    """
+    Return the path to the pickle cache file that older versions wrote for a
+    given PuppetDB host and timespan; see migrate_legacy_cache()
 
-    logger.debug("got {num} nodes".format(num=len(res['nodes'])))
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    :param hostname: name of the puppetdb host we're connected to
+    :type hostname: string
+    :param start: beginning of time period
+    :type start: Datetime
+    :param end: end of time period
+    :type end: Datetime
+    """
+    return os.path.splitext(cache_path(cache_dir, hostname, start, end))[0] + '.pickle'
 
-    logger.debug("aggregating data")
-    res['aggregate'] = aggregate_data_for_timespan(res)
 
-    return res
+def is_cached(cache_dir, hostname, start, end):
+    """
+    Return whether there's a cache file (in either format) for a given
+    PuppetDB host and timespan
+
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    :param hostname: name of the puppetdb host we're connected to
+    :type hostname: string
+    :param start: beginning of time period
+    :type start: Datetime
+    :param end: end of time period
+    :type end: Datetime
+    """
+    return (os.path.exists(cache_path(cache_dir, hostname, start, end)) or
+            os.path.exists(legacy_cache_path(cache_dir, hostname, start, end)))
 
 
-def aggregate_data_for_timespan(data):
+def checkpoint_path(cache_fpath):
     """
-    Calculate aggregate values for all data in a given timespan
+    Return the path to the per-node checkpoint file kept while the data for
+    a timespan is being fetched, next to the timespan's cache file
 
-    :param data: dict of result data from query_data_for_timespan()
-    :type data: dict
+    :param cache_fpath: path to the cache file for the timespan
+    :type cache_fpath: string
     """
-    res = {}
-    res['reports'] = {'run_count': 0,
-                      'run_time_total': datetime.timedelta(),
-                      'run_time_max': datetime.timedelta(),
-                      'run_time_avg': datetime.timedelta(),
-                      'with_failures': 0,
-                      'with_changes': 0,
-                      'with_skips': 0,
-                      'resources': {'failed': defaultdict(int), 'changed': defaultdict(int), 'skipped': defaultdict(int)},
-                      }
-    res['nodes'] = {'with_failures': 0,
-                    'with_changes': 0,
-                    'with_skips': 0,
-                    'with_no_report': 0,
-                    'with_no_successful_runs': 0,
-                    'with_50+%_failed': 0,
-                    'with_too_few_runs': 0,
-                    'resources': {'failed': defaultdict(int), 'changed': defaultdict(int), 'skipped': defaultdict(int), 'flapping': defaultdict(int)},
-                    }
+    return cache_fpath + '.partial'
 
-    for node in data['nodes']:
-        if 'reports' not in data['nodes'][node]:
-            res['nodes']['with_no_report'] += 1
-            res['nodes']['with_no_successful_runs'] += 1
-            continue
-        if 'run_count' not in data['nodes'][node]['reports']:
-            res['nodes']['with_no_report'] += 1
-            res['nodes']['with_no_successful_runs'] += 1
-            continue
 
-        failpct = 0
-        if data['nodes'][node]['reports']['run_count'] > 0:
-            failpct = float(data['nodes'][node]['reports']['with_failures']) / float(data['nodes'][node]['reports']['run_count'])
+def backfill_checkpoint_path(cache_dir, hostname, timespans):
+    """
+    Return the path to the per-node checkpoint file kept while a set of
+    timespans is backfilled in one pass (see backfill_uncached()), named for
+    the range they cover
 
-        if data['nodes'][node]['reports']['run_count'] < RUNS_PER_DAY:
-            res['nodes']['with_too_few_runs'] += 1
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    :param hostname: name of the puppetdb host we're connected to
+    :type hostname: string
+    :param timespans: list of (start, end) tuples
+    :type timespans: list
+    """
+    fpath = cache_path(cache_dir, hostname, min(timespans)[0], max(timespans)[1])
+    return os.path.splitext(fpath)[0] + '.backfill.partial'
 
-        if data['nodes'][node]['reports']['run_count'] == 0:
-            res['nodes']['with_no_report'] += 1
-            res['nodes']['with_no_successful_runs'] += 1
-        elif data['nodes'][node]['reports']['with_failures'] == data['nodes'][node]['reports']['run_count']:
-            res['nodes']['with_no_successful_runs'] += 1
-        elif failpct >= 0.5 and failpct < 1.0:
-            res['nodes']['with_50+%_failed'] += 1
 
-        for key in ['run_count', 'with_failures', 'with_changes', 'with_skips']:
-            if key in data['nodes'][node]['reports']:
-                res['reports'][key] += data['nodes'][node]['reports'][key]
-            if key in data['nodes'][node]['reports'] and key in res['nodes'] and data['nodes'][node]['reports'][key] > 0:
-                res['nodes'][key] += 1
+class NodeCheckpoint(object):
+    """
+    Append-only file of the data for each node of a timespan, written as each
+    node is finished, so a fetch that's interrupted (i.e. by a PuppetDB
+    restart) can resume with only the nodes that weren't. Each record is a
+    pickled (node name, data) tuple; a record cut short by a crash is
+    dropped when the file is loaded.
+    """
 
-        if 'run_time_total' in data['nodes'][node]['reports']:
-            res['reports']['run_time_total'] = res['reports']['run_time_total'] + data['nodes'][node]['reports']['run_time_total']
-        if 'run_time_max' in data['nodes'][node]['reports'] and data['nodes'][node]['reports']['run_time_max'] > res['reports']['run_time_max']:
-            res['reports']['run_time_max'] = data['nodes'][node]['reports']['run_time_max']
+    def __init__(self, fpath):
+        """
+        :param fpath: path to the checkpoint file
+        :type fpath: string
+        """
+        self.fpath = fpath
+        self.lock = threading.Lock()
+        self.fh = None
+        self.nodes = {}
+        if os.path.exists(fpath):
+            self.load()
 
-        # resource counts across all nodes
-        if 'resources' in data['nodes'][node]:
-            for key in ['failed', 'changed', 'skipped']:
-                if key in data['nodes'][node]['resources']:
-                    for tup in data['nodes'][node]['resources'][key]:
-                        res['nodes']['resources'][key][tup] += 1
-                        res['reports']['resources'][key][tup] += data['nodes'][node]['resources'][key][tup]
-                        # flapping resources, count of nodes
-                        if key == 'changed' and (float(data['nodes'][node]['resources'][key][tup]) >= (data['nodes'][node]['reports']['run_count'] * 0.45)):
-                            res['nodes']['resources']['flapping'][tup] += 1
+    def load(self):
+        """ read the finished nodes from the file, truncating any partial record """
+        for name, data in load_records(self.fpath):
+            self.nodes[name] = data
+        logger.info("loaded checkpoint of {num} nodes from {f}".format(num=len(self.nodes), f=self.fpath))
 
-    # flatten defaultdicts for serialization
-    for key in res['nodes']['resources']:
-        res['nodes']['resources'][key] = dict(res['nodes']['resources'][key])
-    for key in res['reports']['resources']:
-        res['reports']['resources'][key] = dict(res['reports']['resources'][key])
+    def add(self, name, data):
+        """
+        Record the data for a finished node. Safe to call from several threads.
 
-    if res['reports']['run_count'] != 0:
-        res['reports']['run_time_avg'] = res['reports']['run_time_total'] / res['reports']['run_count']
-    logger.debug("aggregation done, returning result")
-    return res
+        :param name: node name
+        :type name: string
+        :param data: the node's data
+        :type data: dict
+        """
+        with self.lock:
+            if self.fh is None:
+                self.fh = open(self.fpath, 'ab')
+            pickle.dump((name, data), self.fh, pickle.HIGHEST_PROTOCOL)
+            self.fh.flush()
+            self.nodes[name] = data
+
+    def close(self):
+        """ close the file, leaving it in place to resume from """
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+
+    def remove(self):
+        """ close and delete the file, once the timespan's cache file is written """
+        self.close()
+        if os.path.exists(self.fpath):
+            os.remove(self.fpath)
 
 
-def get_facts(pdb):
+def lock_path(cache_fpath):
     """
-    return a dict of the values of the facts in FACTS and the counts of each value
+    Return the path to the CacheLock file for a cache entry
 
-    :param pdb: object representing a connected pypuppetdb instance
-    :type pdb: one of the pypuppetdb.API classes
+    :param cache_fpath: path to the cache file
+    :type cache_fpath: string
     """
-    logger.debug("querying facts")
-    res = {}
-    for fact in FACTS:
-        res[fact] = {}
-        fact_vals = pdb.facts(fact)
-        for val in fact_vals:
-            if val.value not in res[fact]:
-                res[fact][val.value] = 0
-            res[fact][val.value] += 1
-    logger.debug("done with facts")
-    return res
+    return cache_fpath + '.lock'
 
 
-def query_data_for_node(pdb, node, start, end):
+class CacheLock(object):
     """
-    Retrieve all desired data for a given node in a given time period
-
-    :param pdb: object representing a connected pypuppetdb instance
-    :type pdb: one of the pypuppetdb.API classes
-    :param node: the node to query for
-    :type node: pypuppetdb.types.Node
-    :param start: beginning of time period to get data for
-    :type start: Datetime
-    :param end: end of time period to get data for
-    :type end: Datetime
+    Advisory exclusive lock on a cache entry, shared by every process (and
+    thread) using the cache dir: an flock() on a lock file next to the entry,
+    which the holder removes when it releases the lock. If fcntl isn't
+    available (i.e. on Windows), locking does nothing.
     """
-    logger.debug("querying node {name} for timespan: {start} to {end}".format(start=start.strftime('%Y-%m-%d %H-%M-%S%z'),
-                                                                              end=end.strftime('%Y-%m-%d %H-%M-%S%z'),
-                                                                              name=node.name,
-                                                                              ))
-    res = {}
 
-    res['reports'] = {'run_count': 0,
-                      'with_failures': 0,
-                      'with_changes': 0,
-                      'with_skips': 0,
-                      'run_time_total': datetime.timedelta(),
-                      'run_time_max': datetime.timedelta()
-                      }
-    res['resources'] = {'failed': defaultdict(int),
-                        'changed': defaultdict(int),
-                        'skipped': defaultdict(int),
-                        }
-    for rep in node.reports():
-        if rep.start > end:
-            continue
-        if rep.start < start:
-            # reports are returned sorted desc by completion time of run
-            logger.debug("found first report before time period - start time is {s}".format(s=rep.start))
-            break
-        res['reports']['run_count'] += 1
-        res['reports']['run_time_total'] = res['reports']['run_time_total'] + rep.run_time
-        if rep.run_time > res['reports']['run_time_max']:
-            res['reports']['run_time_max'] = rep.run_time
-        query_s = '["=", "report", "{hash_}"]'.format(hash_=rep.hash_)
-        events = pdb.events(query_s)
-        # increment per-report counters
-        skips = 0
-        successes = 0
-        failures = 0
-        for e in events:
-            if e.status == 'skipped':
-                skips += 1
-                res['resources']['skipped'][(e.item['type'], e.item['title'])] += 1
-            elif e.status == 'success':
-                successes += 1
-                res['resources']['changed'][(e.item['type'], e.item['title'])] += 1
-            elif e.status == 'failure':
-                failures += 1
-                res['resources']['failed'][(e.item['type'], e.item['title'])] += 1
-        # increment per-node counters for this report
-        if skips > 0:
-            res['reports']['with_skips'] += 1
-        if successes > 0:
-            res['reports']['with_changes'] += 1
-        if failures > 0:
-            res['reports']['with_failures'] += 1
+    def __init__(self, fpath):
+        """
+        :param fpath: path to the lock file
+        :type fpath: string
+        """
+        self.fpath = fpath
+        self.fh = None
 
-    # flatten defaultdicts for serialization
-    for key in res['resources']:
-        res['resources'][key] = dict(res['resources'][key])
+    def acquire(self, blocking=True):
+        """
+        Lock the entry, waiting for any other holder to release it unless
+        blocking is False. Returns whether the lock was acquired.
 
-    logger.debug("got {num} reports for node".format(num=res['reports']['run_count']))
+        :param blocking: whether to wait for the lock
+        :type blocking: boolean
+        """
+        if fcntl is None:
+            return True
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        while True:
+            fh = open(self.fpath, 'a')
+            try:
+                fcntl.flock(fh.fileno(), flags)
+            except (IOError, OSError) as ex:
+                fh.close()
+                if ex.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                    return False
+                raise
+            # the holder we waited for removed the file we locked when it
+            # released it; lock the one at fpath now, if any, instead
+            try:
+                if os.fstat(fh.fileno()).st_ino == os.stat(self.fpath).st_ino:
+                    self.fh = fh
+                    return True
+            except OSError:
+                pass
+            fh.close()
 
-    return res
+    def release(self):
+        """ remove the lock file and unlock it """
+        if self.fh is None:
+            return
+        try:
+            os.remove(self.fpath)
+        except OSError:
+            pass
+        self.fh.close()
+        self.fh = None
 
+    def __enter__(self):
+        self.acquire()
+        return self
 
-def get_dashboard_metrics(pdb):
+    def __exit__(self, *args):
+        self.release()
+
+
+def load_records(fpath):
     """
-    return a dict of the metrics displayed on the PuppetDB dashboard
+    Return the list of records in a file of pickled records appended one
+    after another (as written by NodeCheckpoint and EventCache). If the last
+    record was cut short by a crash, it's dropped and truncated off the file,
+    so the next record appended follows the last complete one.
 
-    :param pdb: object representing a connected pypuppetdb instance
-    :type pdb: one of the pypuppetdb.API classes
+    :param fpath: path to the file
+    :type fpath: string
+    """
+    records = []
+    good = 0
+    with open(fpath, 'rb') as fh:
+        while True:
+            try:
+                records.append(pickle.load(fh))
+            except EOFError:
+                break
+            except (pickle.UnpicklingError, ValueError, TypeError, IndexError):
+                logger.warning("dropping incomplete record at end of {f}".format(f=fpath))
+                break
+            good = fh.tell()
+    if good < os.path.getsize(fpath):
+        with open(fpath, 'r+b') as fh:
+            fh.truncate(good)
+    return records
+
+
+def event_cache_path(cache_dir, hostname):
+    """
+    Return the path to the EventCache file for a given PuppetDB host
+
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    :param hostname: name of the puppetdb host we're connected to
+    :type hostname: string
+    """
+    return os.path.join(cache_dir, "events_{host}.pickle".format(host=hostname))
+
+
+class EventCache(object):
+    """
+    Cache of the events of every report seen, keyed by report hash. A
+    report's events never change once PuppetDB has stored it, so they only
+    ever need to be queried once, whatever day or window is being reported
+    on. Only what the report uses is kept: a tuple of (status, type, title)
+    for each event with a status in EVENT_STATUS_KEYS (an empty tuple for a
+    report with none). The cache is an append-only file of pickled
+    (stored, reports) records, one per call to store(), where stored is the
+    time they were stored as seconds since the epoch and reports is a dict
+    of report hash to events. Since it's loaded whole every run, compact()
+    rewrites it without the reports stored too long ago to still be needed.
+    """
+
+    def __init__(self, fpath):
+        """
+        :param fpath: path to the cache file
+        :type fpath: string
+        """
+        self.fpath = fpath
+        self.lock = threading.Lock()
+        self.fh = None
+        self.reports = {}
+        # report hash to the time it was stored
+        self.stored = {}
+        # hashes of the reports looked up or stored this run
+        self.used = set()
+        # whether the file has records from before they were timestamped,
+        # which compact() rewrites with a timestamp
+        self.legacy = False
+        if os.path.exists(fpath):
+            mtime = os.path.getmtime(fpath)
+            for record in load_records(fpath):
+                if isinstance(record, dict):
+                    # stored no later than the file was last written
+                    record = (mtime, record)
+                    self.legacy = True
+                stored, reports = record
+                self.reports.update(reports)
+                self.stored.update((hash_, stored) for hash_ in reports)
+            os.utime(fpath, None)
+            logger.info("loaded events of {num} reports from {f}".format(num=len(self.reports), f=fpath))
+
+    def lookup(self, hashes):
+        """
+        Return a tuple of the list of EventSummary for the reports in the
+        cache, and the list of hashes of the reports that aren't.
+
+        :param hashes: list of report hashes
+        :type hashes: list
+        """
+        events = []
+        missing = []
+        with self.lock:
+            self.used.update(hashes)
+        for hash_ in hashes:
+            if hash_ not in self.reports:
+                missing.append(hash_)
+                continue
+            for status, type_, title in self.reports[hash_]:
+                events.append(EventSummary(hash_, status, type_, title))
+        return events, missing
+
+    def store(self, hashes, events):
+        """
+        Add the complete events of some reports to the cache. Safe to call
+        from several threads.
+
+        :param hashes: the hashes of the reports
+        :type hashes: list
+        :param events: all of the events of those reports
+        :type events: list of EventSummary
+        """
+        record = dict((hash_, []) for hash_ in hashes)
+        for e in events:
+            if e.hash_ in record and e.status in EVENT_STATUS_KEYS:
+                record[e.hash_].append((e.status, e.type_, e.title))
+        for hash_ in record:
+            record[hash_] = tuple(record[hash_])
+        stored = time.time()
+        with self.lock:
+            if self.fh is None:
+                if not os.path.exists(os.path.dirname(self.fpath)):
+                    try:
+                        os.makedirs(os.path.dirname(self.fpath))
+                    except OSError:
+                        # another thread may have just created it
+                        if not os.path.isdir(os.path.dirname(self.fpath)):
+                            raise
+                self.fh = open(self.fpath, 'ab')
+            # in a single write, so records appended by other processes
+            # sharing the cache dir are never interleaved with it
+            self.fh.write(pickle.dumps((stored, record), pickle.HIGHEST_PROTOCOL))
+            self.fh.flush()
+            self.reports.update(record)
+            self.stored.update((hash_, stored) for hash_ in record)
+            self.used.update(record)
+
+    def compact(self, max_age=None, now=None):
+        """
+        Rewrite the cache file without the reports stored more than max_age
+        days ago and not used this run, so it doesn't grow without bound. A
+        report is stored no earlier than it ran, so the reports of every day
+        within max_age are kept, whether or not this run read that day from
+        the day cache. Records from before they were timestamped are
+        rewritten with one. Returns the number of reports dropped. Records
+        appended meanwhile by another run sharing the cache dir may be lost,
+        which only means querying them again.
+
+        :param max_age: max age of a stored report, in days; None for no limit
+        :type max_age: int
+        :param now: current time as seconds since the epoch; default time.time()
+        :type now: float
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            expired = []
+            if max_age:
+                cutoff = now - max_age * 86400
+                expired = [hash_ for hash_ in self.reports if self.stored[hash_] < cutoff and hash_ not in self.used]
+            if len(expired) == 0 and not self.legacy:
+                return 0
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+            for hash_ in expired:
+                del self.reports[hash_]
+                del self.stored[hash_]
+            records = defaultdict(dict)
+            for hash_ in self.reports:
+                records[self.stored[hash_]][hash_] = self.reports[hash_]
+            with CacheLock(lock_path(self.fpath)):
+                write_file_atomic(self.fpath, b''.join(pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+                                                       for record in sorted(records.items())))
+            self.legacy = False
+        logger.info("compacted {f}, dropping the events of {num} reports".format(f=self.fpath, num=len(expired)))
+        return len(expired)
+
+    def close(self):
+        """ close the file """
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+
+
+def manifest_path(cache_dir):
+    """
+    Return the path to the CacheManifest file in a cache directory
+
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    """
+    return os.path.join(cache_dir, 'manifest.json')
+
+
+class CacheManifest(object):
+    """
+    JSON manifest of the days cached in a cache dir, and of how often the
+    cache was used. Each entry, keyed by the day's cache file name (for
+    either cache backend), records the PuppetDB host, the day's start and
+    end (UTC), the cache backend and schema version, the size of its cache
+    file, how many seconds it took to build, when it was built and last
+    used, and how many times it was used; per host, the total cache hits
+    and misses are kept.
+
+    Updates are kept in memory (safe to make from several threads) until
+    save(), which merges them into the file as it is then and replaces it
+    atomically, so runs against other PuppetDB hosts don't lose each
+    other's updates.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: absolute path to where to cache data from PuppetDB
+        :type cache_dir: string
+        """
+        self.cache_dir = cache_dir
+        self.fpath = manifest_path(cache_dir)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.counts = {}
+
+    def load(self):
+        """
+        Return the manifest from disk, or an empty one if there is none or
+        it can't be read.
+        """
+        doc = {'version': 1, 'entries': {}, 'hosts': {}}
+        if not os.path.exists(self.fpath):
+            return doc
+        try:
+            with open(self.fpath, 'r') as fh:
+                doc.update(json.load(fh))
+        except ValueError as ex:
+            logger.warning("ignoring unreadable cache manifest {f}: {ex}".format(f=self.fpath, ex=ex))
+        return doc
+
+    def _update(self, hostname, start, end, backend, **fields):
+        """ record new values for some fields of a day's entry; call with the lock held """
+        key = os.path.basename(cache_path(self.cache_dir, hostname, start, end))
+        entry = self.entries.setdefault(key, {'hits': 0})
+        entry.update(fields, host=hostname, start=sqlite_time(start), end=sqlite_time(end), backend=backend)
+        return entry
+
+    def _count(self, hostname, counter):
+        """ count a cache hit or miss for a host; call with the lock held """
+        self.counts.setdefault(hostname, {'hits': 0, 'misses': 0})[counter] += 1
+
+    def record_hit(self, hostname, start, end, backend):
+        """
+        Record that a day's data was read from the cache.
+
+        :param hostname: name of the puppetdb host
+        :type hostname: string
+        :param start: beginning of time period
+        :type start: Datetime
+        :param end: end of time period
+        :type end: Datetime
+        :param backend: cache backend, 'files' or 'sqlite'
+        :type backend: string
+        """
+        with self.lock:
+            self._update(hostname, start, end, backend, last_access=time.time())['hits'] += 1
+            self._count(hostname, 'hits')
+
+    def record_build(self, hostname, start, end, backend, seconds):
+        """
+        Record that a day's data wasn't cached, and was queried from PuppetDB
+        and cached.
+
+        :param hostname: name of the puppetdb host
+        :type hostname: string
+        :param start: beginning of time period
+        :type start: Datetime
+        :param end: end of time period
+        :type end: Datetime
+        :param backend: cache backend, 'files' or 'sqlite'
+        :type backend: string
+        :param seconds: how long it took to query the data
+        :type seconds: float
+        """
+        schema = SQLITE_SCHEMA_VERSION if backend == 'sqlite' else CACHE_SCHEMA_VERSION
+        now = time.time()
+        with self.lock:
+            self._update(hostname, start, end, backend, schema=schema, build_seconds=round(seconds, 3), built=now,
+                         last_access=now)
+            self._count(hostname, 'misses')
+
+    def save(self):
+        """
+        Merge the updates recorded since the last save() into the manifest
+        file, and atomically replace it. Entries for cache files, or days in
+        the SQLite cache, that no longer exist (i.e. were pruned) are
+        dropped, and the size of the cache files is updated.
+        """
+        with self.lock:
+            if not os.path.exists(self.cache_dir):
+                return
+            with CacheLock(lock_path(self.fpath)):
+                self._save()
+
+    def _save(self):
+        """ body of save(); call with both locks held """
+        doc = self.load()
+        for key, update in self.entries.items():
+            entry = doc['entries'].setdefault(key, {'hits': 0})
+            hits = entry.get('hits', 0) + update['hits']
+            entry.update(update)
+            entry['hits'] = hits
+        for hostname, counts in self.counts.items():
+            host = doc['hosts'].setdefault(hostname, {'hits': 0, 'misses': 0})
+            for counter in counts:
+                host[counter] = host.get(counter, 0) + counts[counter]
+        sqlite_days = set()
+        if os.path.exists(sqlite_cache_path(self.cache_dir)) and \
+                any(e.get('backend') == 'sqlite' for e in doc['entries'].values()):
+            sqlite_days = SQLiteCache(sqlite_cache_path(self.cache_dir)).cached_days()
+        for key in list(doc['entries'].keys()):
+            entry = doc['entries'][key]
+            if entry.get('backend') == 'sqlite':
+                if (entry.get('host'), entry.get('start'), entry.get('end')) not in sqlite_days:
+                    del doc['entries'][key]
+                continue
+            if entry.get('backend') != 'files':
+                continue
+            fpath = os.path.join(self.cache_dir, key)
+            if not os.path.exists(fpath):
+                del doc['entries'][key]
+                continue
+            doc['entries'][key]['size'] = os.path.getsize(fpath)
+        write_file_atomic(self.fpath, json.dumps(doc, sort_keys=True, indent=1).encode('utf-8'))
+        self.entries = {}
+        self.counts = {}
+
+
+def format_cache_stats(doc, num_slowest=NUM_RESULT_ROWS):
+    """
+    Return a plain text summary of a cache manifest, for --cache-stats: the
+    number of cached days (and buckets, see get_data_for_windows()), their
+    size, hits, misses and hit rate, overall and per PuppetDB host, and the
+    slowest days to build.
+
+    :param doc: the manifest, from CacheManifest.load()
+    :type doc: dict
+    :param num_slowest: number of the slowest days to build to list
+    :type num_slowest: int
+    """
+    entries = list(doc['entries'].values())
+
+    def is_bucket(e):
+        length = (calendar.timegm(time.strptime(e['end'], '%Y-%m-%d %H:%M:%S')) -
+                  calendar.timegm(time.strptime(e['start'], '%Y-%m-%d %H:%M:%S')))
+        return length < BUCKET_LENGTH.total_seconds()
+
+    def summary(entries, counts):
+        lookups = counts['hits'] + counts['misses']
+        rate = float(counts['hits']) / lookups if lookups > 0 else 0.0
+        buckets = len([e for e in entries if is_bucket(e)])
+        return "{num} cached days, {buckets}{size} bytes; {hits} hits, {misses} misses ({rate:.1%} hit rate)".format(
+            num=len(entries) - buckets, buckets='{b} cached buckets, '.format(b=buckets) if buckets else '',
+            size=sum(e.get('size') or 0 for e in entries), hits=counts['hits'], misses=counts['misses'], rate=rate)
+
+    total = {'hits': 0, 'misses': 0}
+    for counts in doc['hosts'].values():
+        total['hits'] += counts.get('hits', 0)
+        total['misses'] += counts.get('misses', 0)
+    lines = ["total: " + summary(entries, total)]
+    for host in sorted(set(doc['hosts'].keys()) | set(e['host'] for e in entries)):
+        counts = {'hits': 0, 'misses': 0}
+        counts.update(doc['hosts'].get(host, {}))
+        lines.append("{host}: ".format(host=host) + summary([e for e in entries if e['host'] == host], counts))
+    built = sorted([e for e in entries if e.get('build_seconds') is not None and not is_bucket(e)],
+                   key=lambda e: -e['build_seconds'])
+    if len(built) > 0:
+        lines.append("slowest days to build:")
+    for e in built[:num_slowest]:
+        lines.append("  {secs:.1f}s {host} {start} to {end} ({backend})".format(
+            secs=e['build_seconds'], host=e['host'], start=e['start'], end=e['end'], backend=e['backend']))
+    return '\n'.join(lines) + '\n'
+
+
+def sqlite_cache_path(cache_dir):
+    """
+    Return the path to the SQLite cache database in a cache directory
+
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    """
+    return os.path.join(cache_dir, 'pypuppetdb_daily_report.sqlite')
+
+
+def sqlite_time(dt):
+    """
+    Format a datetime for the SQLite cache, as UTC text that sorts in time
+    order. Naive datetimes are assumed to already be UTC.
+
+    :param dt: the datetime to format
+    :type dt: Datetime
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.utc)
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class SQLiteCache(object):
+    """
+    Day data cache in a single SQLite database, selected with
+    ``--cache-backend sqlite``, as an alternative to one cache file per day.
+    Each day is a row of ``days``, indexed by PuppetDB host and start time,
+    and its per-node counters, resource tallies, aggregates, metric
+    snapshots (as JSON) and fact counts are rows of their own tables, so any
+    range of days is read with indexed queries. ``run_time_*`` values are
+    stored as integer microseconds.
+
+    Each method opens its own connection, so one instance may be used from
+    several threads (and several processes may share the database).
+    """
+
+    # aggregate sections, and the resource tallies in each
+    AGGREGATE_RESOURCES = {'reports': ['failed', 'changed', 'skipped'],
+                           'nodes': ['failed', 'changed', 'skipped', 'flapping']}
+    NODE_COUNTERS = ['run_count', 'with_failures', 'with_changes', 'with_skips', 'run_time_total', 'run_time_max']
+    TABLES = ['days', 'node_days', 'node_resources', 'aggregates', 'aggregate_resources', 'metrics', 'facts']
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS days (id INTEGER PRIMARY KEY, host TEXT NOT NULL, start TEXT NOT NULL,
+           end TEXT NOT NULL, has_metrics INTEGER NOT NULL, has_facts INTEGER NOT NULL, accessed REAL NOT NULL,
+           compacted INTEGER NOT NULL, UNIQUE (host, start, end))""",
+        """CREATE TABLE IF NOT EXISTS node_days (day_id INTEGER NOT NULL, node TEXT NOT NULL, run_count INTEGER,
+           with_failures INTEGER, with_changes INTEGER, with_skips INTEGER, run_time_total INTEGER,
+           run_time_max INTEGER, PRIMARY KEY (day_id, node))""",
+        """CREATE TABLE IF NOT EXISTS node_resources (day_id INTEGER NOT NULL, node TEXT NOT NULL,
+           status TEXT NOT NULL, type TEXT NOT NULL, title TEXT NOT NULL, count INTEGER NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS node_resources_day ON node_resources (day_id, node)",
+        """CREATE TABLE IF NOT EXISTS aggregates (day_id INTEGER NOT NULL, section TEXT NOT NULL, key TEXT NOT NULL,
+           value INTEGER, PRIMARY KEY (day_id, section, key))""",
+        """CREATE TABLE IF NOT EXISTS aggregate_resources (day_id INTEGER NOT NULL, section TEXT NOT NULL,
+           status TEXT NOT NULL, type TEXT NOT NULL, title TEXT NOT NULL, count INTEGER NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS aggregate_resources_day ON aggregate_resources (day_id, section, status)",
+        """CREATE TABLE IF NOT EXISTS metrics (day_id INTEGER NOT NULL, name TEXT NOT NULL, metric TEXT NOT NULL,
+           PRIMARY KEY (day_id, name))""",
+        """CREATE TABLE IF NOT EXISTS facts (day_id INTEGER NOT NULL, fact TEXT NOT NULL, value TEXT NOT NULL,
+           count INTEGER NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS facts_day ON facts (day_id)",
+    ]
+
+    def __init__(self, fpath):
+        """
+        :param fpath: path to the SQLite database file
+        :type fpath: string
+        """
+        self.fpath = fpath
+
+    def connect(self):
+        """
+        Return a new connection to the database, creating it (and the dir
+        it's in) and the tables if they don't exist, or recreating the
+        tables (dropping all cached data) if they're from another
+        SQLITE_SCHEMA_VERSION.
+        """
+        if not os.path.exists(os.path.dirname(self.fpath)):
+            try:
+                os.makedirs(os.path.dirname(self.fpath))
+            except OSError:
+                # another thread may have just created it
+                if not os.path.isdir(os.path.dirname(self.fpath)):
+                    raise
+        conn = sqlite3.connect(self.fpath, timeout=60)
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != SQLITE_SCHEMA_VERSION:
+            with conn:
+                if version != 0:
+                    logger.warning("SQLite cache {f} has schema version {v}, not {cur}; discarding it".format(
+                        f=self.fpath, v=version, cur=SQLITE_SCHEMA_VERSION))
+                    for table in self.TABLES:
+                        conn.execute('DROP TABLE IF EXISTS {t}'.format(t=table))
+                for statement in self.SCHEMA:
+                    conn.execute(statement)
+                conn.execute('PRAGMA user_version = {v:d}'.format(v=SQLITE_SCHEMA_VERSION))
+        return conn
+
+    def read_day(self, hostname, start, end):
+        """
+        Return the cached data for one timespan, or None if it's not cached.
+
+        :param hostname: name of the puppetdb host
+        :type hostname: string
+        :param start: beginning of time period
+        :type start: Datetime
+        :param end: end of time period
+        :type end: Datetime
+        """
+        return self.read_days(hostname, [(start, end)]).get((start, end), None)
+
+    def cached_timespans(self, hostname, timespans):
+        """
+        Return the list of the given (start, end) timespans that are cached.
+
+        :param hostname: name of the puppetdb host
+        :type hostname: string
+        :param timespans: list of (start, end) tuples
+        :type timespans: list
+        """
+        if len(timespans) == 0:
+            return []
+        conn = self.connect()
+        try:
+            rows = self._day_rows(conn, hostname, timespans)
+        finally:
+            conn.close()
+        return [timespan for timespan in timespans if (sqlite_time(timespan[0]), sqlite_time(timespan[1])) in rows]
+
+    def read_days(self, hostname, timespans):
+        """
+        Return a dict of (start, end) tuple to data for each of the given
+        timespans that's cached, read with one range query per table.
+
+        :param hostname: name of the puppetdb host
+        :type hostname: string
+        :param timespans: list of (start, end) tuples
+        :type timespans: list
+        """
+        if len(timespans) == 0:
+            return {}
+        conn = self.connect()
+        try:
+            rows = self._day_rows(conn, hostname, timespans)
+            wanted = dict((rows[(sqlite_time(start), sqlite_time(end))], (start, end)) for start, end in timespans
+                          if (sqlite_time(start), sqlite_time(end)) in rows)
+            data = self._load(conn, wanted.keys())
+            with conn:
+                conn.executemany('UPDATE days SET accessed = ? WHERE id = ?', [(time.time(), day_id) for day_id in wanted])
+        finally:
+            conn.close()
+        return dict((wanted[day_id], data[day_id]) for day_id in wanted)
+
+    def cached_days(self):
+        """
+        Return the set of (hostname, start, end) tuples of every cached day,
+        with start and end as stored (see sqlite_time()).
+        """
+        conn = self.connect()
+        try:
+            return set(tuple(row) for row in conn.execute('SELECT host, start, end FROM days'))
+        finally:
+            conn.close()
+
+    def _day_rows(self, conn, hostname, timespans):
+        """ return a dict of (start, end) text to day id, for the host's days in the range of timespans """
+        cur = conn.execute('SELECT id, start, end FROM days WHERE host = ? AND start >= ? AND end <= ?',
+                           (hostname, min(sqlite_time(start) for start, end in timespans),
+                            max(sqlite_time(end) for start, end in timespans)))
+        return dict(((start, end), day_id) for day_id, start, end in cur)
+
+    def _load(self, conn, day_ids):
+        """ return a dict of day id to the data for that day """
+        day_ids = list(day_ids)
+        if len(day_ids) == 0:
+            return {}
+        ids = ','.join('{i:d}'.format(i=day_id) for day_id in day_ids)
+        res = {}
+        for day_id, has_metrics, has_facts, compacted in conn.execute(
+                'SELECT id, has_metrics, has_facts, compacted FROM days WHERE id IN ({ids})'.format(ids=ids)):
+            res[day_id] = {'nodes': {},
+                           'aggregate': dict((section, {'resources': dict((status, {}) for status in self.AGGREGATE_RESOURCES[section])})
+                                             for section in self.AGGREGATE_RESOURCES)}
+            if has_metrics:
+                res[day_id]['metrics'] = {}
+            if has_facts:
+                res[day_id]['facts'] = {}
+            if compacted:
+                res[day_id]['compacted'] = True
+        for row in conn.execute('SELECT day_id, node, {cols} FROM node_days WHERE day_id IN ({ids})'.format(
+                cols=', '.join(self.NODE_COUNTERS), ids=ids)):
+            if 'compacted' in res[row[0]]:
+                res[row[0]]['nodes'][row[1]] = {}
+                continue
+            reports = dict(zip(self.NODE_COUNTERS, row[2:]))
+            for key in ['run_time_total', 'run_time_max']:
+                reports[key] = datetime.timedelta(microseconds=reports[key])
+            res[row[0]]['nodes'][row[1]] = {'reports': reports,
+                                            'resources': {'failed': {}, 'changed': {}, 'skipped': {}}}
+        for day_id, node, status, type_, title, count in conn.execute(
+                'SELECT day_id, node, status, type, title, count FROM node_resources WHERE day_id IN ({ids})'.format(ids=ids)):
+            res[day_id]['nodes'][node]['resources'][status][(type_, title)] = count
+        for day_id, section, key, value in conn.execute(
+                'SELECT day_id, section, key, value FROM aggregates WHERE day_id IN ({ids})'.format(ids=ids)):
+            if key.startswith('run_time_'):
+                value = datetime.timedelta(microseconds=value)
+            res[day_id]['aggregate'][section][key] = value
+        for day_id, section, status, type_, title, count in conn.execute(
+                'SELECT day_id, section, status, type, title, count FROM aggregate_resources WHERE day_id IN ({ids})'.format(ids=ids)):
+            res[day_id]['aggregate'][section]['resources'][status][(type_, title)] = count
+        for day_id, name, metric in conn.execute(
+                'SELECT day_id, name, metric FROM metrics WHERE day_id IN ({ids})'.format(ids=ids)):
+            res[day_id]['metrics'][name] = json.loads(metric)
+        for day_id, fact, value, count in conn.execute(
+                'SELECT day_id, fact, value, count FROM facts WHERE day_id IN ({ids})'.format(ids=ids)):
+            res[day_id]['facts'].setdefault(fact, {})[json.loads(value)] = count
+        return res
+
+    def write_day(self, hostname, start, end, data):
+        """
+        Store the data for one timespan, replacing any already stored.
+
+        :param hostname: name of the puppetdb host
+        :type hostname: string
+        :param start: beginning of time period
+        :type start: Datetime
+        :param end: end of time period
+        :type end: Datetime
+        :param data: data for the timespan
+        :type data: dict
+        """
+        logger.debug("writing data to SQLite cache")
+        conn = self.connect()
+        try:
+            with conn:
+                self._delete_day(conn, hostname, start, end)
+                day_id = conn.execute('INSERT INTO days (host, start, end, has_metrics, has_facts, accessed, compacted) '
+                                      'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                      (hostname, sqlite_time(start), sqlite_time(end), int('metrics' in data),
+                                       int('facts' in data), time.time(), int(data.get('compacted', False)))).lastrowid
+                self._insert_day(conn, day_id, data)
+        finally:
+            conn.close()
+
+    def prune(self, max_age=None, max_bytes=None, max_files=None, now=None, keep=None, bucket_max_age=None):
+        """
+        Delete cached days, as prune_cache() does for cache files: days that
+        started more than max_age days ago, and buckets that started more
+        than bucket_max_age days ago, then the least recently used
+        days of each host beyond max_files, then the least recently used
+        days until the data takes up at most max_bytes, never deleting the
+        ``keep`` days for the last two. Returns the number of days deleted.
+
+        :param max_age: max age of a cached day, in days; None for no limit
+        :type max_age: int
+        :param max_bytes: max size of the data, in bytes; None for no limit
+        :type max_bytes: int
+        :param max_files: max number of cached days per host; None for no limit
+        :type max_files: int
+        :param now: current time as seconds since the epoch; default time.time()
+        :type now: float
+        :param keep: (hostname, start, end) tuples of the days used by this
+          run; a hostname of None keeps the day for every host
+        :type keep: list
+        :param bucket_max_age: max age of a cached bucket, in days; None for
+          max_age
+        :type bucket_max_age: int
+        """
+        if now is None:
+            now = time.time()
+        if keep is None:
+            keep = []
+        kept = set((host, sqlite_time(start), sqlite_time(end)) for host, start, end in keep)
+        kept_any = set((start, end) for host, start, end in kept if host is None)
+        conn = self.connect()
+        try:
+            with conn:
+                day_ids = set()
+                if max_age:
+                    cutoff = datetime.datetime.utcfromtimestamp(now - max_age * 86400).strftime('%Y-%m-%d %H:%M:%S')
+                    day_ids.update(row[0] for row in conn.execute('SELECT id FROM days WHERE start < ?', (cutoff,)))
+                if bucket_max_age:
+                    cutoff = datetime.datetime.utcfromtimestamp(now - bucket_max_age * 86400).strftime('%Y-%m-%d %H:%M:%S')
+                    day_ids.update(row[0] for row in conn.execute(
+                        'SELECT id FROM days WHERE start < ? AND (julianday(end) - julianday(start)) * 86400 < ?',
+                        (cutoff, BUCKET_LENGTH.total_seconds())))
+                keep_ids = set(row[0] for row in conn.execute('SELECT id, host, start, end FROM days')
+                               if tuple(row[1:]) in kept or tuple(row[2:]) in kept_any)
+                if max_files:
+                    for host, in conn.execute('SELECT DISTINCT host FROM days').fetchall():
+                        rows = [row[0] for row in conn.execute('SELECT id FROM days WHERE host = ? ORDER BY accessed', (host,))
+                                if row[0] not in day_ids]
+                        excess = len(rows) - max_files
+                        day_ids.update([day_id for day_id in rows if day_id not in keep_ids][:max(excess, 0)])
+                for day_id in day_ids:
+                    self._delete_day_id(conn, day_id)
+            num = len(day_ids)
+            while max_bytes and self._used_bytes(conn) > max_bytes:
+                row = conn.execute('SELECT id FROM days WHERE id NOT IN ({ids}) ORDER BY accessed LIMIT 1'.format(
+                    ids=','.join('{i:d}'.format(i=day_id) for day_id in keep_ids))).fetchone()
+                if row is None:
+                    break
+                with conn:
+                    self._delete_day_id(conn, row[0])
+                num += 1
+            if num > 0:
+                conn.execute('VACUUM')
+        finally:
+            conn.close()
+        return num
+
+    def compact(self, older_than, top=COMPACT_TOP_RESOURCES, now=None):
+        """
+        Compact the cached days that started more than older_than days ago,
+        as compact_cache() does for cache files. Returns the number of days
+        compacted.
+
+        :param older_than: compact days older than this many days
+        :type older_than: int
+        :param top: number of resources of each status to keep in each aggregate
+        :type top: int
+        :param now: current time as seconds since the epoch; default time.time()
+        :type now: float
+        """
+        if now is None:
+            now = time.time()
+        cutoff = datetime.datetime.utcfromtimestamp(now - older_than * 86400).strftime('%Y-%m-%d %H:%M:%S')
+        conn = self.connect()
+        try:
+            # buckets are merged node by node, so they're kept whole
+            day_ids = [row[0] for row in conn.execute(
+                'SELECT id FROM days WHERE start < ? AND compacted = 0 AND '
+                '(julianday(end) - julianday(start)) * 86400 >= ?', (cutoff, BUCKET_LENGTH.total_seconds()))]
+            data = self._load(conn, day_ids)
+            with conn:
+                for day_id in day_ids:
+                    self._delete_day_rows(conn, day_id)
+                    conn.execute('UPDATE days SET compacted = 1 WHERE id = ?', (day_id,))
+                    self._insert_day(conn, day_id, compact_day_data(data[day_id], top=top))
+            if len(day_ids) > 0:
+                conn.execute('VACUUM')
+        finally:
+            conn.close()
+        return len(day_ids)
+
+    def _used_bytes(self, conn):
+        """ return the number of bytes of the database in use (not free pages) """
+        pages = conn.execute('PRAGMA page_count').fetchone()[0] - conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return pages * conn.execute('PRAGMA page_size').fetchone()[0]
+
+    def _delete_day(self, conn, hostname, start, end):
+        """ delete the data for one timespan """
+        row = conn.execute('SELECT id FROM days WHERE host = ? AND start = ? AND end = ?',
+                           (hostname, sqlite_time(start), sqlite_time(end))).fetchone()
+        if row is not None:
+            self._delete_day_id(conn, row[0])
+
+    def _delete_day_id(self, conn, day_id):
+        """ delete the data for one day, by id """
+        self._delete_day_rows(conn, day_id)
+        conn.execute('DELETE FROM days WHERE id = ?', (day_id,))
+
+    def _delete_day_rows(self, conn, day_id):
+        """ delete the rows holding the data of one day, but not the day itself """
+        for table in self.TABLES[1:]:
+            conn.execute('DELETE FROM {t} WHERE day_id = ?'.format(t=table), (day_id,))
+
+    def _insert_day(self, conn, day_id, data):
+        """ insert the rows for one day's data """
+        node_rows = []
+        resource_rows = []
+        for node in data['nodes']:
+            # compacted days only have the node names
+            reports = data['nodes'][node].get('reports', {})
+            node_rows.append([day_id, node] + [int_value(reports.get(key)) for key in self.NODE_COUNTERS])
+            for status in data['nodes'][node].get('resources', {}):
+                for (type_, title), count in data['nodes'][node]['resources'][status].items():
+                    resource_rows.append((day_id, node, status, type_, title, count))
+        conn.executemany('INSERT INTO node_days (day_id, node, {cols}) VALUES (?, ?, {params})'.format(
+            cols=', '.join(self.NODE_COUNTERS), params=', '.join('?' for key in self.NODE_COUNTERS)), node_rows)
+        conn.executemany('INSERT INTO node_resources (day_id, node, status, type, title, count) VALUES (?, ?, ?, ?, ?, ?)',
+                         resource_rows)
+        aggregate_rows = []
+        resource_rows = []
+        for section in data.get('aggregate', {}):
+            for key, value in data['aggregate'][section].items():
+                if key != 'resources':
+                    aggregate_rows.append((day_id, section, key, int_value(value)))
+                    continue
+                for status in value:
+                    for (type_, title), count in value[status].items():
+                        resource_rows.append((day_id, section, status, type_, title, count))
+        conn.executemany('INSERT INTO aggregates (day_id, section, key, value) VALUES (?, ?, ?, ?)', aggregate_rows)
+        conn.executemany('INSERT INTO aggregate_resources (day_id, section, status, type, title, count) VALUES (?, ?, ?, ?, ?, ?)',
+                         resource_rows)
+        metrics = data.get('metrics', {})
+        conn.executemany('INSERT INTO metrics (day_id, name, metric) VALUES (?, ?, ?)',
+                         [(day_id, name, json.dumps(metrics[name])) for name in metrics])
+        facts = data.get('facts', {})
+        conn.executemany('INSERT INTO facts (day_id, fact, value, count) VALUES (?, ?, ?, ?)',
+                         [(day_id, fact, json.dumps(value), count) for fact in facts for value, count in facts[fact].items()])
+
+
+def int_value(value):
+    """
+    Return a value to store in an INTEGER column of the SQLite cache:
+    timedeltas as integer microseconds, anything else as-is.
+
+    :param value: the value
+    """
+    if isinstance(value, datetime.timedelta):
+        return (value.days * 86400 + value.seconds) * 1000000 + value.microseconds
+    return value
+
+
+def write_cache(fpath, data):
+    """
+    Write the data for one timespan to its cache file
+
+    :param fpath: path to the cache file
+    :type fpath: string
+    :param data: data for the timespan
+    :type data: dict
+    """
+    logger.debug("writing data to cache")
+    write_file_atomic(fpath, dumps_cache(data))
+
+
+def write_file_atomic(fpath, data):
+    """
+    Write a file by writing a temporary file next to it and renaming that
+    over it, so anything reading it (i.e. another run sharing the cache dir)
+    only ever sees the old or the complete new content.
+
+    :param fpath: path to the file
+    :type fpath: string
+    :param data: the new content
+    :type data: bytes
+    """
+    tmp_fpath = '{f}.{pid}.{thread}.tmp'.format(f=fpath, pid=os.getpid(), thread=threading.current_thread().ident)
+    try:
+        with open(tmp_fpath, 'wb') as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        getattr(os, 'replace', os.rename)(tmp_fpath, fpath)
+    except Exception:
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+        raise
+
+
+def read_cache(fpath):
+    """
+    Return the data for one timespan from its cache file, or None if there
+    is no cache file, or it can't be used (i.e. it was written with another
+    CACHE_SCHEMA_VERSION) and the timespan needs to be queried again.
+
+    :param fpath: path to the cache file
+    :type fpath: string
+    """
+    if not os.path.exists(fpath):
+        return None
+    try:
+        with open(fpath, 'rb') as fh:
+            logger.debug("reading cache file")
+            raw = fh.read()
+    except (IOError, OSError):
+        # pruned by another run since we checked
+        return None
+    try:
+        data = loads_cache(raw)
+    except ValueError as ex:
+        logger.warning("ignoring cache file {f}: {ex}".format(f=fpath, ex=ex))
+        return None
+    # the modification time is when it was last used; see prune_cache()
+    try:
+        os.utime(fpath, None)
+    except OSError:
+        pass
+    return data
+
+
+def migrate_legacy_cache(legacy_fpath, fpath):
+    """
+    If there's a pickle cache file written by an older version, convert it
+    to the current format at ``fpath``, remove it and return its data;
+    otherwise return None.
+
+    :param legacy_fpath: path to the pickle cache file
+    :type legacy_fpath: string
+    :param fpath: path to write the converted cache file to
+    :type fpath: string
+    """
+    if not os.path.exists(legacy_fpath):
+        return None
+    with open(legacy_fpath, 'rb') as fh:
+        raw = fh.read()
+    try:
+        data = pickle.loads(raw)
+    except (pickle.UnpicklingError, EOFError, ValueError, TypeError, AttributeError, IndexError, ImportError, UnicodeDecodeError) as ex:
+        logger.warning("ignoring unreadable pickle cache file {f}: {ex}".format(f=legacy_fpath, ex=ex))
+        return None
+    logger.info("converting pickle cache file {f} to {new}".format(f=legacy_fpath, new=fpath))
+    write_cache(fpath, data)
+    os.remove(legacy_fpath)
+    return data
+
+
+def dumps_cache(data, compression=None):
+    """
+    Return the data for one timespan serialized in the cache file format: a
+    CACHE_HEADER of CACHE_MAGIC, CACHE_SCHEMA_VERSION and the compression
+    used, then a section index, then each section (top-level key of the
+    data) as the separately (optionally) compressed UTF-8 JSON of
+    encode_cache_data() of just that section, so loads_cache() can decode
+    each one only when it's used. The index is the CACHE_INDEX_LENGTH of
+    its UTF-8 JSON, then that JSON: the list of [name, length] of each
+    section, and the number of nodes.
+
+    :param data: data for the timespan
+    :type data: dict
+    :param compression: 'zstd', 'gzip' or None; default CACHE_COMPRESSION
+    :type compression: string
+    """
+    if compression is None:
+        compression = CACHE_COMPRESSION
+    if compression == 'zstd' and zstandard is None:
+        compression = 'gzip'
+    sections = []
+    for key in data:
+        body = json.dumps(encode_cache_data({key: data[key]}), separators=(',', ':')).encode('utf-8')
+        sections.append((key, compress_cache_body(body, compression)))
+    index = json.dumps({'sections': [[key, len(body)] for key, body in sections],
+                        'nodes': len(data.get('nodes', {}))}, separators=(',', ':')).encode('utf-8')
+    return b''.join([CACHE_HEADER.pack(CACHE_MAGIC, CACHE_SCHEMA_VERSION, CACHE_COMPRESSION_CODES[compression]),
+                     CACHE_INDEX_LENGTH.pack(len(index)), index] + [body for key, body in sections])
+
+
+def compress_cache_body(body, compression):
+    """
+    Return bytes compressed for a cache file.
+
+    :param body: bytes to compress
+    :type body: bytes
+    :param compression: 'zstd', 'gzip' or None
+    :type compression: string
+    """
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(body)
+    if compression == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    return body
+
+
+def decompress_cache_body(body, code):
+    """
+    Reverse compress_cache_body(); raises ValueError if we can't decompress
+    it.
+
+    :param body: bytes from a cache file
+    :type body: bytes
+    :param code: compression code from the CACHE_HEADER (see CACHE_COMPRESSION_CODES)
+    :type code: int
+    """
+    if code == CACHE_COMPRESSION_CODES['zstd']:
+        if zstandard is None:
+            raise ValueError("zstd compressed, but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(body)
+    if code == CACHE_COMPRESSION_CODES['gzip']:
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if code != CACHE_COMPRESSION_CODES[None]:
+        raise ValueError("unknown compression {c}".format(c=code))
+    return body
+
+
+def loads_cache(raw):
+    """
+    Return the data for one timespan from the contents of a cache file
+    written by dumps_cache(), as a LazyDayData; raises ValueError if it
+    isn't one, or was written with a different CACHE_SCHEMA_VERSION, or
+    with compression we can't decompress. Files written with schema version
+    1 (the whole day in one compressed JSON body) are still read, into a
+    dict.
+
+    :param raw: cache file contents
+    :type raw: bytes
+    """
+    if len(raw) < CACHE_HEADER.size:
+        raise ValueError("file is too short")
+    magic, version, code = CACHE_HEADER.unpack(raw[:CACHE_HEADER.size])
+    if magic != CACHE_MAGIC:
+        raise ValueError("not a cache file")
+    if version == 1:
+        return decode_cache_data(json.loads(decompress_cache_body(raw[CACHE_HEADER.size:], code).decode('utf-8')))
+    if version != CACHE_SCHEMA_VERSION:
+        raise ValueError("schema version {v}, not {cur}".format(v=version, cur=CACHE_SCHEMA_VERSION))
+    if code not in CACHE_COMPRESSION_CODES.values():
+        raise ValueError("unknown compression {c}".format(c=code))
+    if code == CACHE_COMPRESSION_CODES['zstd'] and zstandard is None:
+        raise ValueError("zstd compressed, but the zstandard package is not installed")
+    pos = CACHE_HEADER.size + CACHE_INDEX_LENGTH.size
+    if len(raw) < pos:
+        raise ValueError("file is too short")
+    length = CACHE_INDEX_LENGTH.unpack(raw[CACHE_HEADER.size:pos])[0]
+    index = json.loads(raw[pos:pos + length].decode('utf-8'))
+    pos += length
+    sections = OrderedDict()
+    for key, length in index['sections']:
+        sections[key] = raw[pos:pos + length]
+        pos += length
+    if pos != len(raw):
+        raise ValueError("file is truncated")
+    return LazyDayData(sections, code, index['nodes'])
+
+
+class LazyDayData(Mapping):
+    """
+    Read-only mapping of the data for one timespan, from a cache file, that
+    decompresses and decodes each section (top-level key, i.e. 'aggregate')
+    the first time it's used. The 'nodes' section is a LazyNodes, so the
+    number of nodes the templates show doesn't need the per-node data to
+    be decoded.
+    """
+
+    def __init__(self, sections, code, num_nodes):
+        """
+        :param sections: dict of section name to its (compressed) bytes
+        :type sections: OrderedDict
+        :param code: compression code from the CACHE_HEADER
+        :type code: int
+        :param num_nodes: number of nodes in the 'nodes' section
+        :type num_nodes: int
+        """
+        self.sections = sections
+        self.code = code
+        self.num_nodes = num_nodes
+        self.loaded = {}
+
+    def load_section(self, key):
+        """ decompress and decode one section """
+        logger.debug("decoding cache section: {key}".format(key=key))
+        doc = json.loads(decompress_cache_body(self.sections[key], self.code).decode('utf-8'))
+        return decode_cache_data(doc)[key]
+
+    def __getitem__(self, key):
+        if key not in self.loaded:
+            if key not in self.sections:
+                raise KeyError(key)
+            if key == 'nodes':
+                self.loaded[key] = LazyNodes(partial(self.load_section, key), self.num_nodes)
+            else:
+                self.loaded[key] = self.load_section(key)
+        return self.loaded[key]
+
+    def __contains__(self, key):
+        return key in self.sections
+
+    def __iter__(self):
+        return iter(self.sections)
+
+    def __len__(self):
+        return len(self.sections)
+
+
+class LazyNodes(Mapping):
+    """
+    Read-only mapping of node name to data, for LazyDayData, whose length
+    is known without loading it.
+    """
+
+    def __init__(self, loader, length):
+        """
+        :param loader: callable returning the dict of node name to data
+        :type loader: callable
+        :param length: number of nodes
+        :type length: int
+        """
+        self.loader = loader
+        self.length = length
+        self.nodes = None
+
+    def load(self):
+        """ return the dict of node name to data, loading it if needed """
+        if self.nodes is None:
+            self.nodes = self.loader()
+        return self.nodes
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return self.length
+
+
+def encode_cache_data(data):
+    """
+    Return the data for one timespan as a JSON-serializable dict: resource
+    (type, title) tuples become pairs of indexes into a single table of
+    strings (``strings``), ``run_time_*`` timedeltas become integer
+    microseconds, and fact value counts become lists of [value, count].
+
+    :param data: data for the timespan
+    :type data: dict
+    """
+    strings = []
+    index = {}
+
+    def string_id(s):
+        if s not in index:
+            index[s] = len(strings)
+            strings.append(s)
+        return index[s]
+
+    def encode(d):
+        res = {}
+        for key, value in d.items():
+            if key == 'resources':
+                res[key] = dict((status, [x for (type_, title), count in value[status].items()
+                                          for x in (string_id(type_), string_id(title), count)])
+                                for status in value)
+            elif key.startswith('run_time_'):
+                res[key] = (value.days * 86400 + value.seconds) * 1000000 + value.microseconds
+            elif isinstance(value, dict):
+                res[key] = encode(value)
+            else:
+                res[key] = value
+        return res
+
+    res = {}
+    for key in data:
+        if key == 'nodes':
+            res[key] = dict((name, encode(data[key][name])) for name in data[key])
+        elif key == 'aggregate':
+            res[key] = encode(data[key])
+        elif key == 'facts':
+            res[key] = dict((fact, [[value, count] for value, count in data[key][fact].items()]) for fact in data[key])
+        else:
+            res[key] = data[key]
+    res['strings'] = strings
+    return res
+
+
+def decode_cache_data(doc):
+    """
+    Reverse encode_cache_data(); return the data for one timespan.
+
+    :param doc: decoded JSON from a cache file
+    :type doc: dict
+    """
+    strings = doc.pop('strings')
+
+    def decode(d):
+        res = {}
+        for key, value in d.items():
+            if key == 'resources':
+                res[key] = {}
+                for status in value:
+                    flat = value[status]
+                    res[key][status] = dict(((strings[flat[i]], strings[flat[i + 1]]), flat[i + 2])
+                                            for i in range(0, len(flat), 3))
+            elif key.startswith('run_time_'):
+                res[key] = datetime.timedelta(microseconds=value)
+            elif isinstance(value, dict):
+                res[key] = decode(value)
+            else:
+                res[key] = value
+        return res
+
+    res = {}
+    for key in doc:
+        if key == 'nodes':
+            res[key] = dict((name, decode(doc[key][name])) for name in doc[key])
+        elif key == 'aggregate':
+            res[key] = decode(doc[key])
+        elif key == 'facts':
+            res[key] = dict((fact, dict((value, count) for value, count in doc[key][fact])) for fact in doc[key])
+        else:
+            res[key] = doc[key]
+    return res
+
+
+def compact_day_data(data, top=COMPACT_TOP_RESOURCES):
+    """
+    Return a compacted copy of the data for one timespan, holding only what
+    the report uses for days other than the newest: the aggregates, with
+    the top resources of each status (by count, as sorted by
+    filter_resource_dict_sort()), and the node names, for the node count.
+    Metrics and facts are kept, and ``compacted`` is set to True.
+
+    :param data: data for the timespan
+    :type data: dict
+    :param top: number of resources of each status to keep in each aggregate
+    :type top: int
+    """
+    res = dict((key, value) for key, value in data.items() if key not in ['nodes', 'aggregate'])
+    res['nodes'] = dict((node, {}) for node in data['nodes'])
+    res['aggregate'] = {}
+    for section, agg in data.get('aggregate', {}).items():
+        res['aggregate'][section] = dict(agg)
+        if 'resources' in agg:
+            res['aggregate'][section]['resources'] = dict(
+                (status, dict(list(filter_resource_dict_sort(agg['resources'][status]).items())[:top]))
+                for status in agg['resources'])
+    res['compacted'] = True
+    return res
+
+
+def compact_cache(cache_dir, older_than, top=COMPACT_TOP_RESOURCES, now=None):
+    """
+    Rewrite the day cache files in cache_dir for days that started more
+    than older_than days ago in compacted form (see compact_day_data()),
+    keeping their modification (last used) times; buckets (see
+    get_data_for_windows()) aren't compacted. Days in the SQLite cache,
+    if any, are compacted by SQLiteCache.compact(). Returns the number of
+    days compacted.
+
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    :param older_than: compact days older than this many days
+    :type older_than: int
+    :param top: number of resources of each status to keep in each aggregate
+    :type top: int
+    :param now: current time as seconds since the epoch; default time.time()
+    :type now: float
+    """
+    if now is None:
+        now = time.time()
+    if not os.path.exists(cache_dir):
+        return 0
+    cutoff = now - older_than * 86400
+    num = 0
+    saved = 0
+    for fname in sorted(os.listdir(cache_dir)):
+        m = DAY_CACHE_FILE_RE.match(fname)
+        if m is None or not fname.endswith('.cache'):
+            continue
+        start = calendar.timegm(time.strptime(m.group('start'), '%Y-%m-%d_%H-%M-%S'))
+        if start >= cutoff:
+            continue
+        # buckets are merged node by node, so they're kept whole
+        if calendar.timegm(time.strptime(m.group('end'), '%Y-%m-%d_%H-%M-%S')) - start < BUCKET_LENGTH.total_seconds():
+            continue
+        fpath = os.path.join(cache_dir, fname)
+        st = os.stat(fpath)
+        with open(fpath, 'rb') as fh:
+            try:
+                data = loads_cache(fh.read())
+            except ValueError:
+                continue
+        if data.get('compacted', False):
+            continue
+        write_cache(fpath, compact_day_data(data, top=top))
+        os.utime(fpath, (st.st_atime, st.st_mtime))
+        num += 1
+        saved += st.st_size - os.stat(fpath).st_size
+    if num > 0:
+        logger.info("compacted {num} cached days in {d}, saving {saved} bytes".format(num=num, d=cache_dir, saved=saved))
+    if os.path.exists(sqlite_cache_path(cache_dir)):
+        days = SQLiteCache(sqlite_cache_path(cache_dir)).compact(older_than, top=top, now=now)
+        if days > 0:
+            logger.info("compacted {num} days in the SQLite cache".format(num=days))
+        num += days
+    return num
+
+
+def prune_cache(cache_dir, max_age=None, max_bytes=None, max_files=None, now=None, keep=None, bucket_max_age=None):
+    """
+    Delete cache entries from cache_dir to keep it within the given limits:
+    first every cached day that started more than max_age days ago, and
+    every cached bucket that started more than bucket_max_age days ago, then the
+    least recently used files of each PuppetDB host beyond max_files, then
+    the least recently used files until cache_dir holds at most max_bytes.
+    A file's modification time is when it was last used, since reading a
+    cache file touches it. Day cache files (with their checkpoints),
+    backfill checkpoints and event caches are pruned; checkpoints don't
+    count toward max_files. The
+    entries for the ``keep`` timespans (and the event caches of their hosts)
+    count toward max_files and max_bytes but are never deleted for them, so
+    the days just reported on aren't evicted in favour of older ones; a
+    hostname of None keeps the timespan for every host. The
+    SQLite cache, if any, is pruned by SQLiteCache.prune() with the same
+    limits. Temporary and lock files older than CACHE_STALE_SECONDS, left by
+    runs that crashed, are deleted too. Returns the number of files and
+    days deleted.
+
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    :param max_age: max age of a cached day, in days; None for no limit
+    :type max_age: int
+    :param max_bytes: max total size of the cache files, in bytes; None for no limit
+    :type max_bytes: int
+    :param max_files: max number of cache files per host; None for no limit
+    :type max_files: int
+    :param now: current time as seconds since the epoch; default time.time()
+    :type now: float
+    :param keep: (hostname, start, end) tuples of the timespans (days or
+      buckets) used by this run
+    :type keep: list
+    :param bucket_max_age: max age of a cached bucket (a timespan shorter
+      than BUCKET_LENGTH, with its end inclusive), in days; None for max_age
+    :type bucket_max_age: int
+    """
+    if now is None:
+        now = time.time()
+    if not os.path.exists(cache_dir):
+        return 0
+    if keep is None:
+        keep = []
+    kept = set((host, start.strftime('%Y-%m-%d_%H-%M-%S'), end.strftime('%Y-%m-%d_%H-%M-%S')) for host, start, end in keep)
+    kept_hosts = set(host for host, start, end in keep)
+    entries = []
+    stale = []
+    for fname in os.listdir(cache_dir):
+        fpath = os.path.join(cache_dir, fname)
+        if CACHE_STALE_FILE_RE.match(fname):
+            try:
+                if os.stat(fpath).st_mtime < now - CACHE_STALE_SECONDS:
+                    stale.append(fpath)
+            except OSError:
+                pass
+            continue
+        m = DAY_CACHE_FILE_RE.match(fname) or EVENT_CACHE_FILE_RE.match(fname)
+        if m is None:
+            continue
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            # pruned by another run since we listed the dir
+            continue
+        day = None
+        bucket = False
+        if 'start' in m.groupdict():
+            day = calendar.timegm(time.strptime(m.group('start'), '%Y-%m-%d_%H-%M-%S'))
+            bucket = calendar.timegm(time.strptime(m.group('end'), '%Y-%m-%d_%H-%M-%S')) - day < BUCKET_LENGTH.total_seconds()
+            keep_entry = bool(set([(m.group('host'), m.group('start'), m.group('end')),
+                                   (None, m.group('start'), m.group('end'))]) & kept)
+        else:
+            keep_entry = m.group('host') in kept_hosts or None in kept_hosts
+        entries.append({'path': fpath, 'host': m.group('host'), 'day': day, 'size': st.st_size, 'used': st.st_mtime,
+                        'keep': keep_entry, 'partial': fname.endswith('.partial'), 'bucket': bucket})
+    # least recently used first
+    entries.sort(key=lambda e: e['used'])
+    remove = []
+    if max_age:
+        cutoff = now - max_age * 86400
+        remove = [e for e in entries if e['day'] is not None and e['day'] < cutoff]
+        entries = [e for e in entries if e['day'] is None or e['day'] >= cutoff]
+    if bucket_max_age:
+        cutoff = now - bucket_max_age * 86400
+        remove.extend([e for e in entries if e['bucket'] and e['day'] < cutoff])
+        entries = [e for e in entries if not e['bucket'] or e['day'] >= cutoff]
+    if max_files:
+        by_host = defaultdict(list)
+        for e in entries:
+            if not e['partial']:
+                by_host[e['host']].append(e)
+        for host in by_host:
+            excess = len(by_host[host]) - max_files
+            remove.extend([e for e in by_host[host] if not e['keep']][:max(excess, 0)])
+        removed = set(e['path'] for e in remove)
+        entries = [e for e in entries if e['path'] not in removed]
+    if max_bytes:
+        total = sum(e['size'] for e in entries)
+        for e in entries:
+            if total <= max_bytes:
+                break
+            if e['keep']:
+                continue
+            remove.append(e)
+            total -= e['size']
+    for e in remove:
+        logger.debug("pruning cache file {f}".format(f=e['path']))
+        try:
+            os.remove(e['path'])
+        except OSError:
+            pass
+    for fpath in stale:
+        logger.debug("removing stale file {f}".format(f=fpath))
+        try:
+            os.remove(fpath)
+        except OSError:
+            pass
+    if len(remove) > 0:
+        logger.info("pruned {num} cache files ({size} bytes) from {d}".format(
+            num=len(remove), size=sum(e['size'] for e in remove), d=cache_dir))
+    num = len(remove) + len(stale)
+    if os.path.exists(sqlite_cache_path(cache_dir)):
+        days = SQLiteCache(sqlite_cache_path(cache_dir)).prune(max_age=max_age, max_bytes=max_bytes,
+                                                               max_files=max_files, now=now, keep=keep,
+                                                               bucket_max_age=bucket_max_age)
+        if days > 0:
+            logger.info("pruned {num} days from the SQLite cache".format(num=days))
+        num += days
+    return num
+
+
+def backfill_timespans(hostname, pdb, timespans, cache_dir=None, workers=1, cache_backend='files', facts=None):
+    """
+    Query PuppetDB for all of the given timespans that aren't already cached
+    in one pass, with query_data_for_timespans(), and write the result for
+    each to its cache file. If fewer than two timespans need querying, do
+    nothing and leave them to get_data_for_timespan().
+
+    Returns a dict of (start, end) tuple to data, for the timespans queried.
+
+    :param hostname: name of the puppetdb host we're connected to
+    :type hostname: string
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param timespans: list of (start, end) tuples
+    :type timespans: list
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    :param workers: number of nodes to query PuppetDB for concurrently
+    :type workers: int
+    :param cache_backend: 'files' or 'sqlite'; see main()
+    :type cache_backend: string
+    """
+    def find_uncached(timespans):
+        if cache_dir is None:
+            return list(timespans)
+        if cache_backend == 'sqlite':
+            cached = SQLiteCache(sqlite_cache_path(cache_dir)).cached_timespans(hostname, timespans)
+            return [timespan for timespan in timespans if timespan not in cached]
+        return [(start, end) for start, end in timespans if not is_cached(cache_dir, hostname, start, end)]
+
+    uncached = find_uncached(timespans)
+    if len(uncached) < 2:
+        return {}
+    locks = []
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            logger.info("creating dir: {cache_dir}".format(cache_dir=cache_dir))
+            os.makedirs(cache_dir)
+        # leave the days another run is building to get_data_for_timespan(),
+        # which waits for them; and skip any finished since we looked
+        locked = []
+        for start, end in uncached:
+            lock = CacheLock(lock_path(cache_path(cache_dir, hostname, start, end)))
+            if lock.acquire(blocking=False):
+                locks.append(lock)
+                locked.append((start, end))
+            else:
+                logger.info("another process is caching {start} to {end}; not backfilling it".format(
+                    start=start.strftime('%Y-%m-%d_%H-%M-%S'), end=end.strftime('%Y-%m-%d_%H-%M-%S')))
+        uncached = find_uncached(locked)
+    try:
+        if len(uncached) < 2:
+            return {}
+        return backfill_uncached(hostname, pdb, uncached, cache_dir=cache_dir, workers=workers,
+                                 cache_backend=cache_backend, facts=facts)
+    finally:
+        for lock in locks:
+            lock.release()
+
+
+def backfill_uncached(hostname, pdb, uncached, cache_dir=None, workers=1, cache_backend='files', snapshots=True,
+                      facts=None, cache_before=None):
+    """
+    Query and cache the data for the uncached timespans found by
+    backfill_timespans() (which takes the same arguments), holding their
+    CacheLocks. ``snapshots`` is passed to query_data_for_timespans().
+    Timespans ending after ``cache_before``, if given, are returned but not
+    cached. With a cache_dir, each node is recorded in a NodeCheckpoint for
+    the set of timespans as it's finished, so an interrupted backfill
+    resumes with only the nodes that weren't; a node is only resumed if
+    its data for the timespans to be cached was recorded at least
+    BUCKET_CACHE_GRACE after they ended, so nothing that may have been
+    missing reports is cached.
+    """
+    logger.info("backfilling {num} uncached timespans in one pass".format(num=len(uncached)))
+    started = time.time()
+    checkpoint = None
+    if cache_dir is not None:
+        checkpoint = NodeCheckpoint(backfill_checkpoint_path(cache_dir, hostname, uncached))
+        if cache_before is not None:
+            for name, (written, node_data) in list(checkpoint.nodes.items()):
+                written = pytz.utc.localize(datetime.datetime.utcfromtimestamp(written))
+                if any(end <= cache_before and end > written - BUCKET_CACHE_GRACE for start, end in node_data):
+                    del checkpoint.nodes[name]
+    try:
+        results = query_data_for_timespans(pdb, uncached, workers=workers, snapshots=snapshots, facts=facts,
+                                           checkpoint=checkpoint)
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+    # the days are queried together, so each is recorded as an equal share
+    seconds = (time.time() - started) / len(uncached)
+    manifest = getattr(pdb, 'cache_manifest', None)
+    res = {}
+    for (start, end), data in zip(uncached, results):
+        res[(start, end)] = data
+        if cache_before is not None and end > cache_before:
+            logger.debug("not caching timespan {start} to {end}, which may still get reports".format(
+                start=start.strftime('%Y-%m-%d_%H-%M-%S'), end=end.strftime('%Y-%m-%d_%H-%M-%S')))
+            continue
+        if cache_dir is not None:
+            if cache_backend == 'sqlite':
+                SQLiteCache(sqlite_cache_path(cache_dir)).write_day(hostname, start, end, data)
+            else:
+                write_cache(cache_path(cache_dir, hostname, start, end), data)
+            if manifest is not None:
+                manifest.record_build(hostname, start, end, cache_backend, seconds)
+    if checkpoint is not None:
+        checkpoint.remove()
+    return res
+
+
+def get_buckets(start, end):
+    """
+    Return the list of (start, end) tuples of the BUCKET_LENGTH buckets that
+    make up a window, each ending one second before the next starts, as
+    the days reported on do. Raises ValueError if the window doesn't start
+    and end on bucket boundaries.
+
+    :param start: beginning of the window
+    :type start: Datetime
+    :param end: end of the window (inclusive)
+    :type end: Datetime
+    """
+    length = int(BUCKET_LENGTH.total_seconds())
+    second = datetime.timedelta(seconds=1)
+    if calendar.timegm(start.utctimetuple()) % length != 0 or calendar.timegm((end + second).utctimetuple()) % length != 0:
+        raise ValueError("window {start} to {end} doesn't start and end on the hour (UTC)".format(
+            start=start.strftime('%Y-%m-%d %H:%M:%S%z'), end=end.strftime('%Y-%m-%d %H:%M:%S%z')))
+    buckets = []
+    while start < end:
+        buckets.append((start, start + BUCKET_LENGTH - second))
+        start = start + BUCKET_LENGTH
+    return buckets
+
+
+def merge_buckets(buckets):
+    """
+    Merge the data for the buckets making up a window into the per-node data
+    for the window: for each node, report counts and run times are summed,
+    the longest run kept, and resource tallies summed. Nodes missing from a
+    bucket had no runs in it. Returns a dict with only 'nodes'.
+
+    :param buckets: the data for each bucket
+    :type buckets: list of dicts
+    """
+    nodes = {}
+    for data in buckets:
+        for name, node in data['nodes'].items():
+            if name not in nodes:
+                nodes[name] = start_node_data([])[0]
+            merged = nodes[name]
+            for key, value in node.get('reports', {}).items():
+                if key == 'run_time_max':
+                    merged['reports'][key] = max(merged['reports'][key], value)
+                else:
+                    merged['reports'][key] = merged['reports'][key] + value
+            for key, counts in node.get('resources', {}).items():
+                for tup, num in counts.items():
+                    merged['resources'][key][tup] += num
+    for name in nodes:
+        finish_node_data(nodes[name], {})
+    return {'nodes': nodes}
+
+
+def read_buckets(cache_dir, hostname, buckets, cache_backend='files', manifest=None):
+    """
+    Return a dict of (start, end) tuple to data for each of the given
+    buckets that's cached, recording each as a hit in the manifest, if any.
+
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    :param hostname: name of the puppetdb host we're connected to
+    :type hostname: string
+    :param buckets: list of (start, end) tuples
+    :type buckets: list
+    :param cache_backend: 'files' or 'sqlite'; see main()
+    :type cache_backend: string
+    :param manifest: the run's CacheManifest
+    :type manifest: CacheManifest
+    """
+    if cache_backend == 'sqlite':
+        res = SQLiteCache(sqlite_cache_path(cache_dir)).read_days(hostname, buckets)
+    else:
+        res = {}
+        for start, end in buckets:
+            data = read_cached_timespan(cache_dir, hostname, start, end)
+            if data is not None:
+                res[(start, end)] = data
+    if manifest is not None:
+        for start, end in res:
+            manifest.record_hit(hostname, start, end, cache_backend)
+    return res
+
+
+def get_data_for_windows(hostname, pdb, windows, cache_dir=None, workers=1, cache_backend='files', facts=None):
+    """
+    Get the data for each of a list of windows by merging the data for the
+    BUCKET_LENGTH buckets that make them up, so that any window on bucket
+    boundaries (a rolling 24 hours, or days in another timezone) can be
+    built from what's cached. Buckets are read from the cache if possible;
+    the rest are queried from PuppetDB (up to BUCKETS_PER_QUERY at a time,
+    in one pass) and cached, holding their CacheLocks (taken in order, so
+    concurrent runs can't deadlock), except for those ending within
+    BUCKET_CACHE_GRACE of now. The most recent window also gets a snapshot
+    of the dashboard metrics and facts, as the most recent day does.
+
+    Returns a list of data dicts, one per window in the order given.
+
+    :param hostname: name of the puppetdb host we're connected to
+    :type hostname: string
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param windows: list of (start, end) tuples, on bucket boundaries
+    :type windows: list
+    :param cache_dir: absolute path to where to cache data from PuppetDB
+    :type cache_dir: string
+    :param workers: number of nodes to query PuppetDB for concurrently
+    :type workers: int
+    :param cache_backend: 'files' or 'sqlite'; see main()
+    :type cache_backend: string
+    :param facts: names of the facts to snapshot; default FACTS
+    :type facts: list
+    """
+    window_buckets = [get_buckets(start, end) for start, end in windows]
+    buckets = sorted(set(bucket for wb in window_buckets for bucket in wb))
+    data = {}
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            logger.info("creating dir: {cache_dir}".format(cache_dir=cache_dir))
+            os.makedirs(cache_dir)
+        data = read_buckets(cache_dir, hostname, buckets, cache_backend, manifest=getattr(pdb, 'cache_manifest', None))
+    missing = [bucket for bucket in buckets if bucket not in data]
+    logger.info("{num} of {total} buckets cached".format(num=len(buckets) - len(missing), total=len(buckets)))
+    cache_before = pytz.utc.localize(datetime.datetime.utcnow()) - BUCKET_CACHE_GRACE
+    for idx in range(0, len(missing), BUCKETS_PER_QUERY):
+        chunk = missing[idx:idx + BUCKETS_PER_QUERY]
+        locks = []
+        try:
+            if cache_dir is not None:
+                for start, end in chunk:
+                    lock = CacheLock(lock_path(cache_path(cache_dir, hostname, start, end)))
+                    lock.acquire()
+                    locks.append(lock)
+                # other runs may have cached some while we waited
+                data.update(read_buckets(cache_dir, hostname, chunk, cache_backend,
+                                         manifest=getattr(pdb, 'cache_manifest', None)))
+                chunk = [bucket for bucket in chunk if bucket not in data]
+            if len(chunk) > 0:
+                data.update(backfill_uncached(hostname, pdb, chunk, cache_dir=cache_dir, workers=workers,
+                                              cache_backend=cache_backend, snapshots=False, cache_before=cache_before))
+        finally:
+            for lock in locks:
+                lock.release()
+    res = []
+    for wb in window_buckets:
+        res.append(merge_buckets([data[bucket] for bucket in wb]))
+    newest = max(range(len(windows)), key=lambda i: windows[i][1])
+    res[newest]['metrics'] = get_dashboard_metrics(pdb)
+    res[newest]['facts'] = get_facts(pdb, facts)
+    for window_data in res:
+        window_data['aggregate'] = aggregate_data_for_timespan(window_data)
+    return res
+
+
+def get_async_backend():
+    """
+    Import and return the async_backend module, which needs aiohttp and
+    Python 3.5+; exit with an error if it can't be imported.
+    """
+    try:
+        from . import async_backend
+    except (ImportError, SyntaxError):
+        raise SystemExit("ERROR: --backend async requires Python 3.5+ and the aiohttp package")
+    return async_backend
+
+
+def query_data_for_timespan(pdb, start, end, workers=1, engine='events', checkpoint=None, facts=None):
+    """
+    Retrieve all desired data for one day, from PuppetDB
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param start: beginning of time period to get data for
+    :type start: Datetime
+    :param end: end of time period to get data for
+    :type end: Datetime
+    :param workers: number of nodes to query PuppetDB for concurrently
+    :type workers: int
+    :param engine: 'events' to download and tally every event,
+      'event-counts' to build the same data from event-counts summaries, or
+      'counters' for only the per-node report counters, without resource
+      tallies (so the resource tables will be empty)
+    :type engine: string
+    :param checkpoint: optional checkpoint to record each node's data in as
+      it's finished; nodes already in it aren't queried again
+    :type checkpoint: NodeCheckpoint
+    :param facts: names of the facts to snapshot; default FACTS
+    :type facts: list
+    """
+    logger.info("querying data for timespan: {start} to {end}".format(start=start.strftime('%Y-%m-%d_%H-%M-%S'),
+                                                                      end=end.strftime('%Y-%m-%d_%H-%M-%S'),
+                                                                      ))
+    res = {}
+
+    # if we're getting for yesterday, also snapshot dashboard metrics
+    if is_yesterday(end):
+        logger.debug("requested yesterday, getting dashboard metrics")
+        res['metrics'] = get_dashboard_metrics(pdb)
+        res['facts'] = get_facts(pdb, facts)
+
+    logger.debug("querying nodes")
+    nodes = pdb.nodes()
+    done = {}
+    if checkpoint is not None and len(checkpoint.nodes) > 0:
+        nodes = list(nodes)
+        done = dict((node.name, checkpoint.nodes[node.name]) for node in nodes if node.name in checkpoint.nodes)
+        nodes = [node for node in nodes if node.name not in done]
+        logger.info("resuming from checkpoint: {done} nodes done, {num} to query".format(done=len(done), num=len(nodes)))
+    if engine in ['event-counts', 'counters']:
+        func = partial(query_nodes_event_counts, pdb, start=start, end=end, workers=workers,
+                       resources=(engine == 'event-counts'))
+        if checkpoint is None:
+            res['nodes'] = func(nodes)
+        else:
+            res['nodes'] = query_nodes_checkpointed(func, list(nodes), checkpoint)
+    else:
+        with_events = get_nodes_with_events(pdb, start, end)
+        if workers > 1:
+            res['nodes'] = query_nodes_parallel(partial(query_nodes, pdb, start=start, end=end, checkpoint=checkpoint,
+                                                        with_events=with_events),
+                                                list(nodes), workers)
+        else:
+            res['nodes'] = query_nodes(pdb, nodes, start, end, checkpoint=checkpoint, with_events=with_events)
+        log_skipped_events(dict((name, res['nodes'][name].get('reports', {}).get('run_count', 0)) for name in res['nodes']),
+                           with_events)
+    res['nodes'].update(done)
+
+    logger.debug("got {num} nodes".format(num=len(res['nodes'])))
+
+    logger.debug("aggregating data")
+    res['aggregate'] = aggregate_data_for_timespan(res)
+
+    return res
+
+
+def query_data_for_timespans(pdb, timespans, workers=1, snapshots=True, facts=None, checkpoint=None):
+    """
+    Retrieve all desired data for several (non-overlapping) timespans from
+    PuppetDB in a single pass: each node's reports and events are fetched
+    once for the whole range covered by the timespans, and each report is
+    put into its timespan by binary search over the timespan start times.
+
+    Returns a list of data dicts, one per timespan in the order given, each
+    the same as query_data_for_timespan() would return for that timespan.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param timespans: list of (start, end) tuples
+    :type timespans: list
+    :param workers: number of nodes to query PuppetDB for concurrently
+    :type workers: int
+    :param snapshots: whether to snapshot the dashboard metrics and facts
+      for a timespan that's the most recent day
+    :type snapshots: boolean
+    :param facts: names of the facts to snapshot; default FACTS
+    :type facts: list
+    :param checkpoint: optional checkpoint to record each node's data in as
+      it's finished (see query_nodes_for_timespans()); nodes already in it
+      for all of the timespans aren't queried again
+    :type checkpoint: NodeCheckpoint
+    """
+    ordered = sorted(timespans)
+    logger.info("querying data for {num} timespans: {start} to {end}".format(num=len(ordered),
+                                                                             start=ordered[0][0].strftime('%Y-%m-%d_%H-%M-%S'),
+                                                                             end=ordered[-1][1].strftime('%Y-%m-%d_%H-%M-%S'),
+                                                                             ))
+    results = dict((timespan, {}) for timespan in ordered)
+
+    for start, end in ordered:
+        if snapshots and is_yesterday(end):
+            logger.debug("requested yesterday, getting dashboard metrics")
+            results[(start, end)]['metrics'] = get_dashboard_metrics(pdb)
+            results[(start, end)]['facts'] = get_facts(pdb, facts)
+
+    logger.debug("querying nodes")
+    nodes = pdb.nodes()
+    done = {}
+    if checkpoint is not None and len(checkpoint.nodes) > 0:
+        nodes = list(nodes)
+        for node in nodes:
+            if node.name in checkpoint.nodes and all(timespan in checkpoint.nodes[node.name][1] for timespan in ordered):
+                done[node.name] = [checkpoint.nodes[node.name][1][timespan] for timespan in ordered]
+        nodes = [node for node in nodes if node.name not in done]
+        logger.info("resuming from checkpoint: {done} nodes done, {num} to query".format(done=len(done), num=len(nodes)))
+    with_events = get_nodes_with_events(pdb, ordered[0][0], ordered[-1][1])
+    if workers > 1:
+        node_data = query_nodes_parallel(partial(query_nodes_for_timespans, pdb, timespans=ordered, with_events=with_events,
+                                                 checkpoint=checkpoint),
+                                         list(nodes), workers)
+    else:
+        node_data = query_nodes_for_timespans(pdb, nodes, ordered, with_events=with_events, checkpoint=checkpoint)
+    log_skipped_events(dict((name, sum(data['reports']['run_count'] for data in node_data[name])) for name in node_data),
+                       with_events)
+    node_data.update(done)
+    logger.debug("got {num} nodes".format(num=len(node_data)))
+
+    for idx, timespan in enumerate(ordered):
+        results[timespan]['nodes'] = {}
+        for name in node_data:
+            results[timespan]['nodes'][name] = node_data[name][idx]
+        results[timespan]['aggregate'] = aggregate_data_for_timespan(results[timespan])
+    return [results[timespan] for timespan in timespans]
+
+
+def query_nodes_for_timespans(pdb, nodes, timespans, with_events=None, checkpoint=None):
+    """
+    For each of a list of nodes, get the node's reports and events for the
+    whole range covered by a sorted list of timespans and split them up by
+    timespan. Returns a dict of node name to a list of the node's data for
+    each timespan, in the same order as ``timespans``. Each node finished is
+    recorded in the checkpoint, if any, as a tuple of the time it was
+    finished (seconds since the epoch) and a dict of (start, end) tuple to
+    the node's data for that timespan.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param nodes: the nodes to query for
+    :type nodes: list of pypuppetdb.types.Node
+    :param timespans: list of (start, end) tuples, sorted by start
+    :type timespans: list
+    :param with_events: optional names of the only nodes that had any
+      events in the whole range, from get_nodes_with_events()
+    :type with_events: set
+    :param checkpoint: optional checkpoint to record each node's data in
+    :type checkpoint: NodeCheckpoint
+    """
+    starts = [start for start, end in timespans]
+    res = {}
+    for node in nodes:
+        logger.debug("working node {node}".format(node=node.name))
+        reports = [[] for timespan in timespans]
+        buckets = {}
+        for rep in get_reports_for_node(pdb, node, timespans[0][0], timespans[-1][1]):
+            idx = bisect_right(starts, rep.start) - 1
+            if idx < 0 or rep.start > timespans[idx][1]:
+                # in a gap between timespans
+                continue
+            reports[idx].append(rep)
+            buckets[rep.hash_] = idx
+        data = [start_node_data(reports[idx]) for idx in range(len(timespans))]
+        hashes = hashes_needing_events([rep for bucket in reports for rep in bucket],
+                                       has_events=(with_events is None or node.name in with_events),
+                                       until=timespans[-1][1] + EVENTS_TIMESTAMP_GRACE)
+        for e in get_events_for_reports_cached(pdb, hashes):
+            if e.hash_ in buckets:
+                count_event(data[buckets[e.hash_]][0], data[buckets[e.hash_]][1], e)
+        res[node.name] = [finish_node_data(node_res, counts) for node_res, counts in data]
+        if checkpoint is not None:
+            checkpoint.add(node.name, (time.time(), dict(zip(timespans, res[node.name]))))
+    return res
+
+
+def is_yesterday(end):
+    """
+    Return True if a time period ending at ``end`` is the most recent day,
+    for which we also snapshot dashboard metrics and facts.
+
+    :param end: end of time period
+    :type end: Datetime
+    """
+    return end >= pytz.utc.localize(datetime.datetime.now()) - datetime.timedelta(days=1)
+
+
+def query_nodes(pdb, nodes, start, end, checkpoint=None, with_events=None):
+    """
+    Run query_data_for_node() for each of a list of nodes, and return a dict
+    of node name to its data.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param nodes: the nodes to query for
+    :type nodes: list of pypuppetdb.types.Node
+    :param start: beginning of time period to get data for
+    :type start: Datetime
+    :param end: end of time period to get data for
+    :type end: Datetime
+    :param checkpoint: optional checkpoint to record each node's data in
+    :type checkpoint: NodeCheckpoint
+    :param with_events: optional names of the only nodes that had any
+      events in the time period, from get_nodes_with_events()
+    :type with_events: set
+    """
+    res = {}
+    for node in nodes:
+        logger.debug("working node {node}".format(node=node.name))
+        res[node.name] = query_data_for_node(pdb, node, start, end,
+                                             has_events=(with_events is None or node.name in with_events))
+        if checkpoint is not None:
+            checkpoint.add(node.name, res[node.name])
+    return res
+
+
+def query_nodes_checkpointed(func, nodes, checkpoint):
+    """
+    Call ``func`` on successive chunks of CHECKPOINT_CHUNK_SIZE nodes,
+    recording each chunk's nodes in the checkpoint once it's done, and return
+    the merged results. For functions like query_nodes_event_counts() that
+    only finish nodes a whole list at a time.
+
+    :param func: function taking a list of nodes and returning a dict keyed
+      by node name
+    :type func: callable
+    :param nodes: the nodes to query for
+    :type nodes: list of pypuppetdb.types.Node
+    :param checkpoint: checkpoint to record each node's data in
+    :type checkpoint: NodeCheckpoint
+    """
+    res = {}
+    for i in range(0, len(nodes), CHECKPOINT_CHUNK_SIZE):
+        chunk_res = func(nodes[i:i + CHECKPOINT_CHUNK_SIZE])
+        for name in chunk_res:
+            checkpoint.add(name, chunk_res[name])
+        res.update(chunk_res)
+    return res
+
+
+def query_nodes_parallel(func, nodes, workers):
+    """
+    Split a list of nodes into chunks and call ``func`` on each chunk on a
+    pool of worker threads. ``func`` takes a list of nodes and returns a dict
+    keyed by node name (i.e. query_nodes() with the other arguments bound).
+    Each chunk builds its own partial result; the partials are merged in
+    node list order, so the result is the same as calling ``func`` on the
+    whole list.
+
+    :param func: function to call on each chunk of nodes
+    :type func: callable
+    :param nodes: the nodes to query for
+    :type nodes: list of pypuppetdb.types.Node
+    :param workers: number of worker threads
+    :type workers: int
+    """
+    chunk_size = max(1, int(ceil(len(nodes) / float(workers * NODE_CHUNKS_PER_WORKER))))
+    chunks = [nodes[i:i + chunk_size] for i in range(0, len(nodes), chunk_size)]
+    logger.debug("querying {num} nodes in {chunks} chunks on {workers} workers".format(num=len(nodes),
+                                                                                       chunks=len(chunks),
+                                                                                       workers=workers))
+    pool = ThreadPool(workers)
+    try:
+        partials = pool.map(func, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    res = {}
+    for partial_res in partials:
+        res.update(partial_res)
+    return res
+
+
+def query_nodes_event_counts(pdb, nodes, start, end, workers=1, resources=True):
+    """
+    Get the data for each node in the given time period, like query_nodes(),
+    but without downloading any events: each node's resource tallies come
+    from one event-counts query summarized by resource, and the per-report
+    failure/change/skip flags from the reports' own metrics where PuppetDB
+    includes them, or else from event-counts queries summarized by certname,
+    batched across nodes. Returns a dict of node name to data.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param nodes: the nodes to query for
+    :type nodes: iterable of pypuppetdb.types.Node
+    :param start: beginning of time period to get data for
+    :type start: Datetime
+    :param end: end of time period to get data for
+    :type end: Datetime
+    :param workers: number of nodes to query PuppetDB for concurrently
+    :type workers: int
+    :param resources: whether to get the resource tallies; if False, only
+      the report counters are filled in, and the resources left empty
+    :type resources: boolean
+    """
+    func = partial(query_resource_counts_for_nodes, pdb, start=start, end=end, resources=resources)
+    if workers > 1:
+        per_node = query_nodes_parallel(func, list(nodes), workers)
+    else:
+        per_node = func(nodes)
+    # only reports without embedded metrics need their events counted
+    unknown = dict((name, [rep.hash_ for rep in per_node[name][0] if report_event_counts(rep) is None]) for name in per_node)
+    if not resources and any(unknown.values()):
+        warn_counters_fallback(pdb)
+    report_counts = get_report_event_counts(pdb, unknown)
+    res = {}
+    for name in per_node:
+        reports, node_resources = per_node[name]
+        node_res, counts = start_node_data(reports)
+        for rep in reports:
+            if report_event_counts(rep) is not None:
+                counts[rep.hash_] = report_event_counts(rep)
+            elif rep.hash_ in report_counts:
+                counts[rep.hash_] = report_counts[rep.hash_]
+        for key in node_resources:
+            node_res['resources'][key].update(node_resources[key])
+        res[name] = finish_node_data(node_res, counts)
+    return res
+
+
+def warn_counters_fallback(pdb):
+    """
+    Warn (once per client) that the counters engine is querying
+    event-counts for reports' failure/change/skip flags, because PuppetDB
+    didn't include their metrics; the v3 reports API never does.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    """
+    if getattr(pdb, 'counters_fallback_warned', False):
+        return
+    pdb.counters_fallback_warned = True
+    logger.warning("PuppetDB reports don't include metrics (the v3 API never does); the counters engine is "
+                   "querying event-counts for each report's failure/change/skip flags instead")
+
+
+def report_event_counts(rep):
+    """
+    Return the event counts by status of a report, from its metrics, or None
+    if they're not known (i.e. for pypuppetdb Report objects).
+
+    :param rep: the report
+    :type rep: ReportSummary or pypuppetdb.types.Report
+    """
+    return getattr(rep, 'event_counts', None)
+
+
+def query_resource_counts_for_nodes(pdb, nodes, start, end, resources=True):
+    """
+    For each node, get its reports and (unless ``resources`` is False)
+    resource tallies in the given time period; returns a dict of node name
+    to a (reports, resources) tuple.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param nodes: the nodes to query for
+    :type nodes: iterable of pypuppetdb.types.Node
+    :param start: beginning of time period to get data for
+    :type start: Datetime
+    :param end: end of time period to get data for
+    :type end: Datetime
+    :param resources: whether to get the resource tallies
+    :type resources: boolean
+    """
+    res = {}
+    for node in nodes:
+        logger.debug("working node {node}".format(node=node.name))
+        reports = get_reports_for_node(pdb, node, start, end)
+        if resources and len(reports) > 0:
+            node_resources = get_resource_counts_for_node(pdb, node.name, start, end)
+        else:
+            node_resources = {'failed': {}, 'changed': {}, 'skipped': {}}
+        res[node.name] = (reports, node_resources)
+    return res
+
+
+def get_resource_counts_for_node(pdb, certname, start, end):
+    """
+    Return the failed, changed and skipped resource tallies for the reports
+    of one node that started in the given time period, in the same form as
+    the 'resources' of node_data_from_reports(), from a single event-counts
+    query summarized by resource.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param certname: the name of the node to query for
+    :type certname: string
+    :param start: beginning of time period to get data for
+    :type start: Datetime
+    :param end: end of time period to get data for
+    :type end: Datetime
+    """
+    query_s = json.dumps(["and",
+                          ["=", "certname", certname],
+                          [">=", "run-start-time", datetime_to_json(start)],
+                          ["<=", "run-start-time", datetime_to_json(end)],
+                          ])
+    res = {'failed': {}, 'changed': {}, 'skipped': {}}
+    for row in pdb.event_counts(query_s, summarize_by='resource'):
+        tup = (row['subject']['type'], row['subject']['title'])
+        for field, status in EVENT_COUNTS_STATUSES.items():
+            if row[field] > 0:
+                res[EVENT_STATUS_KEYS[status]][tup] = row[field]
+    return res
+
+
+def get_report_event_counts(pdb, hashes_by_node):
+    """
+    Return a dict of report hash to counts of the report's events by status
+    ('skipped', 'success' and 'failure'), for reports with any events.
+
+    event-counts can't be summarized by report, but every report belongs to
+    exactly one node; so the reports are batched with at most one report
+    per node, and each batch is summarized by certname.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param hashes_by_node: dict of node name to a list of its report hashes
+    :type hashes_by_node: dict
+    """
+    res = {}
+    depth = max([len(hashes) for hashes in hashes_by_node.values()] + [0])
+    for idx in range(depth):
+        # node name to its idx'th report
+        batch = dict((name, hashes[idx]) for name, hashes in hashes_by_node.items() if len(hashes) > idx)
+        for query_s in get_events_queries(sorted(batch.values())):
+            for row in pdb.event_counts(query_s, summarize_by='certname'):
+                counts = dict((status, row[field]) for field, status in EVENT_COUNTS_STATUSES.items())
+                res[batch[row['subject']['title']]] = counts
+    return res
+
+
+def aggregate_data_for_timespan(data):
+    """
+    Calculate aggregate values for all data in a given timespan
+
+    :param data: dict of result data from query_data_for_timespan()
+    :type data: dict
+    """
+    res = {}
+    res['reports'] = {'run_count': 0,
+                      'run_time_total': datetime.timedelta(),
+                      'run_time_max': datetime.timedelta(),
+                      'run_time_avg': datetime.timedelta(),
+                      'with_failures': 0,
+                      'with_changes': 0,
+                      'with_skips': 0,
+                      'resources': {'failed': defaultdict(int), 'changed': defaultdict(int), 'skipped': defaultdict(int)},
+                      }
+    res['nodes'] = {'with_failures': 0,
+                    'with_changes': 0,
+                    'with_skips': 0,
+                    'with_no_report': 0,
+                    'with_no_successful_runs': 0,
+                    'with_50+%_failed': 0,
+                    'with_too_few_runs': 0,
+                    'resources': {'failed': defaultdict(int), 'changed': defaultdict(int), 'skipped': defaultdict(int), 'flapping': defaultdict(int)},
+                    }
+
+    for node in data['nodes']:
+        if 'reports' not in data['nodes'][node]:
+            res['nodes']['with_no_report'] += 1
+            res['nodes']['with_no_successful_runs'] += 1
+            continue
+        if 'run_count' not in data['nodes'][node]['reports']:
+            res['nodes']['with_no_report'] += 1
+            res['nodes']['with_no_successful_runs'] += 1
+            continue
+
+        failpct = 0
+        if data['nodes'][node]['reports']['run_count'] > 0:
+            failpct = float(data['nodes'][node]['reports']['with_failures']) / float(data['nodes'][node]['reports']['run_count'])
+
+        if data['nodes'][node]['reports']['run_count'] < RUNS_PER_DAY:
+            res['nodes']['with_too_few_runs'] += 1
+
+        if data['nodes'][node]['reports']['run_count'] == 0:
+            res['nodes']['with_no_report'] += 1
+            res['nodes']['with_no_successful_runs'] += 1
+        elif data['nodes'][node]['reports']['with_failures'] == data['nodes'][node]['reports']['run_count']:
+            res['nodes']['with_no_successful_runs'] += 1
+        elif failpct >= 0.5 and failpct < 1.0:
+            res['nodes']['with_50+%_failed'] += 1
+
+        for key in ['run_count', 'with_failures', 'with_changes', 'with_skips']:
+            if key in data['nodes'][node]['reports']:
+                res['reports'][key] += data['nodes'][node]['reports'][key]
+            if key in data['nodes'][node]['reports'] and key in res['nodes'] and data['nodes'][node]['reports'][key] > 0:
+                res['nodes'][key] += 1
+
+        if 'run_time_total' in data['nodes'][node]['reports']:
+            res['reports']['run_time_total'] = res['reports']['run_time_total'] + data['nodes'][node]['reports']['run_time_total']
+        if 'run_time_max' in data['nodes'][node]['reports'] and data['nodes'][node]['reports']['run_time_max'] > res['reports']['run_time_max']:
+            res['reports']['run_time_max'] = data['nodes'][node]['reports']['run_time_max']
+
+        # resource counts across all nodes
+        if 'resources' in data['nodes'][node]:
+            for key in ['failed', 'changed', 'skipped']:
+                if key in data['nodes'][node]['resources']:
+                    for tup in data['nodes'][node]['resources'][key]:
+                        res['nodes']['resources'][key][tup] += 1
+                        res['reports']['resources'][key][tup] += data['nodes'][node]['resources'][key][tup]
+                        # flapping resources, count of nodes
+                        if key == 'changed' and (float(data['nodes'][node]['resources'][key][tup]) >= (data['nodes'][node]['reports']['run_count'] * 0.45)):
+                            res['nodes']['resources']['flapping'][tup] += 1
+
+    # flatten defaultdicts for serialization
+    for key in res['nodes']['resources']:
+        res['nodes']['resources'][key] = dict(res['nodes']['resources'][key])
+    for key in res['reports']['resources']:
+        res['reports']['resources'][key] = dict(res['reports']['resources'][key])
+
+    if res['reports']['run_count'] != 0:
+        res['reports']['run_time_avg'] = res['reports']['run_time_total'] / res['reports']['run_count']
+    logger.debug("aggregation done, returning result")
+    return res
+
+
+def get_facts(pdb, facts=None):
+    """
+    return a dict of the values of the given facts and the counts of each value
+
+    All of the facts are fetched in a single facts query, and the values
+    counted as the response is streamed.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param facts: names of the facts; default FACTS
+    :type facts: list
+    """
+    logger.debug("querying facts")
+    if facts is None:
+        facts = FACTS
+    res = {}
+    for fact in facts:
+        res[fact] = {}
+    for row in query_rows(pdb, 'facts', query=facts_query(facts)):
+        if row['name'] not in res:
+            continue
+        if row['value'] not in res[row['name']]:
+            res[row['name']][row['value']] = 0
+        res[row['name']][row['value']] += 1
+    logger.debug("done with facts")
+    return res
+
+
+def facts_query(facts):
+    """
+    Return the query string for a facts query matching all of the named facts.
+
+    :param facts: list of fact names
+    :type facts: list
+    """
+    clauses = [["=", "name", fact] for fact in facts]
+    if len(clauses) == 1:
+        return json.dumps(clauses[0])
+    return json.dumps(["or"] + clauses)
+
+
+def query_data_for_node(pdb, node, start, end, has_events=True):
+    """
+    Retrieve all desired data for a given node in a given time period
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param node: the node to query for
+    :type node: pypuppetdb.types.Node
+    :param start: beginning of time period to get data for
+    :type start: Datetime
+    :param end: end of time period to get data for
+    :type end: Datetime
+    :param has_events: whether the node may have any events in the time
+      period (see get_nodes_with_events()); if not, only reports still
+      running after it are queried for events
+    :type has_events: boolean
+    """
+    logger.debug("querying node {name} for timespan: {start} to {end}".format(start=start.strftime('%Y-%m-%d %H-%M-%S%z'),
+                                                                              end=end.strftime('%Y-%m-%d %H-%M-%S%z'),
+                                                                              name=node.name,
+                                                                              ))
+    reports = get_reports_for_node(pdb, node, start, end)
+    events = get_events_for_reports_cached(pdb, hashes_needing_events(reports, has_events=has_events,
+                                                                      until=end + EVENTS_TIMESTAMP_GRACE))
+    res = node_data_from_reports(reports, events)
+
+    logger.debug("got {num} reports for node".format(num=res['reports']['run_count']))
+
+    return res
+
+
+def get_nodes_with_events(pdb, start, end):
+    """
+    Return the set of names of the nodes that had any failed, changed or
+    skipped events from ``start`` until EVENTS_TIMESTAMP_GRACE after
+    ``end``, from a single event-counts query summarized by certname. The
+    reports of any other node that started (and finished) in that time
+    have no events to query. v3 reports don't say whether they have any
+    events, but event-counts can be filtered by event timestamp.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param start: beginning of time period
+    :type start: Datetime
+    :param end: end of time period
+    :type end: Datetime
+    """
+    res = nodes_with_events(pdb.event_counts(nodes_with_events_query(start, end), summarize_by='certname'))
+    logger.debug("{num} nodes had events".format(num=len(res)))
+    return res
+
+
+def nodes_with_events_query(start, end):
+    """
+    Return the event-counts query string used by get_nodes_with_events()
+
+    :param start: beginning of time period
+    :type start: Datetime
+    :param end: end of time period
+    :type end: Datetime
+    """
+    return json.dumps(["and",
+                       [">=", "timestamp", datetime_to_json(start)],
+                       ["<=", "timestamp", datetime_to_json(end + EVENTS_TIMESTAMP_GRACE)],
+                       ])
+
+
+def nodes_with_events(rows):
+    """
+    Return the set of node names with any failed, changed or skipped events
+    in an event-counts response summarized by certname.
+
+    :param rows: the decoded event-counts response
+    :type rows: list of dicts
+    """
+    return set(row['subject']['title'] for row in rows if any(row[field] > 0 for field in EVENT_COUNTS_STATUSES))
+
+
+def log_skipped_events(run_counts, with_events):
+    """
+    Log how many nodes' and reports' events queries were skipped because
+    get_nodes_with_events() showed the nodes had no events.
+
+    :param run_counts: dict of node name to its number of reports
+    :type run_counts: dict
+    :param with_events: names of the nodes that had events
+    :type with_events: set
+    """
+    quiet = [name for name in run_counts if name not in with_events and run_counts[name] > 0]
+    logger.info("skipped events queries for {reports} reports of {num} of {total} nodes, which had no "
+                "events".format(reports=sum(run_counts[name] for name in quiet), num=len(quiet),
+                                total=len(run_counts)))
+
+
+def hashes_needing_events(reports, has_events=True, until=None):
+    """
+    Return the hashes of the reports that we need to get events for: all of
+    them, unless the node is known to have had no failed, changed or
+    skipped events until ``until`` (see get_nodes_with_events()); then only
+    those of its reports that were still running at ``until``.
+
+    :param reports: the reports
+    :type reports: list of ReportSummary (or pypuppetdb.types.Report)
+    :param has_events: whether the node may have any events
+    :type has_events: boolean
+    :param until: end of the time get_nodes_with_events() covered
+    :type until: Datetime
+    """
+    if has_events:
+        return [rep.hash_ for rep in reports]
+    hashes = [rep.hash_ for rep in reports if rep.start + rep.run_time > until]
+    if len(hashes) < len(reports):
+        avoided = len(get_events_queries([rep.hash_ for rep in reports])) - len(get_events_queries(hashes))
+        logger.debug("skipping events for {num} of {total} reports with no events; avoided {avoided} events "
+                     "queries".format(num=len(reports) - len(hashes), total=len(reports), avoided=avoided))
+    return hashes
+
+
+def node_data_from_reports(reports, events):
+    """
+    Build the data dict for one node in a time period, from the node's
+    reports in that period and the events belonging to those reports.
+    Events are tallied one at a time as they're iterated, so ``events`` may
+    be a generator streaming them from PuppetDB.
+
+    :param reports: the node's reports in the time period
+    :type reports: list of pypuppetdb.types.Report
+    :param events: the events for those reports, in any order
+    :type events: iterable of EventSummary
+    """
+    res, counts = start_node_data(reports)
+    for e in events:
+        count_event(res, counts, e)
+    return finish_node_data(res, counts)
+
+
+def start_node_data(reports):
+    """
+    Begin the data dict for one node in a time period; returns a tuple of
+    the data dict (with report counters filled in from ``reports``) and a
+    dict of report hash to per-status event counts, to be passed to
+    count_event() and finish_node_data().
+
+    :param reports: the node's reports in the time period
+    :type reports: list of ReportSummary (or pypuppetdb.types.Report)
+    """
+    res = {}
+
+    res['reports'] = {'run_count': 0,
+                      'with_failures': 0,
+                      'with_changes': 0,
+                      'with_skips': 0,
+                      'run_time_total': datetime.timedelta(),
+                      'run_time_max': datetime.timedelta()
+                      }
+    res['resources'] = {'failed': defaultdict(int),
+                        'changed': defaultdict(int),
+                        'skipped': defaultdict(int),
+                        }
+    # per-report counts of events by status
+    counts = {}
+    for rep in reports:
+        res['reports']['run_count'] += 1
+        res['reports']['run_time_total'] = res['reports']['run_time_total'] + rep.run_time
+        if rep.run_time > res['reports']['run_time_max']:
+            res['reports']['run_time_max'] = rep.run_time
+        counts[rep.hash_] = {'skipped': 0, 'success': 0, 'failure': 0}
+    return res, counts
+
+
+def count_event(res, counts, e):
+    """
+    Tally one event into a node data dict begun by start_node_data(). Events
+    for other reports, or with a status we don't report on, are ignored.
+
+    :param res: node data dict from start_node_data()
+    :type res: dict
+    :param counts: per-report event counts from start_node_data()
+    :type counts: dict
+    :param e: the event
+    :type e: EventSummary
+    """
+    if e.hash_ not in counts or e.status not in EVENT_STATUS_KEYS:
+        return
+    counts[e.hash_][e.status] += 1
+    res['resources'][EVENT_STATUS_KEYS[e.status]][(e.type_, e.title)] += 1
+
+
+def finish_node_data(res, counts):
+    """
+    Finish a node data dict begun by start_node_data(), once all of its
+    events have been counted, and return it.
+
+    :param res: node data dict from start_node_data()
+    :type res: dict
+    :param counts: per-report event counts from start_node_data()
+    :type counts: dict
+    """
+    # increment per-node counters for each report
+    for hash_ in counts:
+        if counts[hash_]['skipped'] > 0:
+            res['reports']['with_skips'] += 1
+        if counts[hash_]['success'] > 0:
+            res['reports']['with_changes'] += 1
+        if counts[hash_]['failure'] > 0:
+            res['reports']['with_failures'] += 1
+
+    # flatten defaultdicts for serialization
+    for key in res['resources']:
+        res['resources'][key] = dict(res['resources'][key])
+
+    return res
+
+
+def get_reports_for_node(pdb, node, start, end):
+    """
+    Return a list of the reports for a node that started within the given
+    time period, newest first. Reports are selected server-side with a
+    start-time range query, paged REPORTS_PAGE_SIZE at a time, so only the
+    reports in the time period are transferred. If PuppetDB rejects the
+    range query, fall back to walking the node's full report history.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param node: the node to query for
+    :type node: pypuppetdb.types.Node
+    :param start: beginning of time period to get reports for
+    :type start: Datetime
+    :param end: end of time period to get reports for
+    :type end: Datetime
+    """
+    if getattr(pdb, 'reports_range_query', True):
+        try:
+            return query_reports_for_node(pdb, node.name, start, end)
+        except requests.exceptions.HTTPError:
+            logger.warning("PuppetDB rejected reports start-time range query; falling back to full report history")
+            pdb.reports_range_query = False
+    reports = []
+    for rep in node.reports():
+        if rep.start > end:
+            continue
+        if rep.start < start:
+            # reports are returned sorted desc by completion time of run
+            logger.debug("found first report before time period - start time is {s}".format(s=rep.start))
+            break
+        reports.append(rep)
+    return reports
+
+
+def query_reports_for_node(pdb, certname, start, end):
+    """
+    Query PuppetDB for the reports of one node that started within the given
+    time period, newest first, paging through the results.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param certname: the name of the node to query for
+    :type certname: string
+    :param start: beginning of time period to get reports for
+    :type start: Datetime
+    :param end: end of time period to get reports for
+    :type end: Datetime
+    """
+    query_s = json.dumps(["and",
+                          ["=", "certname", certname],
+                          [">=", "start-time", datetime_to_json(start)],
+                          ["<=", "start-time", datetime_to_json(end)],
+                          ])
+    order_by = json.dumps([{"field": "start-time", "order": "desc"}])
+    reports = []
+    offset = 0
+    while True:
+        num_rows = 0
+        for report in query_rows(pdb, 'reports', query=query_s, order_by=order_by, limit=REPORTS_PAGE_SIZE,
+                                 offset=offset):
+            reports.append(report_from_json(report))
+            num_rows += 1
+        if num_rows < REPORTS_PAGE_SIZE:
+            break
+        offset += REPORTS_PAGE_SIZE
+    return reports
+
+
+def query_rows(pdb, endpoint, **kwargs):
+    """
+    Query a PuppetDB endpoint that returns a JSON array, and return an
+    iterator over its decoded elements. With a PooledAPI the response is
+    streamed and decoded one element at a time, rather than all at once.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param endpoint: the API endpoint to query, i.e. 'reports'
+    :type endpoint: string
+    """
+    if isinstance(pdb, PooledAPI):
+        return pdb.stream_query(endpoint, **kwargs)
+    return iter(pdb._query(endpoint, **kwargs))
+
+
+def report_from_json(r):
+    """
+    Build a ReportSummary from one decoded element of a reports API
+    response; only the start and end times are parsed.
+
+    :param r: the decoded report
+    :type r: dict
+    """
+    start = parse_timestamp(r['start-time'])
+    return ReportSummary(r['hash'], start, parse_timestamp(r['end-time']) - start, event_counts_from_metrics(r))
+
+
+def event_counts_from_metrics(r):
+    """
+    Return a report's event counts by status ('skipped', 'success' and
+    'failure'), from the metrics embedded in the decoded report, or None if
+    it has none. The v3 reports API doesn't include metrics, but newer
+    PuppetDB versions do, either as a list or as ``{"data": [...]}``.
+
+    :param r: the decoded report
+    :type r: dict
+    """
+    metrics = r.get('metrics', None)
+    if isinstance(metrics, dict):
+        metrics = metrics.get('data', None)
+    if not metrics:
+        return None
+    values = {}
+    for m in metrics:
+        values[(m['category'], m['name'])] = m['value']
+    if ('events', 'failure') not in values or ('events', 'success') not in values:
+        return None
+    return {'skipped': values.get(('resources', 'skipped'), 0),
+            'success': values[('events', 'success')],
+            'failure': values[('events', 'failure')],
+            }
+
+
+def event_from_json(e):
+    """
+    Build an EventSummary from one decoded element of an events API response.
+
+    :param e: the decoded event
+    :type e: dict
+    """
+    return EventSummary(e['report'], e['status'], e['resource-type'], e['resource-title'])
+
+
+def parse_timestamp(s):
+    """
+    Return a timezone-aware UTC datetime for a PuppetDB timestamp string, i.e.
+    '2014-06-10T05:00:02.123Z'. The fixed-width fields are sliced out
+    directly, which is much faster than the strptime() used by pypuppetdb;
+    anything not in exactly that format is handed to pypuppetdb instead.
+
+    :param s: the timestamp
+    :type s: string
+    """
+    if len(s) > 20 and s[-1] == 'Z' and s[19] == '.':
+        try:
+            return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                                     int(s[11:13]), int(s[14:16]), int(s[17:19]),
+                                     int(s[20:-1][:6].ljust(6, '0')), tzinfo=pytz.utc)
+        except ValueError:
+            pass
+    return json_to_datetime(s)
+
+
+def iter_json_array(chunks):
+    """
+    Generator that incrementally decodes a JSON array from an iterable of
+    text chunks, yielding each element of the array as soon as it has been
+    read in full. Only the current element and one chunk are held in
+    memory, not the whole array.
+
+    :param chunks: the JSON text, in pieces of any size
+    :type chunks: iterable of strings
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    # pos is an offset into buf; buf is only sliced when a chunk is added,
+    # not for every element decoded from it
+    buf = ''
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        # skip whitespace and separators up to the next value
+        while pos < len(buf) and buf[pos] in ' \t\r\n' + (',' if started else ''):
+            pos += 1
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError("expected a JSON array, got: {s}".format(s=buf[pos:pos + 20]))
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # element is incomplete; read more
+                if eof:
+                    raise
+            else:
+                # a number may only be the start of a longer one (i.e. "-1" of
+                # "-1.5"), so only take a value once we've seen what follows it
+                if eof or (end < len(buf) and buf[end] in ' \t\r\n,]'):
+                    yield obj
+                    pos = end
+                    continue
+        elif eof:
+            raise ValueError("unexpected end of JSON array")
+        try:
+            buf = buf[pos:] + next(chunks)
+            pos = 0
+        except StopIteration:
+            eof = True
+
+
+def datetime_to_json(dt):
+    """
+    Format a datetime the way PuppetDB formats timestamps, in UTC. Naive
+    datetimes are assumed to already be UTC.
+
+    :param dt: the datetime to format
+    :type dt: Datetime
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.utc)
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def get_events_for_reports(pdb, hashes):
+    """
+    Generator yielding an EventSummary for each event of the given report
+    hashes, using as few batched events queries as possible. With a
+    PooledAPI they're built directly from the streamed JSON; otherwise from
+    pypuppetdb's Event objects.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param hashes: list of report hashes to get events for
+    :type hashes: list
+    """
+    for query_s in get_events_queries(hashes):
+        if isinstance(pdb, PooledAPI):
+            for e in pdb.stream_query('events', query=query_s):
+                yield event_from_json(e)
+        else:
+            for e in pdb.events(query_s):
+                yield EventSummary(e.hash_, e.status, e.item['type'], e.item['title'])
+
+
+def get_events_for_reports_cached(pdb, hashes):
+    """
+    Generator yielding the events of the given report hashes like
+    get_events_for_reports(), but from the client's event cache (see
+    PooledAPI), if it has one, for the reports that are in it; only the rest
+    are queried. Queried events are yielded as they're streamed, and each
+    batch of reports is added to the cache once all of its events have been
+    read, so only one batch's events are held at once.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param hashes: list of report hashes to get events for
+    :type hashes: list
+    """
+    event_cache = getattr(pdb, 'event_cache', None)
+    if event_cache is None:
+        for e in get_events_for_reports(pdb, hashes):
+            yield e
+        return
+    events, missing = event_cache.lookup(hashes)
+    if len(missing) < len(hashes):
+        logger.debug("got events for {num} of {total} reports from the event cache".format(
+            num=len(hashes) - len(missing), total=len(hashes)))
+    for e in events:
+        yield e
+    for batch in get_events_batches(missing):
+        # only what the cache keeps
+        kept = []
+        for e in get_events_for_reports(pdb, batch):
+            if e.status in EVENT_STATUS_KEYS:
+                kept.append(e)
+            yield e
+        event_cache.store(batch, kept)
+
+
+def get_events_queries(hashes):
+    """
+    Return a list of events query strings covering all of the given report
+    hashes, one per batch from get_events_batches(). A batch of one report
+    uses a plain "=" query.
+
+    :param hashes: list of report hashes to get events for
+    :type hashes: list
+    """
+    return [events_query_for_batch([["=", "report", hash_] for hash_ in batch])
+            for batch in get_events_batches(hashes)]
+
+
+def get_events_batches(hashes):
+    """
+    Split report hashes into lists to query events for together, batching as
+    many reports as possible into each query while staying under
+    EVENTS_BATCH_SIZE reports and EVENTS_QUERY_MAX_LEN characters per query
+    once URL-encoded.
+
+    :param hashes: list of report hashes to get events for
+    :type hashes: list
+    """
+    batches = []
+    batch = []
+    empty_len = len(urlencode({'query': json.dumps(["or"])}))
+    batch_len = empty_len
+    for hash_ in hashes:
+        clause_len = len(quote_plus(', ' + json.dumps(["=", "report", hash_])))
+        if batch and (len(batch) >= EVENTS_BATCH_SIZE or batch_len + clause_len > EVENTS_QUERY_MAX_LEN):
+            batches.append(batch)
+            batch = []
+            batch_len = empty_len
+        batch.append(hash_)
+        batch_len += clause_len
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def events_query_for_batch(batch):
+    """
+    Return the events query string for a list of ["=", "report", hash] clauses
+
+    :param batch: list of query clauses
+    :type batch: list
+    """
+    if len(batch) == 1:
+        return json.dumps(batch[0])
+    return json.dumps(["or"] + batch)
+
+
+def dashboard_metrics():
+    """
+    return a dict of the metrics displayed on the PuppetDB dashboard, with
+    the MBean path and display order of each; values are not yet filled in
     """
-    logger.debug("getting dashboard metrics...")
     metrics = {}
     metrics['Nodes'] = {'path': 'com.puppetlabs.puppetdb.query.population:type=default,name=num-nodes', 'order': 2, 'formatted': None}
     metrics['Resources'] = {'path': 'com.puppetlabs.puppetdb.query.population:type=default,name=num-resources', 'order': 3, 'formatted': None}
@@ -498,20 +3763,64 @@ def get_dashboard_metrics(pdb):
     metrics['DLO Compression'] = {'path': 'com.puppetlabs.puppetdb.command.dlo:type=global,name=compression', 'order': 16, 'formatted': None}
     metrics['DLO Size on Disk'] = {'path': 'com.puppetlabs.puppetdb.command.dlo:type=global,name=filesize', 'order': 17, 'formatted': None}
     metrics['Discarded Messages'] = {'path': 'com.puppetlabs.puppetdb.command.dlo:type=global,name=messages', 'order': 18, 'formatted': None}
+    return metrics
+
+
+def get_dashboard_metrics(pdb):
+    """
+    return a dict of the metrics displayed on the PuppetDB dashboard
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    """
+    logger.debug("getting dashboard metrics...")
+    metrics = dashboard_metrics()
 
+    # some metrics share an MBean; only read each once
+    values = get_mbeans(pdb, sorted(set(metrics[metric]['path'] for metric in metrics)))
     for metric in metrics:
-        logger.debug("getting metric: %s" % metric)
-        try:
-            metrics[metric]['api_response'] = pdb.metric(metrics[metric]['path'])
-            metrics[metric]['formatted'] = metric_value(metrics[metric]['api_response'])
-            logger.debug("got raw value: %s" % metrics[metric]['formatted'])
-        except requests.exceptions.HTTPError:
+        if metrics[metric]['path'] not in values:
             logger.debug("unable to get value for metric: %s" % metric)
+            continue
+        metrics[metric]['api_response'] = values[metrics[metric]['path']]
+        metrics[metric]['formatted'] = metric_value(metrics[metric]['api_response'])
+        logger.debug("got raw value for %s: %s" % (metric, metrics[metric]['formatted']))
     logger.info("got dashboard metrics")
 
     return metrics
 
 
+def get_mbeans(pdb, paths):
+    """
+    Read a list of MBeans from the metrics API, and return a dict of MBean
+    path to API response; MBeans that couldn't be read are left out. With a
+    PooledAPI they're all read in one bulk request, falling back to one
+    request per MBean if that fails.
+
+    :param pdb: object representing a connected pypuppetdb instance
+    :type pdb: one of the pypuppetdb.API classes
+    :param paths: list of MBean paths (names)
+    :type paths: list
+    """
+    if isinstance(pdb, PooledAPI):
+        try:
+            res = {}
+            for path, value in zip(paths, pdb.metrics(paths)):
+                if isinstance(value, dict):
+                    res[path] = value
+            return res
+        except (requests.exceptions.HTTPError, ValueError):
+            logger.debug("bulk metrics read failed; reading metrics one at a time")
+    res = {}
+    for path in paths:
+        logger.debug("getting metric: %s" % path)
+        try:
+            res[path] = pdb.metric(path)
+        except requests.exceptions.HTTPError:
+            logger.debug("unable to get metric: %s" % path)
+    return res
+
+
 def metric_value(m):
     """
     Takes a dict returned by the metric() API endpoint, returns the formatted value we want to track.
@@ -542,6 +3851,342 @@ def metric_value(m):
     return m
 
 
+class AdaptiveLimiter(object):
+    """
+    Thread-safe limit on the number of PuppetDB requests in flight, adjusted
+    AIMD-style (additive increase, multiplicative decrease) from how PuppetDB
+    responds: the limit grows by about one for every ``limit`` requests that
+    complete promptly, and is cut by ADAPTIVE_BACKOFF on a timeout, connection
+    error or 5xx/429 response, or when an endpoint's smoothed latency rises
+    more than ADAPTIVE_LATENCY_TOLERANCE times above its baseline. Latency
+    is tracked per endpoint, since a page of reports and a batch of events
+    take very different times even when PuppetDB is idle; each baseline is
+    a slow (ADAPTIVE_BASELINE_DECAY) moving average of the smoothed
+    latency, so it isn't pinned by one unusually fast response. While PuppetDB's
+    command queue is deeper than ``command_queue_limit``, the limit is held at
+    ``min_limit``, so the report never competes with command processing.
+    """
+
+    def __init__(self, max_limit, min_limit=1, command_queue_limit=None):
+        """
+        :param max_limit: the most requests ever allowed in flight
+        :type max_limit: int
+        :param min_limit: the fewest requests allowed in flight
+        :type min_limit: int
+        :param command_queue_limit: command queue depth above which to hold
+          the limit at min_limit; None to not watch the command queue
+        :type command_queue_limit: int
+        """
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.command_queue_limit = command_queue_limit
+        self.limit = float(max(self.min_limit, max_limit // 2))
+        self.in_flight = 0
+        # endpoint to its smoothed latency, its baseline latency, and the
+        # number of latencies seen
+        self.latency = {}
+        self.baseline = {}
+        self.samples = {}
+        self.queue_depth = None
+        self.backoffs = 0
+        # completions since the last back-off; we back off at most once per
+        # limit's worth, so one burst of slow responses only counts once
+        self.since_backoff = 0
+        self.cond = threading.Condition()
+
+    def current_limit(self):
+        """ return the number of requests currently allowed in flight """
+        if self.queue_overloaded():
+            return self.min_limit
+        return int(self.limit)
+
+    def queue_overloaded(self):
+        """ return whether the last command queue depth seen is over the limit """
+        if self.command_queue_limit is None or self.queue_depth is None:
+            return False
+        return self.queue_depth > self.command_queue_limit
+
+    def acquire(self):
+        """ block until a request may be sent, and count it as in flight """
+        with self.cond:
+            while self.in_flight >= self.current_limit():
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, error=False, endpoint=None):
+        """
+        Mark a request as complete, and adjust the limit from its outcome.
+
+        :param latency: seconds the request took, or None if unknown
+        :type latency: float
+        :param error: whether the request failed in a way that suggests
+          PuppetDB is overloaded
+        :type error: boolean
+        :param endpoint: the API endpoint the request was for; latency is
+          only compared with that of other requests to the same endpoint
+        :type endpoint: string
+        """
+        with self.cond:
+            self.in_flight -= 1
+            self.since_backoff += 1
+            if error:
+                self._backoff("request error")
+            elif latency is not None:
+                smoothed = self.latency.get(endpoint, None)
+                if smoothed is None:
+                    smoothed = latency
+                else:
+                    smoothed += ADAPTIVE_LATENCY_SMOOTHING * (latency - smoothed)
+                self.latency[endpoint] = smoothed
+                self.samples[endpoint] = self.samples.get(endpoint, 0) + 1
+                baseline = self.baseline.get(endpoint, smoothed)
+                # a plain average until there are enough samples to weight
+                baseline += max(ADAPTIVE_BASELINE_DECAY, 1.0 / self.samples[endpoint]) * (smoothed - baseline)
+                self.baseline[endpoint] = baseline
+                if smoothed > baseline * ADAPTIVE_LATENCY_TOLERANCE:
+                    self._backoff("{e} latency {l:.3f}s vs. {m:.3f}s".format(e=endpoint, l=smoothed, m=baseline))
+                elif not self.queue_overloaded():
+                    self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+    def set_queue_depth(self, depth):
+        """
+        Record the current depth of PuppetDB's command queue.
+
+        :param depth: number of commands waiting to be processed
+        :type depth: int
+        """
+        with self.cond:
+            self.queue_depth = depth
+            if self.queue_overloaded():
+                logger.debug("PuppetDB command queue depth {d} is over {m}; sending one request at a time".format(
+                    d=depth, m=self.command_queue_limit))
+            self.cond.notify_all()
+
+    def _backoff(self, reason):
+        """ cut the limit, unless we already did within the last limit's worth of requests """
+        if self.since_backoff < self.limit:
+            return
+        self.limit = max(float(self.min_limit), self.limit * ADAPTIVE_BACKOFF)
+        self.since_backoff = 0
+        self.backoffs += 1
+        logger.debug("backing off to {n} requests in flight: {reason}".format(n=int(self.limit), reason=reason))
+
+
+class PooledAPI(v3API):
+    """
+    pypuppetdb v3 API that sends every request through one shared, explicitly
+    configured requests.Session, so HTTP keep-alive connections (and their
+    TLS sessions) are reused across all of the report's queries instead of
+    paying a new connection and handshake per request.
+    """
+
+    def __init__(self, host='localhost', port=8080, ssl_verify=False, ssl_key=None, ssl_cert=None,
+                 pool_size=10, connect_timeout=10, read_timeout=60, limiter=None):
+        """
+        :param host: PuppetDB hostname
+        :type host: string
+        :param port: PuppetDB port
+        :type port: int
+        :param ssl_verify: whether to verify the PuppetDB server certificate
+        :type ssl_verify: boolean
+        :param ssl_key: path to client SSL key
+        :type ssl_key: string
+        :param ssl_cert: path to client SSL certificate
+        :type ssl_cert: string
+        :param pool_size: max number of pooled connections; requests beyond
+          this block until a connection is free rather than opening more
+        :type pool_size: int
+        :param connect_timeout: connect timeout, in seconds
+        :type connect_timeout: float
+        :param read_timeout: read timeout, in seconds
+        :type read_timeout: float
+        :param limiter: optional limit on the requests in flight, adjusted
+          from PuppetDB's responses; the pool size is still the upper bound
+        :type limiter: AdaptiveLimiter
+        """
+        super(PooledAPI, self).__init__(host=host, port=port, ssl_verify=ssl_verify, ssl_key=ssl_key,
+                                        ssl_cert=ssl_cert, timeout=(connect_timeout, read_timeout))
+        self.last_total = None
+        self.limiter = limiter
+        self.queue_checked = None
+        # whether PuppetDB accepts start-time range queries on reports;
+        # cleared the first time it rejects one, after which we fall back
+        # to node.reports()
+        self.reports_range_query = True
+        # whether we've warned that the counters engine had to query
+        # event-counts for reports without embedded metrics
+        self.counters_fallback_warned = False
+        # EventCache of report events, and CacheManifest recording cache
+        # hits and builds, set up by main() when there's a cache_dir
+        self.event_cache = None
+        self.cache_manifest = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'content-type': 'application/json',
+                                     'accept': 'application/json',
+                                     'accept-charset': 'utf-8',
+                                     'accept-encoding': 'gzip',
+                                     })
+        self.session.verify = ssl_verify
+        if ssl_cert is not None and ssl_key is not None:
+            self.session.cert = (ssl_cert, ssl_key)
+
+    def _query(self, endpoint, path=None, query=None, order_by=None, limit=None, offset=None,
+               include_total=False, summarize_by=None, count_by=None, count_filter=None):
+        """
+        Query PuppetDB through the shared session; arguments and return value
+        are the same as pypuppetdb.api.BaseAPI._query().
+        """
+        r = self._get(endpoint, path=path, query=query, order_by=order_by, limit=limit, offset=offset,
+                      include_total=include_total, summarize_by=summarize_by, count_by=count_by,
+                      count_filter=count_filter)
+        json_body = r.json()
+        if json_body is None:
+            raise EmptyResponseError
+        return json_body
+
+    def metrics(self, paths):
+        """
+        Read several MBeans in a single request, by POSTing the list of MBean
+        names to the metrics API; returns the list of responses, in the same
+        order as ``paths``.
+
+        :param paths: list of MBean names
+        :type paths: list
+        """
+        r = self._request('post', self._url('mbean'), endpoint='mbean', data=json.dumps(paths))
+        res = r.json()
+        if not isinstance(res, list) or len(res) != len(paths):
+            raise ValueError("unexpected bulk metrics response: {r}".format(r=res))
+        return res
+
+    def stream_query(self, endpoint, path=None, **kwargs):
+        """
+        Generator like _query(), for endpoints that return a JSON array, but
+        streaming the response and yielding each decoded element of the
+        array as it's read, so memory use is bounded by one element rather
+        than by the size of the response. Keyword arguments are the query
+        parameters accepted by _query().
+        """
+        r = self._get(endpoint, path=path, stream=True, **kwargs)
+        started = time.time()
+        error = False
+        try:
+            if r.encoding is None:
+                r.encoding = 'utf-8'
+            for obj in iter_json_array(r.iter_content(chunk_size=STREAM_CHUNK_SIZE, decode_unicode=True)):
+                yield obj
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            error = True
+            raise
+        finally:
+            # release the connection back to the pool, even if we stopped early
+            r.close()
+            if self.limiter is not None:
+                # the body's read time counts toward the latency too
+                self.limiter.release(latency=r.elapsed.total_seconds() + time.time() - started, error=error,
+                                     endpoint=endpoint)
+
+    def _get(self, endpoint, path=None, stream=False, **kwargs):
+        """
+        GET an API endpoint through the shared session, raising on HTTP error
+        statuses, and return the requests.Response. Keyword arguments are the
+        query parameters accepted by _query().
+        """
+        payload = {}
+        for k, v in kwargs.items():
+            if k == 'include_total':
+                if v is True:
+                    payload['include-total'] = json.dumps(v)
+            elif v is not None:
+                payload[k.replace('_', '-')] = v
+        r = self._request('get', self._url(endpoint, path=path), endpoint=endpoint, params=payload or None, stream=stream)
+        self.last_total = r.headers.get('X-Records', None)
+        return r
+
+    def _request(self, method, url, endpoint=None, **kwargs):
+        """
+        Send a request through the shared session, raising on HTTP error
+        statuses, and return the requests.Response. With a limiter, wait for
+        it to allow another request in flight, and report back how long the
+        request took (to ``endpoint``) and whether it failed; for a streamed
+        response, the caller must release the limiter once the body is read.
+        """
+        if self.limiter is None:
+            return self._send(method, url, **kwargs)
+        self._check_command_queue()
+        self.limiter.acquire()
+        started = time.time()
+        try:
+            r = self._send(method, url, **kwargs)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            self.limiter.release(error=True)
+            raise
+        except requests.exceptions.HTTPError as ex:
+            # 4xx other than 429 is a problem with the query, not with load
+            status = ex.response.status_code if ex.response is not None else None
+            self.limiter.release(latency=time.time() - started,
+                                 error=(status is None or status >= 500 or status == 429), endpoint=endpoint)
+            raise
+        if not kwargs.get('stream', False):
+            self.limiter.release(latency=time.time() - started, endpoint=endpoint)
+        return r
+
+    def _send(self, method, url, **kwargs):
+        """ send a request through the shared session, and raise on HTTP error statuses """
+        try:
+            r = getattr(self.session, method)(url, timeout=self.timeout, **kwargs)
+            r.raise_for_status()
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as ex:
+            logger.error("error querying PuppetDB {host}:{port} over {proto}: {ex}".format(host=self.host,
+                                                                                           port=self.port,
+                                                                                           proto=self.protocol.upper(),
+                                                                                           ex=ex))
+            raise
+        return r
+
+    def _check_command_queue(self):
+        """
+        If the limiter watches PuppetDB's command queue, and it hasn't been
+        read in the last COMMAND_QUEUE_CHECK_INTERVAL seconds, read its depth
+        (outside of the limiter, so it's seen even when we're throttled).
+        """
+        if self.limiter.command_queue_limit is None:
+            return
+        now = time.time()
+        if self.queue_checked is not None and now - self.queue_checked < COMMAND_QUEUE_CHECK_INTERVAL:
+            return
+        self.queue_checked = now
+        path = dashboard_metrics()['Command Queue']['path']
+        try:
+            r = self._send('get', self._url('mbean', path=path))
+            depth = r.json().get('QueueSize', None)
+        except (requests.exceptions.RequestException, ValueError, AttributeError):
+            logger.debug("unable to read PuppetDB command queue depth")
+            return
+        if depth is not None:
+            self.limiter.set_queue_depth(depth)
+
+    def connection_stats(self):
+        """
+        Return a dict with the number of HTTP connections ``opened``, the
+        number of ``requests`` made, and how many requests ``reused`` an
+        already-open connection, for all requests made so far.
+        """
+        opened = 0
+        num_requests = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                opened += pool.num_connections
+                num_requests += pool.num_requests
+        return {'opened': opened, 'requests': num_requests, 'reused': num_requests - opened}
+
+
 def send_mail(to, subject, html, dry_run=False):
     """
     Send the message
@@ -579,6 +4224,18 @@ def parse_args(argv):
     p.add_option('-n', '--num-days', dest='num_days', action='store', type='int', default=7,
                  help='Number of days to report on; default 7')
 
+    p.add_option('--since', dest='since', action='store', type='string', default=None,
+                 help='instead of --num-days, report on a single window starting at this time on the '
+                 'hour ("YYYY-MM-DD HH:MM" in --timezone), or this many hours before --until (i.e. "24h")')
+
+    p.add_option('--until', dest='until', action='store', type='string', default=None,
+                 help='with --since, end the window at this time on the hour ("YYYY-MM-DD HH:MM" in '
+                 '--timezone); default the start of the current hour')
+
+    p.add_option('--timezone', dest='timezone', action='store', type='string', default=None,
+                 help='timezone that days start at midnight in, and --since and --until are in (i.e. '
+                 '"America/New_York"); default the local timezone')
+
     p.add_option('-d', '--dry-run', dest='dry_run', action='store_true', default=False,
                  help='dry-run - dont actually send anything')
 
@@ -589,9 +4246,94 @@ def parse_args(argv):
     p.add_option('-c', '--cache-dir', dest='cache_dir', action='store', type='string', default=cache_dir,
                  help='data cache directory (default: {cache_dir})'.format(cache_dir=cache_dir))
 
+    p.add_option('--cache-backend', dest='cache_backend', action='store', type='choice',
+                 choices=['files', 'sqlite'], default='files',
+                 help='how to store data in the cache dir: "files" (one per day) or "sqlite" (one '
+                 'SQLite database); default files')
+
+    p.add_option('--cache-granularity', dest='cache_granularity', action='store', type='choice',
+                 choices=['day', 'hour'], default='day',
+                 help='"day" to query and cache each day whole, or "hour" to cache hourly buckets and '
+                 'build each day (or --since/--until window) from them; default day')
+
+    p.add_option('--cache-max-age', dest='cache_max_age', action='store', type='int', default=CACHE_MAX_AGE,
+                 help='prune cached days older than this many days; 0 to keep them forever; '
+                 'default {d}'.format(d=CACHE_MAX_AGE))
+
+    p.add_option('--cache-bucket-max-age', dest='cache_bucket_max_age', action='store', type='int',
+                 default=CACHE_BUCKET_MAX_AGE,
+                 help='prune cached hourly buckets (see --cache-granularity) older than this many days; '
+                 '0 to prune them with --cache-max-age; default {d}'.format(d=CACHE_BUCKET_MAX_AGE))
+
+    p.add_option('--cache-max-bytes', dest='cache_max_bytes', action='store', type='int', default=None,
+                 help='prune the least recently used cache entries until the cache dir holds at most '
+                 'this many bytes; default no limit')
+
+    p.add_option('--cache-max-files', dest='cache_max_files', action='store', type='int', default=None,
+                 help='prune the least recently used cache entries of each PuppetDB host beyond this '
+                 'many; default no limit')
+
+    p.add_option('--cache-compact-after', dest='cache_compact_after', action='store', type='int',
+                 default=CACHE_COMPACT_AFTER,
+                 help='compact cached days older than this many days down to the aggregates the report '
+                 'uses; 0 to never compact them; default {d}'.format(d=CACHE_COMPACT_AFTER))
+
+    p.add_option('--cache-stats', dest='cache_stats', action='store_true', default=False,
+                 help='only print cache hit/miss rates and the slowest days to build, from the cache '
+                 'manifest, then exit')
+
+    p.add_option('--cache-prune', dest='cache_prune', action='store_true', default=False,
+                 help='only compact and prune the cache dir (see --cache-compact-after and the '
+                 '--cache-max-* options), then exit')
+
     p.add_option('-t', '--to', dest='to_str', action='store', type='string',
                  help='csv list of addresses to send mail to')
 
+    p.add_option('-f', '--facts', dest='facts_str', action='store', type='string', default=','.join(FACTS),
+                 help='csv list of facts to report values of; default {facts}'.format(facts=','.join(FACTS)))
+
+    p.add_option('-w', '--workers', dest='workers', action='store', type='int', default=1,
+                 help='number of nodes to query PuppetDB for concurrently; default 1')
+
+    p.add_option('-b', '--backend', dest='backend', action='store', type='choice',
+                 choices=['sync', 'async'], default='sync',
+                 help='PuppetDB client: "sync" (pypuppetdb) or "async" (asyncio/aiohttp); default sync')
+
+    p.add_option('-e', '--engine', dest='engine', action='store', type='choice',
+                 choices=['events', 'event-counts', 'counters'], default='events',
+                 help='how to collect node data: "events" (download and count every event), '
+                 '"event-counts" (use PuppetDB event-counts summaries) or "counters" (per-node '
+                 'report counters only, no resource tables; the counters come from report metrics, '
+                 'which PuppetDB\'s v3 API doesn\'t return, so against v3 they come from event-counts '
+                 'queries instead); default events')
+
+    p.add_option('-D', '--parallel-days', dest='parallel_days', action='store', type='int', default=1,
+                 help='number of uncached days to query PuppetDB for concurrently; default 1')
+
+    p.add_option('--no-backfill', dest='backfill', action='store_false', default=True,
+                 help='query each uncached day separately, instead of all in one pass')
+
+    p.add_option('--pool-size', dest='pool_size', action='store', type='int', default=10,
+                 help='max number of pooled HTTP connections to PuppetDB, which is also the max number '
+                 'of requests in flight across all workers and days; default 10')
+
+    p.add_option('--adaptive', dest='adaptive', action='store_true', default=False,
+                 help='adapt the number of PuppetDB requests in flight (up to --pool-size) to how fast '
+                 'and reliably PuppetDB is responding')
+
+    p.add_option('--command-queue-limit', dest='command_queue_limit', action='store', type='int', default=None,
+                 help='with --adaptive, send only one request at a time while the PuppetDB command queue '
+                 'is deeper than this')
+
+    p.add_option('--connect-timeout', dest='connect_timeout', action='store', type='float', default=10,
+                 help='PuppetDB connect timeout in seconds; default 10')
+
+    p.add_option('--read-timeout', dest='read_timeout', action='store', type='float', default=60,
+                 help='PuppetDB read timeout in seconds; default 60')
+
+    p.add_option('--concurrency', dest='concurrency', action='store', type='int', default=100,
+                 help='max number of PuppetDB requests in flight with --backend async; default 100')
+
     options, args = p.parse_args(argv)
 
     if options.to_str and ',' in options.to_str:
@@ -599,6 +4341,10 @@ def parse_args(argv):
     else:
         options.to = [options.to_str]
 
+    options.facts = [fact for fact in options.facts_str.split(',') if fact != '']
+    if len(options.facts) == 0:
+        p.error("-f/--facts must name at least one fact")
+
     return options
 
 
@@ -611,12 +4357,89 @@ def console_entry_point():
     elif opts.verbose > 0:
         logger.setLevel(logging.INFO)
 
+    if opts.cache_stats:
+        sys.stdout.write(format_cache_stats(CacheManifest(opts.cache_dir).load()))
+        return
+
+    tz = None
+    if opts.timezone is not None:
+        try:
+            tz = pytz.timezone(opts.timezone)
+        except pytz.UnknownTimeZoneError:
+            raise SystemExit("ERROR: unknown --timezone: {tz}".format(tz=opts.timezone))
+
+    window = None
+    if opts.since is not None:
+        try:
+            window = get_window(opts.since, opts.until, tz=tz)
+        except ValueError as ex:
+            raise SystemExit("ERROR: {ex}".format(ex=ex))
+        timespans = [window]
+    else:
+        timespans = get_day_timespans(opts.num_days, tz=tz)
+    try:
+        keep = cache_keep(opts.host, timespans, buckets=(window is not None or opts.cache_granularity == 'hour'))
+    except ValueError:
+        raise SystemExit("ERROR: --cache-granularity hour needs a --timezone whose days start on the hour (UTC)")
+
+    if opts.cache_prune:
+        if opts.cache_compact_after:
+            compact_cache(opts.cache_dir, opts.cache_compact_after)
+        # keep what the next report on the same days needs
+        max_age = opts.cache_max_age
+        if max_age:
+            max_age = max(max_age, min_cache_age(opts.num_days, window))
+        bucket_max_age = opts.cache_bucket_max_age
+        if bucket_max_age:
+            bucket_max_age = max(bucket_max_age, min_cache_age(opts.num_days, window))
+        prune_cache(opts.cache_dir, max_age=max_age, max_bytes=opts.cache_max_bytes,
+                    max_files=opts.cache_max_files, keep=keep, bucket_max_age=bucket_max_age)
+        return
+
     if not opts.to and not opts.dry_run:
         raise SystemExit("ERROR: you must either run with --dry-run or specify to address(es) with --to")
 
     if not opts.host:
         raise SystemExit("ERROR: you must specify the PuppetDB hostname with -p|--puppetdb")
-    main(opts.host, to=opts.to, num_days=opts.num_days, dry_run=opts.dry_run, cache_dir=opts.cache_dir)
+
+    if opts.workers < 1:
+        raise SystemExit("ERROR: -w|--workers must be at least 1")
+
+    if opts.concurrency < 1:
+        raise SystemExit("ERROR: --concurrency must be at least 1")
+
+    if opts.pool_size < 1:
+        raise SystemExit("ERROR: --pool-size must be at least 1")
+
+    if opts.parallel_days < 1:
+        raise SystemExit("ERROR: -D|--parallel-days must be at least 1")
+
+    if opts.parallel_days > 1 and opts.backend == 'async':
+        raise SystemExit("ERROR: --parallel-days is not supported with --backend async")
+
+    if opts.command_queue_limit is not None and not opts.adaptive:
+        raise SystemExit("ERROR: --command-queue-limit requires --adaptive")
+
+    if opts.adaptive and opts.backend == 'async':
+        raise SystemExit("ERROR: --adaptive is not supported with --backend async")
+
+    if opts.engine != 'events' and opts.backend == 'async':
+        raise SystemExit("ERROR: --engine {engine} is not supported with --backend async".format(engine=opts.engine))
+
+    if opts.until is not None and opts.since is None:
+        raise SystemExit("ERROR: --until requires --since")
+
+    if (opts.since is not None or opts.cache_granularity == 'hour') and (opts.backend != 'sync' or opts.engine != 'events'):
+        raise SystemExit("ERROR: --since and --cache-granularity hour are only supported with --backend sync and --engine events")
+
+    main(opts.host, to=opts.to, num_days=opts.num_days, dry_run=opts.dry_run, cache_dir=opts.cache_dir,
+         workers=opts.workers, backend=opts.backend, concurrency=opts.concurrency, backfill=opts.backfill,
+         pool_size=opts.pool_size, connect_timeout=opts.connect_timeout, read_timeout=opts.read_timeout,
+         engine=opts.engine, facts=opts.facts, parallel_days=opts.parallel_days, adaptive=opts.adaptive,
+         command_queue_limit=opts.command_queue_limit, cache_backend=opts.cache_backend,
+         cache_max_age=opts.cache_max_age, cache_max_bytes=opts.cache_max_bytes, cache_max_files=opts.cache_max_files,
+         cache_compact_after=opts.cache_compact_after, window=window, timezone=opts.timezone,
+         cache_granularity=opts.cache_granularity, cache_bucket_max_age=opts.cache_bucket_max_age)
 
 
 if __name__ == "__main__":
@@ -26,11 +26,19 @@ Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
 """
 
 import pytest
+import random
 import sys
 import os
 import mock
 import logging
 import datetime
+import json
+import threading
+import requests
+from requests.compat import urlencode
+import pickle
+import calendar
+from multiprocessing.pool import ThreadPool
 from freezegun import freeze_time
 from freezegun.api import FakeDatetime
 from requests.exceptions import HTTPError
@@ -39,6 +47,10 @@ from jinja2 import Environment, PackageLoader, Template
 import pytz
 from copy import deepcopy
 from collections import OrderedDict
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
 from pypuppetdb_daily_report import pypuppetdb_daily_report as pdr
 from pypuppetdb_daily_report import VERSION
@@ -63,12 +75,30 @@ class OptionsObject(object):
         self.cache_dir = '/tmp/.pypuppetdb_daily_report'
         self.to = None
         self.to_str = None
-
-
-class FactObject(object):
-    """ object to mock a Fact """
-    def __init__(self, value):
-        self.value = value
+        self.workers = 1
+        self.backend = 'sync'
+        self.concurrency = 100
+        self.backfill = True
+        self.pool_size = 10
+        self.connect_timeout = 10
+        self.read_timeout = 60
+        self.engine = 'events'
+        self.facts = ['puppetversion', 'facterversion', 'lsbdistdescription']
+        self.parallel_days = 1
+        self.adaptive = False
+        self.command_queue_limit = None
+        self.cache_backend = 'files'
+        self.cache_max_age = 365
+        self.cache_max_bytes = None
+        self.cache_max_files = None
+        self.cache_bucket_max_age = 31
+        self.cache_prune = False
+        self.cache_compact_after = 14
+        self.cache_stats = False
+        self.since = None
+        self.until = None
+        self.timezone = None
+        self.cache_granularity = 'day'
 
 
 class Test_parse_args:
@@ -164,6 +194,165 @@ class Test_parse_args:
         x = pdr.parse_args(argv)
         assert x.to == ['foo@example.com', 'bar@example.com', 'baz@example.com']
 
+    def test_workers(self):
+        """
+        Test the parse_args option parsing method with number of workers specified
+        """
+        argv = ['pypuppetdb_daily_report']
+        x = pdr.parse_args(argv)
+        assert x.workers == 1
+        argv = ['pypuppetdb_daily_report', '-w', '8']
+        x = pdr.parse_args(argv)
+        assert x.workers == 8
+
+    def test_backend(self):
+        """
+        Test the parse_args option parsing method with backend and concurrency specified
+        """
+        argv = ['pypuppetdb_daily_report']
+        x = pdr.parse_args(argv)
+        assert x.backend == 'sync'
+        assert x.concurrency == 100
+        argv = ['pypuppetdb_daily_report', '--backend', 'async', '--concurrency', '500']
+        x = pdr.parse_args(argv)
+        assert x.backend == 'async'
+        assert x.concurrency == 500
+
+    def test_pool(self):
+        """
+        Test the parse_args option parsing method with connection pool options
+        """
+        argv = ['pypuppetdb_daily_report']
+        x = pdr.parse_args(argv)
+        assert x.pool_size == 10
+        assert x.connect_timeout == 10
+        assert x.read_timeout == 60
+        argv = ['pypuppetdb_daily_report', '--pool-size', '4', '--connect-timeout', '2.5', '--read-timeout', '300']
+        x = pdr.parse_args(argv)
+        assert x.pool_size == 4
+        assert x.connect_timeout == 2.5
+        assert x.read_timeout == 300
+
+    def test_facts(self):
+        """
+        Test the parse_args option parsing method with facts specified
+        """
+        argv = ['pypuppetdb_daily_report']
+        x = pdr.parse_args(argv)
+        assert x.facts == ['puppetversion', 'facterversion', 'lsbdistdescription']
+        argv = ['pypuppetdb_daily_report', '--facts', 'kernel,operatingsystem,']
+        x = pdr.parse_args(argv)
+        assert x.facts == ['kernel', 'operatingsystem']
+        for facts in ['', ',']:
+            with pytest.raises(SystemExit):
+                pdr.parse_args(['pypuppetdb_daily_report', '-f', facts])
+
+    def test_engine(self):
+        """
+        Test the parse_args option parsing method with engine specified
+        """
+        argv = ['pypuppetdb_daily_report']
+        x = pdr.parse_args(argv)
+        assert x.engine == 'events'
+        argv = ['pypuppetdb_daily_report', '--engine', 'event-counts']
+        x = pdr.parse_args(argv)
+        assert x.engine == 'event-counts'
+        argv = ['pypuppetdb_daily_report', '-e', 'counters']
+        x = pdr.parse_args(argv)
+        assert x.engine == 'counters'
+
+    def test_parallel_days(self):
+        """
+        Test the parse_args option parsing method with parallel days specified
+        """
+        argv = ['pypuppetdb_daily_report']
+        x = pdr.parse_args(argv)
+        assert x.parallel_days == 1
+        argv = ['pypuppetdb_daily_report', '--parallel-days', '3']
+        x = pdr.parse_args(argv)
+        assert x.parallel_days == 3
+        argv = ['pypuppetdb_daily_report', '-D', '7']
+        x = pdr.parse_args(argv)
+        assert x.parallel_days == 7
+
+    def test_adaptive(self):
+        """
+        Test the parse_args option parsing method with --adaptive and --command-queue-limit
+        """
+        argv = ['pypuppetdb_daily_report']
+        x = pdr.parse_args(argv)
+        assert x.adaptive is False
+        assert x.command_queue_limit is None
+        argv = ['pypuppetdb_daily_report', '--adaptive', '--command-queue-limit', '1000']
+        x = pdr.parse_args(argv)
+        assert x.adaptive is True
+        assert x.command_queue_limit == 1000
+
+    def test_window(self):
+        """
+        Test the parse_args option parsing method with --since, --until, --timezone and --cache-granularity
+        """
+        x = pdr.parse_args(['pypuppetdb_daily_report'])
+        assert x.since is None
+        assert x.until is None
+        assert x.timezone is None
+        assert x.cache_granularity == 'day'
+        x = pdr.parse_args(['pypuppetdb_daily_report', '--since', '2014-06-10 04:00', '--until', '2014-06-11 04:00',
+                            '--timezone', 'America/New_York', '--cache-granularity', 'hour'])
+        assert x.since == '2014-06-10 04:00'
+        assert x.until == '2014-06-11 04:00'
+        assert x.timezone == 'America/New_York'
+        assert x.cache_granularity == 'hour'
+
+    def test_cache_retention(self):
+        """
+        Test the parse_args option parsing method with the --cache-max-* options and --cache-prune
+        """
+        argv = ['pypuppetdb_daily_report']
+        x = pdr.parse_args(argv)
+        assert x.cache_max_age == 365
+        assert x.cache_max_bytes is None
+        assert x.cache_max_files is None
+        assert x.cache_prune is False
+        assert x.cache_compact_after == 14
+        assert x.cache_bucket_max_age == 31
+        argv = ['pypuppetdb_daily_report', '--cache-max-age', '30', '--cache-max-bytes', '1048576',
+                '--cache-max-files', '60', '--cache-prune', '--cache-compact-after', '3', '--cache-bucket-max-age', '5']
+        x = pdr.parse_args(argv)
+        assert x.cache_max_age == 30
+        assert x.cache_max_bytes == 1048576
+        assert x.cache_max_files == 60
+        assert x.cache_prune is True
+        assert x.cache_compact_after == 3
+        assert x.cache_bucket_max_age == 5
+        assert x.cache_stats is False
+        x = pdr.parse_args(['pypuppetdb_daily_report', '--cache-stats'])
+        assert x.cache_stats is True
+
+    def test_cache_backend(self):
+        """
+        Test the parse_args option parsing method with --cache-backend
+        """
+        argv = ['pypuppetdb_daily_report']
+        x = pdr.parse_args(argv)
+        assert x.cache_backend == 'files'
+        argv = ['pypuppetdb_daily_report', '--cache-backend', 'sqlite']
+        x = pdr.parse_args(argv)
+        assert x.cache_backend == 'sqlite'
+        with pytest.raises(SystemExit):
+            pdr.parse_args(['pypuppetdb_daily_report', '--cache-backend', 'foo'])
+
+    def test_no_backfill(self):
+        """
+        Test the parse_args option parsing method with --no-backfill
+        """
+        argv = ['pypuppetdb_daily_report']
+        x = pdr.parse_args(argv)
+        assert x.backfill is True
+        argv = ['pypuppetdb_daily_report', '--no-backfill']
+        x = pdr.parse_args(argv)
+        assert x.backfill is False
+
 
 class Test_console_entry_point:
     """ test console_entry_point """
@@ -187,7 +376,28 @@ class Test_console_entry_point:
                                                 to=['foo@example.com'],
                                                 num_days=7,
                                                 dry_run=False,
-                                                cache_dir='/tmp/.pypuppetdb_daily_report')
+                                                cache_dir='/tmp/.pypuppetdb_daily_report',
+                                                workers=1,
+                                                backend='sync',
+                                                concurrency=100,
+                                                backfill=True,
+                                                pool_size=10,
+                                                connect_timeout=10,
+                                                read_timeout=60,
+                                                engine='events',
+                                                facts=['puppetversion', 'facterversion', 'lsbdistdescription'],
+                                                parallel_days=1,
+                                                adaptive=False,
+                                                command_queue_limit=None,
+                                                cache_backend='files',
+                                                cache_max_age=365,
+                                                cache_max_bytes=None,
+                                                cache_max_files=None,
+                                                cache_compact_after=14,
+                                                window=None,
+                                                timezone=None,
+                                                cache_granularity='day',
+                                                cache_bucket_max_age=31)
 
     def test_nohost(self):
         """ without a host specified """
@@ -261,6 +471,297 @@ class Test_console_entry_point:
         assert main_mock.call_count == 0
         assert excinfo.value.__str__() == "ERROR: you must either run with --dry-run or specify to address(es) with --to"
 
+    def test_bad_workers(self):
+        """ with less than one worker """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.host = 'foobar'
+        opts_o.to = ['foo@example.com']
+        opts_o.workers = 0
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock), \
+                pytest.raises(SystemExit) as excinfo:
+            pdr.console_entry_point()
+        assert main_mock.call_count == 0
+        assert excinfo.value.__str__() == "ERROR: -w|--workers must be at least 1"
+
+    def test_bad_concurrency(self):
+        """ with concurrency less than one """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.host = 'foobar'
+        opts_o.to = ['foo@example.com']
+        opts_o.concurrency = 0
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock), \
+                pytest.raises(SystemExit) as excinfo:
+            pdr.console_entry_point()
+        assert main_mock.call_count == 0
+        assert excinfo.value.__str__() == "ERROR: --concurrency must be at least 1"
+
+    def test_bad_pool_size(self):
+        """ with pool size less than one """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.host = 'foobar'
+        opts_o.to = ['foo@example.com']
+        opts_o.pool_size = 0
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock), \
+                pytest.raises(SystemExit) as excinfo:
+            pdr.console_entry_point()
+        assert main_mock.call_count == 0
+        assert excinfo.value.__str__() == "ERROR: --pool-size must be at least 1"
+
+    def test_engine_async(self):
+        """ with an engine the async backend doesn't support """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.host = 'foobar'
+        opts_o.to = ['foo@example.com']
+        opts_o.backend = 'async'
+        opts_o.engine = 'event-counts'
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock), \
+                pytest.raises(SystemExit) as excinfo:
+            pdr.console_entry_point()
+        assert main_mock.call_count == 0
+        assert excinfo.value.__str__() == "ERROR: --engine event-counts is not supported with --backend async"
+
+    def test_bad_parallel_days(self):
+        """ with parallel days less than one """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.host = 'foobar'
+        opts_o.to = ['foo@example.com']
+        opts_o.parallel_days = 0
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock), \
+                pytest.raises(SystemExit) as excinfo:
+            pdr.console_entry_point()
+        assert main_mock.call_count == 0
+        assert excinfo.value.__str__() == "ERROR: -D|--parallel-days must be at least 1"
+
+    def test_parallel_days_async(self):
+        """ with parallel days and the async backend """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.host = 'foobar'
+        opts_o.to = ['foo@example.com']
+        opts_o.backend = 'async'
+        opts_o.parallel_days = 2
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock), \
+                pytest.raises(SystemExit) as excinfo:
+            pdr.console_entry_point()
+        assert main_mock.call_count == 0
+        assert excinfo.value.__str__() == "ERROR: --parallel-days is not supported with --backend async"
+
+    def test_command_queue_limit_without_adaptive(self):
+        """ with a command queue limit but not --adaptive """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.host = 'foobar'
+        opts_o.to = ['foo@example.com']
+        opts_o.command_queue_limit = 100
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock), \
+                pytest.raises(SystemExit) as excinfo:
+            pdr.console_entry_point()
+        assert main_mock.call_count == 0
+        assert excinfo.value.__str__() == "ERROR: --command-queue-limit requires --adaptive"
+
+    def test_adaptive_async(self):
+        """ with --adaptive and the async backend """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.host = 'foobar'
+        opts_o.to = ['foo@example.com']
+        opts_o.backend = 'async'
+        opts_o.adaptive = True
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock), \
+                pytest.raises(SystemExit) as excinfo:
+            pdr.console_entry_point()
+        assert main_mock.call_count == 0
+        assert excinfo.value.__str__() == "ERROR: --adaptive is not supported with --backend async"
+
+    def test_cache_prune(self):
+        """ with --cache-prune, only the cache is pruned; no host or to needed """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.cache_prune = True
+        opts_o.cache_max_bytes = 1000
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+        prune_mock = mock.MagicMock()
+        compact_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.prune_cache', prune_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.compact_cache', compact_mock), \
+                mock.patch('tzlocal.get_localzone', mock.MagicMock(return_value=pytz.timezone('US/Eastern'))), \
+                freeze_time("2014-06-11 08:15:43"):
+            pdr.console_entry_point()
+        assert main_mock.call_count == 0
+        assert compact_mock.call_args == mock.call('/tmp/.pypuppetdb_daily_report', 14)
+        day = (datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+               datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc))
+        assert prune_mock.call_args == mock.call('/tmp/.pypuppetdb_daily_report', max_age=365, max_bytes=1000,
+                                                 max_files=None,
+                                                 keep=[(None, day[0] - datetime.timedelta(days=i), day[1] - datetime.timedelta(days=i))
+                                                       for i in range(7)],
+                                                 bucket_max_age=31)
+
+    def test_cache_prune_floor(self):
+        """ a standalone prune keeps what the next report needs, as main() does """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.cache_prune = True
+        opts_o.cache_max_age = 3
+        opts_o.cache_bucket_max_age = 2
+        opts_o.num_days = 7
+        opts_o.host = 'foobar'
+        opts_o.cache_granularity = 'hour'
+        opts_o.timezone = 'America/New_York'
+        parse_args_mock.return_value = opts_o
+        prune_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.prune_cache', prune_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.compact_cache', mock.MagicMock()), \
+                freeze_time("2014-06-11 08:15:43"):
+            pdr.console_entry_point()
+        assert prune_mock.call_args[1]['max_age'] == 7
+        assert prune_mock.call_args[1]['bucket_max_age'] == 7
+        keep = prune_mock.call_args[1]['keep']
+        assert len(keep) == 7 + 7 * 24
+        assert keep[0] == ('foobar', datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                           datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc))
+
+    def test_window(self):
+        """ --since and --until are parsed in --timezone, and passed to main() as a window """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.since = '2014-06-10 00:00'
+        opts_o.until = '2014-06-11 00:00'
+        opts_o.timezone = 'America/New_York'
+        opts_o.dry_run = True
+        opts_o.host = 'foobar'
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock):
+            pdr.console_entry_point()
+        assert main_mock.call_args[1]['window'] == (datetime.datetime(2014, 6, 10, hour=4, tzinfo=pytz.utc),
+                                                    datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59,
+                                                                      tzinfo=pytz.utc))
+        assert main_mock.call_args[1]['timezone'] == 'America/New_York'
+
+    def test_hour_granularity(self):
+        """ --cache-granularity hour with a timezone whose days start on the hour """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.cache_granularity = 'hour'
+        opts_o.timezone = 'America/New_York'
+        opts_o.dry_run = True
+        opts_o.host = 'foobar'
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock):
+            pdr.console_entry_point()
+        assert main_mock.call_args[1]['cache_granularity'] == 'hour'
+        assert main_mock.call_args[1]['window'] is None
+
+    @pytest.mark.parametrize('opts, msg', [
+        ({'until': '2014-06-11 00:00'}, "ERROR: --until requires --since"),
+        ({'since': '24h', 'backend': 'async'},
+         "ERROR: --since and --cache-granularity hour are only supported with --backend sync and --engine events"),
+        ({'cache_granularity': 'hour', 'engine': 'counters'},
+         "ERROR: --since and --cache-granularity hour are only supported with --backend sync and --engine events"),
+        ({'timezone': 'Foo/Bar'}, "ERROR: unknown --timezone: Foo/Bar"),
+        ({'since': 'yesterday'}, "ERROR: unable to parse time 'yesterday'; use YYYY-MM-DD HH:MM"),
+        ({'cache_granularity': 'hour', 'timezone': 'Asia/Kolkata'},
+         "ERROR: --cache-granularity hour needs a --timezone whose days start on the hour (UTC)"),
+    ])
+    def test_window_errors(self, opts, msg):
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.dry_run = True
+        opts_o.host = 'foobar'
+        for k, v in opts.items():
+            setattr(opts_o, k, v)
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock), \
+                pytest.raises(SystemExit) as excinfo:
+            pdr.console_entry_point()
+        assert excinfo.value.args[0] == msg
+        assert main_mock.call_count == 0
+
+    def test_cache_stats(self, capsys):
+        """ with --cache-stats, only the stats are printed """
+        parse_args_mock = mock.MagicMock()
+        opts_o = OptionsObject()
+        opts_o.cache_stats = True
+        parse_args_mock.return_value = opts_o
+        main_mock = mock.MagicMock()
+        manifest_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.parse_args', parse_args_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.main', main_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.CacheManifest', manifest_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_cache_stats',
+                           mock.MagicMock(return_value='foo stats\n')) as format_mock:
+            pdr.console_entry_point()
+        assert main_mock.call_count == 0
+        assert manifest_mock.call_args == mock.call('/tmp/.pypuppetdb_daily_report')
+        assert format_mock.call_args == mock.call(manifest_mock.return_value.load.return_value)
+        assert capsys.readouterr()[0] == 'foo stats\n'
+
+
+class Test_get_async_backend:
+
+    def test_import_error(self):
+        """ aiohttp not installed """
+        import pypuppetdb_daily_report as pkg
+        with mock.patch.dict('sys.modules', {'pypuppetdb_daily_report.async_backend': None}), \
+                mock.patch.dict(pkg.__dict__), \
+                pytest.raises(SystemExit) as excinfo:
+            pkg.__dict__.pop('async_backend', None)
+            pdr.get_async_backend()
+        assert excinfo.value.__str__() == "ERROR: --backend async requires Python 3.5+ and the aiohttp package"
+
 
 class Test_get_dashboard_metrics:
 
@@ -270,9 +771,11 @@ class Test_get_dashboard_metrics:
         val_mock = mock.MagicMock()
         with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.metric_value', val_mock):
             foo = pdr.get_dashboard_metrics(pdb_mock)
-        assert pdb_mock.metric.call_count == 17
+        # 'Command Processing' and 'Processed' share an MBean
+        assert pdb_mock.metric.call_count == 16
         assert val_mock.call_count == 17
         assert isinstance(foo, dict)
+        assert foo['Command Processing']['api_response'] is foo['Processed']['api_response']
 
     def test_exception(self):
         """ throws a HTTP exception """
@@ -285,9 +788,62 @@ class Test_get_dashboard_metrics:
         logger_mock = mock.MagicMock()
         with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger', logger_mock):
             pdr.get_dashboard_metrics(pdb_mock)
-        assert pdb_mock.metric.call_count == 17
+        assert pdb_mock.metric.call_count == 16
         assert mock.call("unable to get value for metric: Catalog duplication") in logger_mock.debug.call_args_list
 
+    def test_one_missing(self):
+        """ one MBean missing leaves the others intact """
+        pdb_mock = mock.MagicMock()
+
+        def side_effect(path):
+            if 'duplicate-pct' in path:
+                raise HTTPError('foo')
+            return {'Value': 2.0}
+
+        pdb_mock.metric.side_effect = side_effect
+        foo = pdr.get_dashboard_metrics(pdb_mock)
+        assert foo['Catalog duplication']['formatted'] is None
+        assert 'api_response' not in foo['Catalog duplication']
+        assert foo['Nodes']['formatted'] == 2
+
+    def test_bulk(self):
+        """ PooledAPI reads all of the MBeans in one request """
+        pdb = pdr.PooledAPI(host='foo')
+        paths = sorted(set(m['path'] for m in pdr.dashboard_metrics().values()))
+        resp = mock.MagicMock()
+        resp.json.return_value = [None if 'duplicate-pct' in p else {'Value': float(n)} for n, p in enumerate(paths)]
+        post_mock = mock.MagicMock(return_value=resp)
+        with mock.patch.object(pdb.session, 'post', post_mock), \
+                mock.patch.object(pdb, 'metric', mock.MagicMock()) as metric_mock:
+            foo = pdr.get_dashboard_metrics(pdb)
+        assert post_mock.call_count == 1
+        assert post_mock.call_args == mock.call('http://foo:8080/v3/metrics/mbean', data=json.dumps(paths), timeout=(10, 60))
+        assert metric_mock.call_count == 0
+        assert foo['Catalog duplication']['formatted'] is None
+        assert foo['Nodes']['formatted'] == paths.index(foo['Nodes']['path'])
+        assert foo['Processed']['formatted'] == foo['Command Processing']['formatted']
+
+    def test_bulk_fails(self):
+        """ fall back to reading MBeans one at a time """
+        pdb = pdr.PooledAPI(host='foo')
+        resp = mock.MagicMock()
+        resp.raise_for_status.side_effect = HTTPError('404')
+        with mock.patch.object(pdb.session, 'post', mock.MagicMock(return_value=resp)), \
+                mock.patch.object(pdb, 'metric', mock.MagicMock(return_value={'Value': 1.0})) as metric_mock:
+            foo = pdr.get_dashboard_metrics(pdb)
+        assert metric_mock.call_count == 16
+        assert foo['Nodes']['formatted'] == 1
+
+    def test_bulk_bad_response(self):
+        """ fall back to reading MBeans one at a time """
+        pdb = pdr.PooledAPI(host='foo')
+        resp = mock.MagicMock()
+        resp.json.return_value = {'error': 'foo'}
+        with mock.patch.object(pdb.session, 'post', mock.MagicMock(return_value=resp)), \
+                mock.patch.object(pdb, 'metric', mock.MagicMock(return_value={'Value': 1.0})) as metric_mock:
+            pdr.get_dashboard_metrics(pdb)
+        assert metric_mock.call_count == 16
+
 
 class Test_get_data_for_timespan:
 
@@ -298,54 +854,60 @@ class Test_get_data_for_timespan:
         query_mock = mock.MagicMock()
         query_mock.return_value = {}
         logger_mock = mock.MagicMock()
-        pickle_mock = mock.MagicMock()
-        pickle_mock.return_value = {'foo': 123}
-
-        raw = "(dp1\nS'foo'\np2\nI123\ns."
-        mock_open = mock.mock_open(read_data=raw)
-        if sys.version_info[0] == 3:
-            mock_target = 'builtins.open'
-        else:
-            mock_target = '__builtin__.open'
+        read_cache_mock = mock.MagicMock(return_value={'foo': 123})
+        migrate_mock = mock.MagicMock()
 
         with mock.patch('os.path.exists', path_exists_mock), \
-                mock.patch(mock_target, mock_open, create=True), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.read_cache', read_cache_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.migrate_legacy_cache', migrate_mock), \
                 mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespan', query_mock), \
-                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger', logger_mock), \
-                mock.patch('pickle.loads', pickle_mock):
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger', logger_mock):
             result = pdr.get_data_for_timespan('foobar',
                                                None,
                                                datetime.datetime(2014, 6, 10, hour=0, minute=0, second=0),
                                                datetime.datetime(2014, 6, 10, hour=23, minute=59, second=59),
                                                cache_dir='/tmp/cache')
-        assert path_exists_mock.call_count == 2
-        assert path_exists_mock.call_args_list == [mock.call('/tmp/cache'),
-                                                   mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.pickle')
-                                                   ]
-        assert mock_open.call_count == 1
-        fh = mock_open.return_value.__enter__.return_value
-        assert fh.read.call_count == 1
+        assert path_exists_mock.call_args_list == [mock.call('/tmp/cache')]
+        assert read_cache_mock.call_args == mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache')
+        assert migrate_mock.call_count == 0
         assert result == {'foo': 123}
-        assert fh.write.call_count == 0
         assert query_mock.call_count == 0
-        assert logger_mock.debug.call_count == 3
+        assert logger_mock.debug.call_count == 2
         assert logger_mock.info.call_count == 1
-        assert pickle_mock.call_count == 1
-        assert pickle_mock.call_args == mock.call(raw)
+
+    def test_legacy_cached(self):
+        """ data is cached in an old pickle file """
+        query_mock = mock.MagicMock()
+        read_cache_mock = mock.MagicMock(return_value=None)
+        migrate_mock = mock.MagicMock(return_value={'foo': 123})
+
+        with mock.patch('os.path.exists', mock.MagicMock(return_value=True)), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.read_cache', read_cache_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.migrate_legacy_cache', migrate_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespan', query_mock):
+            result = pdr.get_data_for_timespan('foobar',
+                                               None,
+                                               datetime.datetime(2014, 6, 10, hour=0, minute=0, second=0),
+                                               datetime.datetime(2014, 6, 10, hour=23, minute=59, second=59),
+                                               cache_dir='/tmp/cache')
+        assert migrate_mock.call_args == mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.pickle',
+                                                   '/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache')
+        assert result == {'foo': 123}
+        assert query_mock.call_count == 0
 
     def test_no_cachedir(self):
         """cache_dir doesn't exist, it gets created """
-        def path_join(*args):
-            return os.path.join(*args)
         os_mock = mock.MagicMock()
         os_mock.path.exists.return_value = False
         os_mock.makedirs.return_value = True
-        os_mock.path.join.side_effect = path_join
+        os_mock.path.join.side_effect = os.path.join
+        os_mock.path.splitext.side_effect = os.path.splitext
         query_mock = mock.MagicMock()
         query_mock.return_value = {"foo": 123}
         logger_mock = mock.MagicMock()
-        pickle_mock = mock.MagicMock()
-        pickle_mock.return_value = "(dp1\nS'foo'\np2\nI123\ns."
+        dumps_mock = mock.MagicMock()
+        dumps_mock.return_value = b'PDRC...'
+        lock_mock = mock.MagicMock()
 
         mock_open = mock.mock_open()
         if sys.version_info[0] == 3:
@@ -355,48 +917,65 @@ class Test_get_data_for_timespan:
 
         with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.os', os_mock), \
                 mock.patch(mock_target, mock_open, create=True), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.CacheLock', lock_mock), \
                 mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespan', query_mock), \
                 mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger', logger_mock), \
-                mock.patch('pickle.dumps', pickle_mock):
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.dumps_cache', dumps_mock):
             pdr.get_data_for_timespan('foobar',
                                       None,
                                       datetime.datetime(2014, 6, 10, hour=0, minute=0, second=0),
                                       datetime.datetime(2014, 6, 10, hour=23, minute=59, second=59),
                                       cache_dir='/tmp/cache')
-        assert os_mock.path.exists.call_count == 2
         assert os_mock.path.exists.call_args_list == [mock.call('/tmp/cache'),
-                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.pickle')
+                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache'),
+                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.pickle'),
+                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache'),
+                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.pickle'),
+                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache.partial'),
+                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache.partial')
                                                       ]
+        assert os_mock.remove.call_count == 0
         assert os_mock.makedirs.call_count == 1
         assert os_mock.makedirs.call_args == mock.call('/tmp/cache')
-        assert mock_open.call_count == 1
+        assert lock_mock.call_args == mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache.lock')
+        assert lock_mock.return_value.release.call_count == 1
+        tmp_fpath = mock_open.call_args[0][0]
+        assert tmp_fpath.startswith('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache.')
+        assert tmp_fpath.endswith('.tmp')
+        assert mock_open.call_args == mock.call(tmp_fpath, 'wb')
+        assert os_mock.replace.call_args == mock.call(tmp_fpath, '/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache')
         fh = mock_open.return_value.__enter__.return_value
         assert fh.read.call_count == 0
         assert fh.write.call_count == 1
-        assert fh.write.call_args == mock.call("(dp1\nS'foo'\np2\nI123\ns.")
+        assert fh.write.call_args == mock.call(b'PDRC...')
         assert query_mock.call_count == 1
         assert query_mock.call_args == mock.call(None,
                                                  datetime.datetime(2014, 6, 10, hour=0, minute=0, second=0),
-                                                 datetime.datetime(2014, 6, 10, hour=23, minute=59, second=59)
+                                                 datetime.datetime(2014, 6, 10, hour=23, minute=59, second=59),
+                                                 workers=1,
+                                                 engine='events',
+                                                 checkpoint=mock.ANY,
+                                                 facts=None
                                                  )
+        assert isinstance(query_mock.call_args[1]['checkpoint'], pdr.NodeCheckpoint)
         assert logger_mock.debug.call_count == 3
         assert logger_mock.info.call_count == 1
-        assert pickle_mock.call_count == 1
-        assert pickle_mock.call_args == mock.call({"foo": 123})
+        assert dumps_mock.call_count == 1
+        assert dumps_mock.call_args == mock.call({"foo": 123})
 
     def test_not_cached(self):
         """ data not cached """
-        def path_join(*args):
-            return os.path.join(*args)
         os_mock = mock.MagicMock()
         os_mock.path.exists.return_value = False
         os_mock.makedirs.return_value = True
-        os_mock.path.join.side_effect = path_join
+        os_mock.path.join.side_effect = os.path.join
+        os_mock.path.splitext.side_effect = os.path.splitext
         query_mock = mock.MagicMock()
         query_mock.return_value = {"foo": 123}
         logger_mock = mock.MagicMock()
-        pickle_mock = mock.MagicMock()
-        pickle_mock.return_value = "(dp1\nS'foo'\np2\nI123\ns."
+        dumps_mock = mock.MagicMock()
+        dumps_mock.return_value = b'PDRC...'
+        lock_mock = mock.MagicMock()
 
         mock_open = mock.mock_open()
         if sys.version_info[0] == 3:
@@ -406,32 +985,49 @@ class Test_get_data_for_timespan:
 
         with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.os', os_mock), \
                 mock.patch(mock_target, mock_open, create=True), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.CacheLock', lock_mock), \
                 mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespan', query_mock), \
                 mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger', logger_mock), \
-                mock.patch('pickle.dumps', pickle_mock):
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.dumps_cache', dumps_mock):
             pdr.get_data_for_timespan('foobar',
                                       None,
                                       datetime.datetime(2014, 6, 10, hour=0, minute=0, second=0),
                                       datetime.datetime(2014, 6, 10, hour=23, minute=59, second=59),
                                       cache_dir='/tmp/cache')
-        assert os_mock.path.exists.call_count == 2
         assert os_mock.path.exists.call_args_list == [mock.call('/tmp/cache'),
-                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.pickle')
+                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache'),
+                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.pickle'),
+                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache'),
+                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.pickle'),
+                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache.partial'),
+                                                      mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache.partial')
                                                       ]
-        assert mock_open.call_count == 1
+        assert os_mock.remove.call_count == 0
+        assert lock_mock.call_args == mock.call('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache.lock')
+        assert lock_mock.return_value.release.call_count == 1
+        tmp_fpath = mock_open.call_args[0][0]
+        assert tmp_fpath.startswith('/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache.')
+        assert tmp_fpath.endswith('.tmp')
+        assert mock_open.call_args == mock.call(tmp_fpath, 'wb')
+        assert os_mock.replace.call_args == mock.call(tmp_fpath, '/tmp/cache/data_foobar_2014-06-10_00-00-00_2014-06-10_23-59-59.cache')
         fh = mock_open.return_value.__enter__.return_value
         assert fh.read.call_count == 0
         assert fh.write.call_count == 1
-        assert fh.write.call_args == mock.call("(dp1\nS'foo'\np2\nI123\ns.")
+        assert fh.write.call_args == mock.call(b'PDRC...')
         assert query_mock.call_count == 1
         assert query_mock.call_args == mock.call(None,
                                                  datetime.datetime(2014, 6, 10, hour=0, minute=0, second=0),
-                                                 datetime.datetime(2014, 6, 10, hour=23, minute=59, second=59)
+                                                 datetime.datetime(2014, 6, 10, hour=23, minute=59, second=59),
+                                                 workers=1,
+                                                 engine='events',
+                                                 checkpoint=mock.ANY,
+                                                 facts=None
                                                  )
+        assert isinstance(query_mock.call_args[1]['checkpoint'], pdr.NodeCheckpoint)
         assert logger_mock.debug.call_count == 3
         assert logger_mock.info.call_count == 1
-        assert pickle_mock.call_count == 1
-        assert pickle_mock.call_args == mock.call({"foo": 123})
+        assert dumps_mock.call_count == 1
+        assert dumps_mock.call_args == mock.call({"foo": 123})
 
     def test_no_cache(self):
         """ caching disabled """
@@ -466,12 +1062,30 @@ class Test_get_data_for_timespan:
         assert query_mock.call_count == 1
         assert query_mock.call_args == mock.call(None,
                                                  datetime.datetime(2014, 6, 10, hour=0, minute=0, second=0),
-                                                 datetime.datetime(2014, 6, 10, hour=23, minute=59, second=59)
+                                                 datetime.datetime(2014, 6, 10, hour=23, minute=59, second=59),
+                                                 workers=1,
+                                                 engine='events',
+                                                 facts=None
                                                  )
         assert logger_mock.debug.call_count == 1
         assert logger_mock.info.call_count == 0
         assert pickle_mock.call_count == 0
 
+    def test_async_backend(self):
+        """ caching disabled, async backend """
+        query_mock = mock.MagicMock()
+        backend_mock = mock.MagicMock()
+        backend_mock.return_value.query_data_for_timespan.return_value = {"foo": 123}
+        start = datetime.datetime(2014, 6, 10, hour=0, minute=0, second=0)
+        end = datetime.datetime(2014, 6, 10, hour=23, minute=59, second=59)
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespan', query_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_async_backend', backend_mock):
+            foo = pdr.get_data_for_timespan('foobar', 'client', start, end, cache_dir=None, backend='async')
+        assert foo == {"foo": 123}
+        assert query_mock.call_count == 0
+        assert backend_mock.return_value.query_data_for_timespan.call_args == mock.call('client', start, end, facts=None)
+
 
 class Test_main:
     """ tests for main() function """
@@ -506,7 +1120,8 @@ class Test_main:
                  'Wed 06/04'
                  ]
 
-        pdb_mock = mock.MagicMock(spec='pypuppetdb.api.v3.API')
+        pdb_mock = mock.MagicMock()
+        pdb_mock.connection_stats.return_value = {'opened': 2, 'requests': 30, 'reused': 28}
         connect_mock = mock.MagicMock()
         connect_mock.return_value = pdb_mock
         format_html_mock = mock.MagicMock()
@@ -519,26 +1134,41 @@ class Test_main:
 
         dft_mock = mock.MagicMock()
         dft_mock.return_value = {'foo': 'bar'}
+        backfill_mock = mock.MagicMock(return_value={})
         with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_date_list', date_list_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_timespans', backfill_mock), \
                 mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger', logger_mock), \
-                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.connect', connect_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.PooledAPI', connect_mock), \
                 mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan', dft_mock), \
                 mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_html', format_html_mock), \
                 mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.send_mail', send_mail_mock), \
                 mock.patch('tzlocal.get_localzone', localzone_mock):
             pdr.main('foobar', to=['foo@example.com'])
         assert connect_mock.call_count == 1
-        assert connect_mock.call_args == mock.call(host='foobar')
+        assert connect_mock.call_args == mock.call(host='foobar', pool_size=10, connect_timeout=10, read_timeout=60,
+                                                   limiter=None)
+        assert mock.call.info("PuppetDB HTTP connections: 2 opened, 28 reused for 30 requests") in logger_mock.mock_calls
+
+        assert backfill_mock.call_count == 1
+        assert backfill_mock.call_args == mock.call('foobar', pdb_mock, [(FakeDatetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                                                                         (FakeDatetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                                                                         (FakeDatetime(2014, 6, 8, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 9, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                                                                         (FakeDatetime(2014, 6, 7, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 8, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                                                                         (FakeDatetime(2014, 6, 6, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 7, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                                                                         (FakeDatetime(2014, 6, 5, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 6, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                                                                         (FakeDatetime(2014, 6, 4, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 5, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                                                                         ],
+                                                    cache_dir=None, workers=1, cache_backend='files', facts=None)
 
         assert dft_mock.call_count == 7
         dft_expected = [
-            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None),
-            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None),
-            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 8, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 9, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None),
-            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 7, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 8, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None),
-            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 6, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 7, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None),
-            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 5, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 6, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None),
-            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 4, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 5, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None),
+            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None, workers=1, backend='sync', engine='events', cache_backend='files', facts=None),
+            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None, workers=1, backend='sync', engine='events', cache_backend='files', facts=None),
+            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 8, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 9, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None, workers=1, backend='sync', engine='events', cache_backend='files', facts=None),
+            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 7, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 8, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None, workers=1, backend='sync', engine='events', cache_backend='files', facts=None),
+            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 6, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 7, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None, workers=1, backend='sync', engine='events', cache_backend='files', facts=None),
+            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 5, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 6, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None, workers=1, backend='sync', engine='events', cache_backend='files', facts=None),
+            mock.call('foobar', pdb_mock, FakeDatetime(2014, 6, 4, hour=4, minute=0, second=0, tzinfo=pytz.utc), FakeDatetime(2014, 6, 5, hour=3, minute=59, second=59, tzinfo=pytz.utc), cache_dir=None, workers=1, backend='sync', engine='events', cache_backend='files', facts=None),
         ]
         assert dft_mock.mock_calls == dft_expected
 
@@ -553,6 +1183,1695 @@ class Test_main:
         assert send_mail_mock.call_count == 1
         assert send_mail_mock.call_args == mock.call(['foo@example.com'], 'daily puppet(db) run summary for foobar', 'foo bar baz', dry_run=False)
 
+    def test_async_backend(self):
+        """ with backend='async' """
+        connect_mock = mock.MagicMock()
+        backend_mock = mock.MagicMock()
+        client = backend_mock.return_value.AsyncPuppetDB.return_value
+        dft_mock = mock.MagicMock(return_value={'foo': 'bar'})
+        date_list = [FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)]
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_date_list', mock.MagicMock(return_value=date_list)), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.PooledAPI', connect_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_async_backend', backend_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan', dft_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_html', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.send_mail', mock.MagicMock()), \
+                mock.patch('tzlocal.get_localzone', mock.MagicMock(return_value=pytz.timezone('US/Eastern'))):
+            pdr.main('foobar', to=['foo@example.com'], backend='async', concurrency=20)
+        assert connect_mock.call_count == 0
+        assert backend_mock.return_value.AsyncPuppetDB.call_args == mock.call(host='foobar', concurrency=20, connect_timeout=10,
+                                                                              read_timeout=60)
+        assert dft_mock.call_args == mock.call('foobar', client,
+                                               FakeDatetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                                               FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc),
+                                               cache_dir=None, workers=1, backend='async', engine='events', cache_backend='files', facts=None)
+
+    def test_prefetched(self):
+        """ backfill returns data for some days """
+        date_list = [FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc),
+                     FakeDatetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc),
+                     FakeDatetime(2014, 6, 9, hour=3, minute=59, second=59, tzinfo=pytz.utc),
+                     ]
+        day1 = (FakeDatetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc))
+        day3 = (FakeDatetime(2014, 6, 8, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                FakeDatetime(2014, 6, 9, hour=3, minute=59, second=59, tzinfo=pytz.utc))
+        backfill_mock = mock.MagicMock(return_value={day1: {'day': 1}, day3: {'day': 3}})
+        dft_mock = mock.MagicMock(return_value={'day': 2})
+        format_html_mock = mock.MagicMock()
+
+        prune_mock = mock.MagicMock()
+        compact_mock = mock.MagicMock()
+        manifest_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_date_list', mock.MagicMock(return_value=date_list)), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.PooledAPI', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_timespans', backfill_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan', dft_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_html', format_html_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.send_mail', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.prune_cache', prune_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.compact_cache', compact_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.CacheManifest', manifest_mock), \
+                mock.patch('tzlocal.get_localzone', mock.MagicMock(return_value=pytz.timezone('US/Eastern'))):
+            pdr.main('foobar', to=['foo@example.com'], num_days=3, cache_dir='/tmp/cache')
+        assert compact_mock.call_args == mock.call('/tmp/cache', 14)
+        day2 = (FakeDatetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                FakeDatetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc))
+        assert prune_mock.call_args == mock.call('/tmp/cache', max_age=365, max_bytes=None, max_files=None,
+                                                 keep=[('foobar',) + day1, ('foobar',) + day2, ('foobar',) + day3],
+                                                 bucket_max_age=31)
+        assert manifest_mock.call_args == mock.call('/tmp/cache')
+        assert manifest_mock.return_value.save.call_count == 1
+        assert backfill_mock.call_count == 1
+        assert dft_mock.call_count == 1
+        assert dft_mock.call_args[0][2] == FakeDatetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        assert format_html_mock.call_args[0][1] == ['Tue 06/10', 'Mon 06/09', 'Sun 06/08']
+        assert format_html_mock.call_args[0][2] == {'Tue 06/10': {'day': 1}, 'Mon 06/09': {'day': 2}, 'Sun 06/08': {'day': 3}}
+
+    def test_no_backfill(self):
+        """ backfill disabled """
+        date_list = [FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc),
+                     FakeDatetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc),
+                     ]
+        backfill_mock = mock.MagicMock(return_value={})
+        dft_mock = mock.MagicMock(return_value={'day': 2})
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_date_list', mock.MagicMock(return_value=date_list)), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.PooledAPI', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_timespans', backfill_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan', dft_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_html', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.send_mail', mock.MagicMock()), \
+                mock.patch('tzlocal.get_localzone', mock.MagicMock(return_value=pytz.timezone('US/Eastern'))):
+            pdr.main('foobar', to=['foo@example.com'], num_days=2, backfill=False)
+        assert backfill_mock.call_count == 0
+        assert dft_mock.call_count == 2
+
+    def test_facts(self):
+        """ facts are passed down, leaving the default FACTS alone """
+        date_list = [FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)]
+        backfill_mock = mock.MagicMock(return_value={})
+        dft_mock = mock.MagicMock()
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_date_list', mock.MagicMock(return_value=date_list)), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.PooledAPI', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_timespans', backfill_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan', dft_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_html', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.send_mail', mock.MagicMock()), \
+                mock.patch('tzlocal.get_localzone', mock.MagicMock(return_value=pytz.timezone('US/Eastern'))):
+            pdr.main('foobar', to=['foo@example.com'], num_days=1, facts=['kernel'])
+        assert backfill_mock.call_args[1]['facts'] == ['kernel']
+        assert dft_mock.call_args[1]['facts'] == ['kernel']
+        assert pdr.FACTS == ['puppetversion', 'facterversion', 'lsbdistdescription']
+
+    def test_event_counts_engine(self):
+        """ engine is passed through, and backfill isn't used """
+        date_list = [FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)]
+        backfill_mock = mock.MagicMock(return_value={})
+        dft_mock = mock.MagicMock(return_value={'day': 1})
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_date_list', mock.MagicMock(return_value=date_list)), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.PooledAPI', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_timespans', backfill_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan', dft_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_html', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.send_mail', mock.MagicMock()), \
+                mock.patch('tzlocal.get_localzone', mock.MagicMock(return_value=pytz.timezone('US/Eastern'))):
+            pdr.main('foobar', to=['foo@example.com'], num_days=1, engine='event-counts')
+        assert backfill_mock.call_count == 0
+        assert dft_mock.call_args[1]['engine'] == 'event-counts'
+
+    def test_parallel_days(self):
+        """ days not backfilled are fetched concurrently, and kept in date order """
+        date_list = [FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc),
+                     FakeDatetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc),
+                     FakeDatetime(2014, 6, 9, hour=3, minute=59, second=59, tzinfo=pytz.utc),
+                     ]
+        prefetched = {(FakeDatetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                       FakeDatetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc)): {'day': 'mon'}}
+        backfill_mock = mock.MagicMock(return_value=prefetched)
+
+        def dft(hostname, pdb, start, end, **kwargs):
+            return {'day': start.strftime('%a').lower()}
+
+        dft_mock = mock.MagicMock(side_effect=dft)
+        format_html_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_date_list', mock.MagicMock(return_value=date_list)), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.PooledAPI', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_timespans', backfill_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan', dft_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_html', format_html_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.send_mail', mock.MagicMock()), \
+                mock.patch('tzlocal.get_localzone', mock.MagicMock(return_value=pytz.timezone('US/Eastern'))):
+            pdr.main('foobar', to=['foo@example.com'], num_days=3, parallel_days=3)
+        assert dft_mock.call_count == 2
+        dates, date_data = format_html_mock.call_args[0][1:3]
+        assert dates == ['Tue 06/10', 'Mon 06/09', 'Sun 06/08']
+        assert [date_data[d]['day'] for d in dates] == ['tue', 'mon', 'sun']
+
+    def test_adaptive(self):
+        """ with adaptive, PooledAPI gets an AdaptiveLimiter bounded by the pool size """
+        date_list = [FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)]
+        connect_mock = mock.MagicMock()
+        logger_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_date_list', mock.MagicMock(return_value=date_list)), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.PooledAPI', connect_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_timespans', mock.MagicMock(return_value={})), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_html', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.send_mail', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger', logger_mock), \
+                mock.patch('tzlocal.get_localzone', mock.MagicMock(return_value=pytz.timezone('US/Eastern'))):
+            connect_mock.return_value.connection_stats.return_value = {'opened': 1, 'requests': 1, 'reused': 0}
+            connect_mock.return_value.limiter = pdr.AdaptiveLimiter(8)
+            pdr.main('foobar', to=['foo@example.com'], num_days=1, pool_size=8, adaptive=True, command_queue_limit=500)
+        limiter = connect_mock.call_args[1]['limiter']
+        assert isinstance(limiter, pdr.AdaptiveLimiter)
+        assert limiter.max_limit == 8
+        assert limiter.command_queue_limit == 500
+        assert mock.call.info("adaptive concurrency limit ended at 4 of 8; backed off 0 times") in logger_mock.mock_calls
+
+    def test_event_cache(self):
+        """ with a cache_dir, an EventCache is set up on the client for the run and closed after """
+        date_list = [FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)]
+        event_cache_mock = mock.MagicMock()
+        seen = []
+        dft_mock = mock.MagicMock(side_effect=lambda hostname, pdb, *args, **kwargs: seen.append((pdb.event_cache, pdb.cache_manifest)))
+        prune_mock = mock.MagicMock()
+        compact_mock = mock.MagicMock()
+        manifest_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_date_list', mock.MagicMock(return_value=date_list)), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.PooledAPI', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_timespans', mock.MagicMock(return_value={})), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan', dft_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_html', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.send_mail', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.EventCache', event_cache_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.prune_cache', prune_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.compact_cache', compact_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.CacheManifest', manifest_mock), \
+                mock.patch('tzlocal.get_localzone', mock.MagicMock(return_value=pytz.timezone('US/Eastern'))):
+            pdr.main('foobar', to=['foo@example.com'], num_days=1, cache_dir='/tmp/cache')
+            pdr.main('foobar', to=['foo@example.com'], num_days=1)
+        assert event_cache_mock.call_args_list == [mock.call('/tmp/cache/events_foobar.pickle')]
+        assert seen == [(event_cache_mock.return_value, manifest_mock.return_value), (None, None)]
+        assert event_cache_mock.return_value.compact.call_args_list == [mock.call(max_age=365)]
+        assert event_cache_mock.return_value.close.call_count == 1
+
+    def test_sqlite_cache(self):
+        """ with the sqlite cache backend, cached days are read in one go and not backfilled or queried """
+        date_list = [FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc),
+                     FakeDatetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc)]
+        day1 = (FakeDatetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc))
+        day2 = (FakeDatetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                FakeDatetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc))
+        cache_mock = mock.MagicMock()
+        cache_mock.return_value.read_days.return_value = {day2: {'day': 2}}
+        backfill_mock = mock.MagicMock(return_value={})
+        dft_mock = mock.MagicMock(return_value={'day': 1})
+        format_html_mock = mock.MagicMock()
+        prune_mock = mock.MagicMock()
+        compact_mock = mock.MagicMock()
+        manifest_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_date_list', mock.MagicMock(return_value=date_list)), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.PooledAPI', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_timespans', backfill_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan', dft_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_html', format_html_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.send_mail', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.EventCache', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.SQLiteCache', cache_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.prune_cache', prune_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.compact_cache', compact_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.CacheManifest', manifest_mock), \
+                mock.patch('tzlocal.get_localzone', mock.MagicMock(return_value=pytz.timezone('US/Eastern'))):
+            pdr.main('foobar', to=['foo@example.com'], num_days=2, cache_dir='/tmp/cache', cache_backend='sqlite')
+        assert cache_mock.call_args_list == [mock.call('/tmp/cache/pypuppetdb_daily_report.sqlite')]
+        assert cache_mock.return_value.read_days.call_args == mock.call('foobar', [day1, day2])
+        assert manifest_mock.return_value.record_hit.call_args_list == [mock.call('foobar', day2[0], day2[1], 'sqlite')]
+        assert backfill_mock.call_args == mock.call('foobar', mock.ANY, [day1], cache_dir='/tmp/cache', workers=1,
+                                                    cache_backend='sqlite', facts=None)
+        assert dft_mock.call_args_list == [mock.call('foobar', mock.ANY, day1[0], day1[1], cache_dir='/tmp/cache', workers=1,
+                                                     backend='sync', engine='events', cache_backend='sqlite', facts=None)]
+        assert format_html_mock.call_args[0][2] == {'Tue 06/10': {'day': 1}, 'Mon 06/09': {'day': 2}}
+
+
+class Test_main_windows:
+    """ main() building its data from buckets """
+
+    def test_window(self):
+        window = (FakeDatetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                  FakeDatetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc))
+        windows_mock = mock.MagicMock(return_value=[{'day': 1}])
+        dft_mock = mock.MagicMock()
+        format_html_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.PooledAPI', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_windows', windows_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan', dft_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_html', format_html_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.send_mail', mock.MagicMock()):
+            pdr.main('foobar', to=['foo@example.com'], window=window, timezone='America/New_York')
+        assert windows_mock.call_args == mock.call('foobar', mock.ANY, [window], cache_dir=None, workers=1,
+                                                   cache_backend='files', facts=None)
+        assert dft_mock.call_count == 0
+        assert format_html_mock.call_args[0][1:] == (['06/10 00:00 - 06/11 00:00'], {'06/10 00:00 - 06/11 00:00': {'day': 1}},
+                                                     window[1], window[0])
+
+    def test_hour_granularity(self):
+        """ days in another timezone, built from buckets """
+        windows_mock = mock.MagicMock(return_value=[{'day': 1}, {'day': 2}])
+        backfill_mock = mock.MagicMock()
+        format_html_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.PooledAPI', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_windows', windows_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_timespans', backfill_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.format_html', format_html_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.send_mail', mock.MagicMock()), \
+                freeze_time("2014-06-11 08:15:43"):
+            pdr.main('foobar', to=['foo@example.com'], num_days=2, timezone='Asia/Tokyo', cache_granularity='hour')
+        assert windows_mock.call_args[0][2] == [
+            (datetime.datetime(2014, 6, 9, hour=15, tzinfo=pytz.utc),
+             datetime.datetime(2014, 6, 10, hour=14, minute=59, second=59, tzinfo=pytz.utc)),
+            (datetime.datetime(2014, 6, 8, hour=15, tzinfo=pytz.utc),
+             datetime.datetime(2014, 6, 9, hour=14, minute=59, second=59, tzinfo=pytz.utc))]
+        assert backfill_mock.call_count == 0
+        assert format_html_mock.call_args[0][1:3] == (['Tue 06/10', 'Mon 06/09'], {'Tue 06/10': {'day': 1}, 'Mon 06/09': {'day': 2}})
+
+
+class Test_NodeCheckpoint:
+    """ tests for NodeCheckpoint """
+
+    def test_add_and_load(self, tmpdir):
+        fpath = str(tmpdir.join('data.pickle.partial'))
+        cp = pdr.NodeCheckpoint(fpath)
+        assert cp.nodes == {}
+        assert not os.path.exists(fpath)
+        cp.add('node1', {'reports': {'run_count': 1}})
+        cp.add('node2', {'reports': {'run_count': 2}})
+        cp.close()
+        cp = pdr.NodeCheckpoint(fpath)
+        assert cp.nodes == {'node1': {'reports': {'run_count': 1}}, 'node2': {'reports': {'run_count': 2}}}
+        cp.add('node3', {'reports': {'run_count': 3}})
+        cp.close()
+        assert sorted(pdr.NodeCheckpoint(fpath).nodes.keys()) == ['node1', 'node2', 'node3']
+
+    def test_truncated(self, tmpdir):
+        """ a record cut short by a crash is dropped, and later records still load """
+        fpath = str(tmpdir.join('data.pickle.partial'))
+        cp = pdr.NodeCheckpoint(fpath)
+        cp.add('node1', {'foo': 1})
+        cp.close()
+        size = os.path.getsize(fpath)
+        with open(fpath, 'ab') as fh:
+            fh.write(pickle.dumps(('node2', {'foo': 2}), pickle.HIGHEST_PROTOCOL)[:-5])
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger') as logger_mock:
+            cp = pdr.NodeCheckpoint(fpath)
+        assert cp.nodes == {'node1': {'foo': 1}}
+        assert logger_mock.warning.call_count == 1
+        assert os.path.getsize(fpath) == size
+        cp.add('node3', {'foo': 3})
+        cp.close()
+        assert pdr.NodeCheckpoint(fpath).nodes == {'node1': {'foo': 1}, 'node3': {'foo': 3}}
+
+    def test_threads(self, tmpdir):
+        fpath = str(tmpdir.join('data.pickle.partial'))
+        cp = pdr.NodeCheckpoint(fpath)
+        pool = ThreadPool(4)
+        pool.map(lambda i: cp.add('node{i}'.format(i=i), {'i': i}), range(50))
+        pool.close()
+        pool.join()
+        cp.close()
+        assert pdr.NodeCheckpoint(fpath).nodes == dict(('node{i}'.format(i=i), {'i': i}) for i in range(50))
+
+    def test_remove(self, tmpdir):
+        fpath = str(tmpdir.join('data.pickle.partial'))
+        cp = pdr.NodeCheckpoint(fpath)
+        cp.remove()
+        cp.add('node1', {'foo': 1})
+        cp.remove()
+        assert not os.path.exists(fpath)
+        assert cp.fh is None
+
+    def test_checkpoint_path(self):
+        assert pdr.checkpoint_path('/tmp/cache/foo.pickle') == '/tmp/cache/foo.pickle.partial'
+
+
+class Test_get_data_for_timespan_sqlite:
+    """ get_data_for_timespan() with the sqlite cache backend """
+
+    start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+    end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+
+    def test_round_trip(self, tmpdir):
+        data = Test_SQLiteCache().day_data()
+        query_mock = mock.MagicMock(return_value=data)
+        cache_dir = str(tmpdir)
+        manifest = pdr.CacheManifest(cache_dir)
+        pdb_mock = mock.MagicMock()
+        pdb_mock.cache_manifest = manifest
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespan', query_mock):
+            foo = pdr.get_data_for_timespan('foobar', pdb_mock, self.start, self.end, cache_dir=cache_dir, cache_backend='sqlite')
+            bar = pdr.get_data_for_timespan('foobar', pdb_mock, self.start, self.end, cache_dir=cache_dir, cache_backend='sqlite')
+        assert query_mock.call_count == 1
+        assert foo == data
+        assert bar == data
+        assert sorted(os.listdir(cache_dir)) == ['pypuppetdb_daily_report.sqlite']
+        assert manifest.counts == {'foobar': {'hits': 1, 'misses': 1}}
+        entry = manifest.entries['data_foobar_2014-06-10_04-00-00_2014-06-11_03-59-59.cache']
+        assert entry['backend'] == 'sqlite'
+        assert entry['schema'] == pdr.SQLITE_SCHEMA_VERSION
+        assert entry['hits'] == 1
+
+
+class Test_get_data_for_timespan_resume:
+    """ an interrupted fetch resumes from its checkpoint """
+
+    def test_resume(self, tmpdir):
+        nodes = []
+        for name in ['node1', 'node2', 'node3']:
+            node = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+            node.name = name
+            nodes.append(node)
+        pdb_mock = mock.MagicMock(spec=pypuppetdb.api.v3.API, autospec=True)
+        pdb_mock.nodes.side_effect = lambda: iter(nodes)
+        start = datetime.datetime(2014, 6, 7, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 8, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+        cache_dir = str(tmpdir)
+        cache_fpath = pdr.cache_path(cache_dir, 'foobar', start, end)
+
+        def interrupted(pdb, node, start, end, has_events=True):
+            if node.name == 'node3':
+                raise requests.exceptions.ConnectionError("PuppetDB restarting")
+            return {'reports': {'name': node.name}}
+
+        query_node_mock = mock.MagicMock(side_effect=interrupted)
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_node', query_node_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.aggregate_data_for_timespan', mock.MagicMock()), \
+                pytest.raises(requests.exceptions.ConnectionError):
+            pdr.get_data_for_timespan('foobar', pdb_mock, start, end, cache_dir=cache_dir)
+        assert os.path.exists(pdr.checkpoint_path(cache_fpath))
+        assert not os.path.exists(cache_fpath)
+
+        query_node_mock = mock.MagicMock(return_value={'reports': {'name': 'node3'}})
+        write_cache_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_node', query_node_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.aggregate_data_for_timespan', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.write_cache', write_cache_mock):
+            foo = pdr.get_data_for_timespan('foobar', pdb_mock, start, end, cache_dir=cache_dir)
+        assert query_node_mock.call_args_list == [mock.call(pdb_mock, nodes[2], start, end, has_events=False)]
+        assert foo['nodes'] == {'node1': {'reports': {'name': 'node1'}},
+                                'node2': {'reports': {'name': 'node2'}},
+                                'node3': {'reports': {'name': 'node3'}},
+                                }
+        assert write_cache_mock.call_args == mock.call(cache_fpath, foo)
+        assert not os.path.exists(pdr.checkpoint_path(cache_fpath))
+
+
+class Test_get_data_for_timespan_locking:
+    """ concurrent runs sharing a cache_dir build each day once """
+
+    start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+    end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+
+    def test_waits_for_build(self, tmpdir):
+        """ a day being built by another run is waited for, then read from the cache """
+        cache_dir = str(tmpdir)
+        cache_fpath = pdr.cache_path(cache_dir, 'foobar', self.start, self.end)
+        other = pdr.CacheLock(pdr.lock_path(cache_fpath))
+        assert other.acquire() is True
+        query_mock = mock.MagicMock()
+        res = []
+
+        def run():
+            res.append(pdr.get_data_for_timespan('foobar', None, self.start, self.end, cache_dir=cache_dir))
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespan', query_mock):
+            t = threading.Thread(target=run)
+            t.start()
+            t.join(0.5)
+            assert t.is_alive()
+            pdr.write_cache(cache_fpath, {'nodes': {}, 'foo': 'bar'})
+            other.release()
+            t.join(5)
+        assert res == [{'nodes': {}, 'foo': 'bar'}]
+        assert query_mock.call_count == 0
+        assert sorted(os.listdir(cache_dir)) == [os.path.basename(cache_fpath)]
+
+    def test_releases_on_error(self, tmpdir):
+        cache_dir = str(tmpdir)
+        cache_fpath = pdr.cache_path(cache_dir, 'foobar', self.start, self.end)
+        query_mock = mock.MagicMock(side_effect=requests.exceptions.ConnectionError("foo"))
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespan', query_mock), \
+                pytest.raises(requests.exceptions.ConnectionError):
+            pdr.get_data_for_timespan('foobar', None, self.start, self.end, cache_dir=cache_dir)
+        assert not os.path.exists(pdr.lock_path(cache_fpath))
+        assert pdr.CacheLock(pdr.lock_path(cache_fpath)).acquire(blocking=False) is True
+
+
+class Test_CacheLock:
+
+    def test_exclusive(self, tmpdir):
+        fpath = str(tmpdir.join('foo.lock'))
+        one = pdr.CacheLock(fpath)
+        two = pdr.CacheLock(fpath)
+        assert one.acquire(blocking=False) is True
+        assert os.path.exists(fpath)
+        assert two.acquire(blocking=False) is False
+        one.release()
+        assert not os.path.exists(fpath)
+        assert two.acquire(blocking=False) is True
+        two.release()
+        two.release()
+
+    def test_blocking(self, tmpdir):
+        """ a waiter gets the lock once the holder releases it, though the file was removed """
+        fpath = str(tmpdir.join('foo.lock'))
+        one = pdr.CacheLock(fpath)
+        one.acquire()
+        order = []
+
+        def wait():
+            with pdr.CacheLock(fpath) as two:
+                order.append('two')
+                assert two.fh is not None
+                assert pdr.CacheLock(fpath).acquire(blocking=False) is False
+        t = threading.Thread(target=wait)
+        t.start()
+        t.join(0.3)
+        order.append('one')
+        one.release()
+        t.join(5)
+        assert order == ['one', 'two']
+        assert os.listdir(str(tmpdir)) == []
+
+    def test_no_fcntl(self, tmpdir):
+        fpath = str(tmpdir.join('foo.lock'))
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.fcntl', None):
+            assert pdr.CacheLock(fpath).acquire(blocking=False) is True
+            assert pdr.CacheLock(fpath).acquire(blocking=False) is True
+        assert os.listdir(str(tmpdir)) == []
+
+
+class Test_write_file_atomic:
+
+    def test_write(self, tmpdir):
+        fpath = str(tmpdir.join('foo'))
+        pdr.write_file_atomic(fpath, b'foo')
+        pdr.write_file_atomic(fpath, b'bar')
+        assert os.listdir(str(tmpdir)) == ['foo']
+        with open(fpath, 'rb') as fh:
+            assert fh.read() == b'bar'
+
+    def test_failed_write(self, tmpdir):
+        """ the old file is left as it was, and the temporary file removed """
+        fpath = str(tmpdir.join('foo'))
+        pdr.write_file_atomic(fpath, b'foo')
+        with mock.patch('os.fsync', mock.MagicMock(side_effect=OSError("disk full"))), \
+                pytest.raises(OSError):
+            pdr.write_file_atomic(fpath, b'bar')
+        assert os.listdir(str(tmpdir)) == ['foo']
+        with open(fpath, 'rb') as fh:
+            assert fh.read() == b'foo'
+
+
+class Test_get_data_for_timespans:
+
+    timespans = [(datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                  datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                 (datetime.datetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                  datetime.datetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                 (datetime.datetime(2014, 6, 8, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                  datetime.datetime(2014, 6, 9, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                 ]
+
+    @pytest.mark.parametrize('parallel_days', [1, 2, 5])
+    def test_order(self, parallel_days):
+        pdb_mock = mock.MagicMock()
+
+        def dft(hostname, pdb, start, end, **kwargs):
+            assert hostname == 'foo'
+            assert pdb is pdb_mock
+            assert kwargs == {'cache_dir': '/tmp', 'workers': 2}
+            return start.day
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan',
+                        mock.MagicMock(side_effect=dft)):
+            foo = pdr.get_data_for_timespans('foo', pdb_mock, self.timespans, parallel_days=parallel_days,
+                                             cache_dir='/tmp', workers=2)
+        assert foo == [10, 9, 8]
+
+    def test_empty(self):
+        dft_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_data_for_timespan', dft_mock):
+            assert pdr.get_data_for_timespans('foo', mock.MagicMock(), [], parallel_days=4) == []
+        assert dft_mock.call_count == 0
+
+
+class Test_cache_format:
+    """ tests for the day cache file format """
+
+    def day_data(self):
+        data = deepcopy(test_data.FINAL_DATA['Tue 06/10'])
+        data['aggregate'] = pdr.aggregate_data_for_timespan(data)
+        data['metrics']['Nodes'] = {'path': 'foo', 'order': 2, 'formatted': 2, 'api_response': {'Value': 2.0}}
+        return data
+
+    @pytest.mark.parametrize('compression', [None, 'gzip', 'zstd'])
+    def test_round_trip(self, compression):
+        data = self.day_data()
+        raw = pdr.dumps_cache(data, compression=compression)
+        assert raw[:4] == b'PDRC'
+        assert pdr.loads_cache(raw) == data
+
+    def test_compression_header(self):
+        data = self.day_data()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.CACHE_COMPRESSION', None):
+            raw = pdr.dumps_cache(data)
+        assert pdr.CACHE_HEADER.unpack(raw[:pdr.CACHE_HEADER.size]) == (b'PDRC', pdr.CACHE_SCHEMA_VERSION, 0)
+        assert pdr.CACHE_HEADER.unpack(pdr.dumps_cache(data, compression='gzip')[:pdr.CACHE_HEADER.size])[2] == 1
+        # without the zstandard package, zstd falls back to gzip
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.zstandard', None):
+            raw = pdr.dumps_cache(data, compression='zstd')
+        assert pdr.CACHE_HEADER.unpack(raw[:pdr.CACHE_HEADER.size])[2] == 1
+        assert pdr.loads_cache(raw) == data
+
+    def test_smaller_than_pickle(self):
+        data = self.day_data()
+        # a fleet of a few hundred nodes, so the per-section overhead doesn't dominate
+        for i in range(50):
+            for node in test_data.FINAL_DATA['Tue 06/10']['nodes']:
+                data['nodes']['{i}{node}'.format(i=i, node=node)] = data['nodes'][node]
+        assert len(pdr.dumps_cache(data, compression='gzip')) < len(pickle.dumps(data)) / 2
+
+    def test_lazy_sections(self):
+        """ each section is only decoded when it's first used; the node count needs none """
+        data = self.day_data()
+        foo = pdr.loads_cache(pdr.dumps_cache(data, compression='gzip'))
+        assert isinstance(foo, pdr.LazyDayData)
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.decode_cache_data',
+                        wraps=pdr.decode_cache_data) as decode_mock:
+            assert sorted(foo.keys()) == ['aggregate', 'facts', 'metrics', 'nodes']
+            assert 'aggregate' in foo
+            assert 'foo' not in foo
+            assert len(foo['nodes']) == 6
+            assert decode_mock.call_count == 0
+            assert foo['aggregate'] == data['aggregate']
+            assert foo['aggregate'] is foo['aggregate']
+            assert decode_mock.call_count == 1
+            assert foo['nodes']['node1.example.com'] == data['nodes']['node1.example.com']
+            assert sorted(foo['nodes']) == sorted(data['nodes'])
+            assert decode_mock.call_count == 2
+            with pytest.raises(KeyError):
+                foo['foo']
+
+    def test_format_html_lazy(self):
+        """ the report renders the same from a LazyDayData, without decoding its nodes """
+        data = self.day_data()
+        dates = ['Wed 06/11', 'Tue 06/10']
+        start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+        lazy = pdr.loads_cache(pdr.dumps_cache(data))
+        with freeze_time("2014-06-11 08:15:43"):
+            full = pdr.format_html('foo', dates, {dates[0]: data, dates[1]: data}, start, end)
+            foo = pdr.format_html('foo', dates, {dates[0]: data, dates[1]: lazy}, start, end)
+        assert foo == full
+        assert 'aggregate' in lazy.loaded
+        assert lazy['nodes'].nodes is None
+
+    def test_truncated(self):
+        raw = pdr.dumps_cache(self.day_data(), compression='gzip')
+        with pytest.raises(ValueError) as excinfo:
+            pdr.loads_cache(raw[:-10])
+        assert str(excinfo.value) == 'file is truncated'
+
+    def test_schema_version_1(self):
+        """ files written with schema version 1, the whole day in one JSON body, can still be read """
+        data = self.day_data()
+        body = json.dumps(pdr.encode_cache_data(data)).encode('utf-8')
+        foo = pdr.loads_cache(pdr.CACHE_HEADER.pack(b'PDRC', 1, 0) + body)
+        assert foo == data
+
+    def test_string_table(self):
+        doc = pdr.encode_cache_data({'nodes': {'node1': {'reports': {'run_count': 1,
+                                                                     'run_time_total': datetime.timedelta(seconds=1, microseconds=5)},
+                                                         'resources': {'failed': {('Package', 'foo'): 2},
+                                                                       'changed': {('Package', 'bar'): 1}}}}})
+        assert doc['nodes']['node1']['reports'] == {'run_count': 1, 'run_time_total': 1000005}
+        failed = doc['nodes']['node1']['resources']['failed']
+        changed = doc['nodes']['node1']['resources']['changed']
+        assert [doc['strings'][failed[0]], doc['strings'][failed[1]], failed[2]] == ['Package', 'foo', 2]
+        assert [doc['strings'][changed[0]], doc['strings'][changed[1]], changed[2]] == ['Package', 'bar', 1]
+        assert sorted(doc['strings']) == ['Package', 'bar', 'foo']
+
+    @pytest.mark.parametrize('raw,msg', [(b'PD', 'file is too short'),
+                                         (b'(dp1\nS\'foo\'\np2\nI123\ns.', 'not a cache file'),
+                                         (pdr.CACHE_HEADER.pack(b'PDRC', pdr.CACHE_SCHEMA_VERSION + 1, 0) + b'{}',
+                                          'schema version {v}, not {cur}'.format(v=pdr.CACHE_SCHEMA_VERSION + 1,
+                                                                                 cur=pdr.CACHE_SCHEMA_VERSION)),
+                                         (pdr.CACHE_HEADER.pack(b'PDRC', pdr.CACHE_SCHEMA_VERSION, 9) + b'{}', 'unknown compression 9'),
+                                         ])
+    def test_invalid(self, raw, msg):
+        with pytest.raises(ValueError) as excinfo:
+            pdr.loads_cache(raw)
+        assert str(excinfo.value) == msg
+
+    def test_zstd_not_installed(self):
+        raw = pdr.CACHE_HEADER.pack(b'PDRC', pdr.CACHE_SCHEMA_VERSION, 2) + b'foo'
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.zstandard', None), \
+                pytest.raises(ValueError):
+            pdr.loads_cache(raw)
+
+    def test_write_and_read(self, tmpdir):
+        data = self.day_data()
+        fpath = str(tmpdir.join('data.cache'))
+        assert pdr.read_cache(fpath) is None
+        pdr.write_cache(fpath, data)
+        assert pdr.read_cache(fpath) == data
+
+    def test_read_old_schema(self, tmpdir):
+        """ a file written with another schema version is ignored, so it's queried again """
+        fpath = str(tmpdir.join('data.cache'))
+        with open(fpath, 'wb') as fh:
+            fh.write(pdr.CACHE_HEADER.pack(b'PDRC', 0, 0) + b'{}')
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger') as logger_mock:
+            assert pdr.read_cache(fpath) is None
+        assert logger_mock.warning.call_count == 1
+
+    def test_migrate_legacy(self, tmpdir):
+        data = self.day_data()
+        legacy = str(tmpdir.join('data.pickle'))
+        fpath = str(tmpdir.join('data.cache'))
+        assert pdr.migrate_legacy_cache(legacy, fpath) is None
+        with open(legacy, 'wb') as fh:
+            fh.write(pickle.dumps(data))
+        assert pdr.migrate_legacy_cache(legacy, fpath) == data
+        assert not os.path.exists(legacy)
+        assert pdr.read_cache(fpath) == data
+
+    def test_migrate_legacy_unreadable(self, tmpdir):
+        legacy = str(tmpdir.join('data.pickle'))
+        with open(legacy, 'wb') as fh:
+            fh.write(b'garbage')
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger'):
+            assert pdr.migrate_legacy_cache(legacy, str(tmpdir.join('data.cache'))) is None
+        assert os.path.exists(legacy)
+
+    def test_paths(self, tmpdir):
+        start = datetime.datetime(2014, 6, 10, hour=0, minute=0, second=0)
+        end = datetime.datetime(2014, 6, 10, hour=23, minute=59, second=59)
+        assert pdr.cache_path('/tmp', 'foo', start, end) == '/tmp/data_foo_2014-06-10_00-00-00_2014-06-10_23-59-59.cache'
+        assert pdr.legacy_cache_path('/tmp', 'foo', start, end) == '/tmp/data_foo_2014-06-10_00-00-00_2014-06-10_23-59-59.pickle'
+        assert pdr.is_cached(str(tmpdir), 'foo', start, end) is False
+        tmpdir.join('data_foo_2014-06-10_00-00-00_2014-06-10_23-59-59.pickle').write('')
+        assert pdr.is_cached(str(tmpdir), 'foo', start, end) is True
+
+
+class Test_SQLiteCache:
+    """ tests for the SQLite day data cache """
+
+    start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+    end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+
+    def day_data(self):
+        data = deepcopy(test_data.FINAL_DATA['Tue 06/10'])
+        # as from query_data_for_node(), every node has all three resource statuses
+        for node in data['nodes']:
+            for status in ['failed', 'changed', 'skipped']:
+                data['nodes'][node]['resources'].setdefault(status, {})
+        data['aggregate'] = pdr.aggregate_data_for_timespan(data)
+        data['metrics']['Nodes'] = {'path': 'foo', 'order': 2, 'formatted': 2, 'api_response': {'Value': 2.0}}
+        return data
+
+    def test_round_trip(self, tmpdir):
+        data = self.day_data()
+        cache = pdr.SQLiteCache(pdr.sqlite_cache_path(str(tmpdir)))
+        assert cache.read_day('foobar', self.start, self.end) is None
+        cache.write_day('foobar', self.start, self.end, data)
+        assert cache.read_day('foobar', self.start, self.end) == data
+        assert cache.read_day('bazbar', self.start, self.end) is None
+        assert os.path.exists(str(tmpdir.join('pypuppetdb_daily_report.sqlite')))
+
+    def test_new_cache_dir(self, tmpdir):
+        """ the cache dir is created if it doesn't exist yet, even just to read """
+        cache = pdr.SQLiteCache(pdr.sqlite_cache_path(str(tmpdir.join('new', 'cache'))))
+        assert cache.read_days('foobar', [(self.start, self.end)]) == {}
+        assert os.path.isdir(str(tmpdir.join('new', 'cache')))
+        cache.write_day('foobar', self.start, self.end, self.day_data())
+        assert cache.read_day('foobar', self.start, self.end) == self.day_data()
+
+    def test_no_metrics_or_facts(self, tmpdir):
+        data = self.day_data()
+        del data['metrics']
+        del data['facts']
+        cache = pdr.SQLiteCache(pdr.sqlite_cache_path(str(tmpdir)))
+        cache.write_day('foobar', self.start, self.end, data)
+        assert cache.read_day('foobar', self.start, self.end) == data
+
+    def test_rewrite(self, tmpdir):
+        """ writing a day again replaces it """
+        data = self.day_data()
+        cache = pdr.SQLiteCache(pdr.sqlite_cache_path(str(tmpdir)))
+        cache.write_day('foobar', self.start, self.end, data)
+        del data['nodes']['node1.example.com']
+        data['aggregate'] = pdr.aggregate_data_for_timespan(data)
+        cache.write_day('foobar', self.start, self.end, data)
+        assert cache.read_day('foobar', self.start, self.end) == data
+
+    def test_read_days(self, tmpdir):
+        """ a range of days is read at once; days missing from the cache aren't returned """
+        data = self.day_data()
+        cache = pdr.SQLiteCache(pdr.sqlite_cache_path(str(tmpdir)))
+        timespans = [(self.start - datetime.timedelta(days=i), self.end - datetime.timedelta(days=i)) for i in range(4)]
+        for i in [0, 1, 3]:
+            data['nodes']['node1.example.com']['reports']['run_count'] = i
+            cache.write_day('foobar', timespans[i][0], timespans[i][1], deepcopy(data))
+        cache.write_day('bazbar', timespans[2][0], timespans[2][1], data)
+        foo = cache.read_days('foobar', timespans)
+        assert sorted(foo.keys()) == sorted([timespans[0], timespans[1], timespans[3]])
+        assert foo[timespans[3]]['nodes']['node1.example.com']['reports']['run_count'] == 3
+        assert cache.cached_timespans('foobar', timespans) == [timespans[0], timespans[1], timespans[3]]
+        assert cache.read_days('foobar', []) == {}
+
+    def test_local_times(self, tmpdir):
+        """ times are stored as UTC, so the same instant in another zone is the same day """
+        data = self.day_data()
+        cache = pdr.SQLiteCache(pdr.sqlite_cache_path(str(tmpdir)))
+        cache.write_day('foobar', self.start, self.end, data)
+        eastern = pytz.timezone('US/Eastern')
+        assert cache.read_day('foobar', self.start.astimezone(eastern), self.end.astimezone(eastern)) == data
+
+    def test_prune(self, tmpdir):
+        """ by age, then least recently used per host, then least recently used overall """
+        cache = pdr.SQLiteCache(pdr.sqlite_cache_path(str(tmpdir)))
+        data = self.day_data()
+        timespans = [(self.start - datetime.timedelta(days=i), self.end - datetime.timedelta(days=i)) for i in range(4)]
+        now = calendar.timegm((2014, 6, 12, 0, 0, 0))
+
+        def cached(host):
+            return [i for i, timespan in enumerate(timespans) if timespan in cache.cached_timespans(host, timespans)]
+        for i, (start, end) in enumerate(timespans):
+            with mock.patch('time.time', mock.MagicMock(return_value=now - i)):
+                cache.write_day('foobar', start, end, data)
+                cache.write_day('bazbar', start, end, data)
+        assert cache.prune(now=now) == 0
+        assert cache.prune(max_age=4, now=now) == 2
+        assert cached('foobar') == [0, 1, 2]
+        # the oldest day of foobar is now the most recently used
+        with mock.patch('time.time', mock.MagicMock(return_value=now + 10)):
+            cache.read_day('foobar', *timespans[2])
+        assert cache.prune(max_files=2, now=now) == 2
+        assert cached('foobar') == [0, 2]
+        assert cached('bazbar') == [0, 1]
+        assert cache.prune(max_bytes=1, now=now) == 4
+        assert cached('foobar') == []
+
+    def test_prune_keep(self, tmpdir):
+        """ the days used by this run aren't evicted for max_files or max_bytes """
+        cache = pdr.SQLiteCache(pdr.sqlite_cache_path(str(tmpdir)))
+        data = self.day_data()
+        timespans = [(self.start - datetime.timedelta(days=i), self.end - datetime.timedelta(days=i)) for i in range(4)]
+        now = calendar.timegm((2014, 6, 12, 0, 0, 0))
+        for i, (start, end) in enumerate(timespans):
+            with mock.patch('time.time', mock.MagicMock(return_value=now - i)):
+                cache.write_day('foobar', start, end, data)
+        keep = [('foobar',) + timespans[3], ('bazbar',) + timespans[0]]
+        assert cache.prune(max_files=2, now=now, keep=keep) == 2
+        assert cache.cached_timespans('foobar', timespans) == [timespans[0], timespans[3]]
+        assert cache.prune(max_bytes=1, now=now, keep=keep) == 1
+        assert cache.cached_timespans('foobar', timespans) == [timespans[3]]
+
+    def test_prune_bucket_max_age(self, tmpdir):
+        """ buckets are pruned after bucket_max_age, days after max_age """
+        cache = pdr.SQLiteCache(pdr.sqlite_cache_path(str(tmpdir)))
+        data = self.day_data()
+        old = self.start - datetime.timedelta(days=5)
+        old_bucket = (old, old + pdr.BUCKET_LENGTH - datetime.timedelta(seconds=1))
+        bucket = (self.start, self.start + pdr.BUCKET_LENGTH - datetime.timedelta(seconds=1))
+        timespans = [(old, self.end - datetime.timedelta(days=5)), old_bucket, bucket]
+        for start, end in timespans:
+            cache.write_day('foobar', start, end, data)
+        now = calendar.timegm((2014, 6, 12, 0, 0, 0))
+        assert cache.prune(max_age=30, bucket_max_age=3, now=now) == 1
+        assert cache.cached_timespans('foobar', timespans) == [timespans[0], bucket]
+
+    def test_schema_version(self, tmpdir):
+        """ tables from another schema version are dropped and recreated """
+        fpath = pdr.sqlite_cache_path(str(tmpdir))
+        cache = pdr.SQLiteCache(fpath)
+        cache.write_day('foobar', self.start, self.end, self.day_data())
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.SQLITE_SCHEMA_VERSION', 999), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger') as logger_mock:
+            assert cache.read_day('foobar', self.start, self.end) is None
+        assert logger_mock.warning.call_count == 1
+
+
+class Test_CacheManifest:
+    """ tests for CacheManifest and format_cache_stats() """
+
+    start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+    end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+
+    def test_record_and_save(self, tmpdir):
+        cache_dir = str(tmpdir)
+        fname = os.path.basename(pdr.cache_path(cache_dir, 'foo', self.start, self.end))
+        with open(os.path.join(cache_dir, fname), 'wb') as fh:
+            fh.write(b'x' * 10)
+        pdr.SQLiteCache(pdr.sqlite_cache_path(cache_dir)).write_day('bar', self.start, self.end, {'nodes': {}})
+        manifest = pdr.CacheManifest(cache_dir)
+        assert manifest.load() == {'version': 1, 'entries': {}, 'hosts': {}}
+        with mock.patch('time.time', mock.MagicMock(return_value=1000.0)):
+            manifest.record_build('foo', self.start, self.end, 'files', 12.34567)
+        with mock.patch('time.time', mock.MagicMock(return_value=2000.0)):
+            manifest.record_hit('foo', self.start, self.end, 'files')
+            manifest.record_hit('bar', self.start, self.end, 'sqlite')
+        manifest.save()
+        assert manifest.entries == {}
+        assert sorted(os.listdir(cache_dir)) == sorted([fname, 'manifest.json', 'pypuppetdb_daily_report.sqlite'])
+        doc = pdr.CacheManifest(cache_dir).load()
+        assert doc['hosts'] == {'foo': {'hits': 1, 'misses': 1}, 'bar': {'hits': 1, 'misses': 0}}
+        assert doc['entries'][fname] == {'host': 'foo', 'start': '2014-06-10 04:00:00', 'end': '2014-06-11 03:59:59',
+                                         'backend': 'files', 'schema': pdr.CACHE_SCHEMA_VERSION, 'size': 10,
+                                         'build_seconds': 12.346, 'built': 1000.0, 'last_access': 2000.0, 'hits': 1}
+        assert doc['entries'][fname.replace('foo', 'bar')]['backend'] == 'sqlite'
+
+    def test_save_merges(self, tmpdir):
+        """ updates are merged into the manifest as it is on disk, and entries of removed files dropped """
+        cache_dir = str(tmpdir)
+        fname = os.path.basename(pdr.cache_path(cache_dir, 'foo', self.start, self.end))
+        open(os.path.join(cache_dir, fname), 'wb').close()
+        one = pdr.CacheManifest(cache_dir)
+        two = pdr.CacheManifest(cache_dir)
+        one.record_hit('foo', self.start, self.end, 'files')
+        two.record_hit('foo', self.start, self.end, 'files')
+        two.record_hit('foo', self.start - datetime.timedelta(days=1), self.end - datetime.timedelta(days=1), 'files')
+        one.save()
+        two.save()
+        doc = one.load()
+        assert doc['hosts'] == {'foo': {'hits': 3, 'misses': 0}}
+        assert list(doc['entries'].keys()) == [fname]
+        assert doc['entries'][fname]['hits'] == 2
+
+    def test_save_drops_sqlite(self, tmpdir):
+        """ entries of days pruned from the SQLite cache are dropped """
+        cache_dir = str(tmpdir)
+        cache = pdr.SQLiteCache(pdr.sqlite_cache_path(cache_dir))
+        before = (self.start - datetime.timedelta(days=1), self.end - datetime.timedelta(days=1))
+        cache.write_day('foo', self.start, self.end, {'nodes': {}})
+        cache.write_day('foo', before[0], before[1], {'nodes': {}})
+        manifest = pdr.CacheManifest(cache_dir)
+        manifest.record_hit('foo', self.start, self.end, 'sqlite')
+        manifest.record_hit('foo', before[0], before[1], 'sqlite')
+        manifest.save()
+        assert len(manifest.load()['entries']) == 2
+        assert cache.prune(max_files=1) == 1
+        manifest.save()
+        entries = list(manifest.load()['entries'].values())
+        assert [(e['host'], e['start'], e['end']) for e in entries] == list(cache.cached_days())
+
+    def test_no_cache_dir(self, tmpdir):
+        manifest = pdr.CacheManifest(str(tmpdir.join('foo')))
+        manifest.record_hit('foo', self.start, self.end, 'files')
+        manifest.save()
+        assert not os.path.exists(str(tmpdir.join('foo')))
+
+    def test_unreadable(self, tmpdir):
+        with open(str(tmpdir.join('manifest.json')), 'w') as fh:
+            fh.write('{foo')
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger') as logger_mock:
+            assert pdr.CacheManifest(str(tmpdir)).load() == {'version': 1, 'entries': {}, 'hosts': {}}
+        assert logger_mock.warning.call_count == 1
+
+    def test_format_cache_stats(self):
+        doc = {'version': 1,
+               'hosts': {'foo': {'hits': 3, 'misses': 1}, 'bar': {'hits': 0, 'misses': 0}},
+               'entries': {'a': {'host': 'foo', 'start': '2014-06-10 04:00:00', 'end': '2014-06-11 03:59:59',
+                                 'backend': 'files', 'size': 100, 'build_seconds': 2.5},
+                           'b': {'host': 'foo', 'start': '2014-06-09 04:00:00', 'end': '2014-06-10 03:59:59',
+                                 'backend': 'files', 'size': 50, 'build_seconds': 7.25},
+                           'c': {'host': 'baz', 'start': '2014-06-09 04:00:00', 'end': '2014-06-10 03:59:59',
+                                 'backend': 'sqlite'}}}
+        assert pdr.format_cache_stats(doc, num_slowest=1) == (
+            "total: 3 cached days, 150 bytes; 3 hits, 1 misses (75.0% hit rate)\n"
+            "bar: 0 cached days, 0 bytes; 0 hits, 0 misses (0.0% hit rate)\n"
+            "baz: 1 cached days, 0 bytes; 0 hits, 0 misses (0.0% hit rate)\n"
+            "foo: 2 cached days, 150 bytes; 3 hits, 1 misses (75.0% hit rate)\n"
+            "slowest days to build:\n"
+            "  7.2s foo 2014-06-09 04:00:00 to 2014-06-10 03:59:59 (files)\n")
+
+    def test_format_cache_stats_buckets(self):
+        """ buckets are counted apart from days, and not listed as slow days """
+        doc = {'version': 1,
+               'hosts': {'foo': {'hits': 1, 'misses': 2}},
+               'entries': {'a': {'host': 'foo', 'start': '2014-06-10 04:00:00', 'end': '2014-06-11 03:59:59',
+                                 'backend': 'files', 'size': 100, 'build_seconds': 2.5},
+                           'b': {'host': 'foo', 'start': '2014-06-10 04:00:00', 'end': '2014-06-10 04:59:59',
+                                 'backend': 'files', 'size': 10, 'build_seconds': 7.25},
+                           'c': {'host': 'foo', 'start': '2014-06-10 05:00:00', 'end': '2014-06-10 05:59:59',
+                                 'backend': 'files', 'size': 10, 'build_seconds': 7.25}}}
+        assert pdr.format_cache_stats(doc) == (
+            "total: 1 cached days, 2 cached buckets, 120 bytes; 1 hits, 2 misses (33.3% hit rate)\n"
+            "foo: 1 cached days, 2 cached buckets, 120 bytes; 1 hits, 2 misses (33.3% hit rate)\n"
+            "slowest days to build:\n"
+            "  2.5s foo 2014-06-10 04:00:00 to 2014-06-11 03:59:59 (files)\n")
+
+
+class Test_compact_cache:
+    """ tests for compact_day_data() and compact_cache() """
+
+    now = calendar.timegm((2014, 6, 30, 12, 0, 0))
+
+    def day_data(self):
+        return Test_SQLiteCache().day_data()
+
+    def test_compact_day_data(self):
+        data = self.day_data()
+        foo = pdr.compact_day_data(data, top=2)
+        assert foo['compacted'] is True
+        assert foo['nodes'] == dict((node, {}) for node in data['nodes'])
+        assert foo['metrics'] == data['metrics']
+        assert foo['facts'] == data['facts']
+        for section in ['reports', 'nodes']:
+            for key in data['aggregate'][section]:
+                if key != 'resources':
+                    assert foo['aggregate'][section][key] == data['aggregate'][section][key]
+            for status, resources in data['aggregate'][section]['resources'].items():
+                top = list(pdr.filter_resource_dict_sort(resources).items())[:2]
+                assert foo['aggregate'][section]['resources'][status] == dict(top)
+        assert len(data['aggregate']['reports']['resources']['changed']) > 2
+        # the original isn't changed
+        assert data == self.day_data()
+
+    def test_renders_the_same(self):
+        """ a compacted day renders the same as the full one, if it's not the newest """
+        data = self.day_data()
+        dates = ['Wed 06/11', 'Tue 06/10']
+        start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+        with freeze_time("2014-06-11 08:15:43"):
+            full = pdr.format_html('foo', dates, {dates[0]: data, dates[1]: data}, start, end)
+            compacted = pdr.format_html('foo', dates, {dates[0]: data, dates[1]: pdr.compact_day_data(data)}, start, end)
+        assert compacted == full
+
+    def test_compact_cache(self, tmpdir):
+        """ only days older than the cutoff are compacted, keeping their last used times """
+        data = self.day_data()
+        cache_dir = str(tmpdir)
+        days = []
+        for day in [1, 20, 29]:
+            start = datetime.datetime(2014, 6, day, hour=4, minute=0, second=0)
+            fpath = pdr.cache_path(cache_dir, 'foo', start, start + datetime.timedelta(hours=23, minutes=59, seconds=59))
+            pdr.write_cache(fpath, data)
+            os.utime(fpath, (self.now - day, self.now - day))
+            days.append(fpath)
+        pdr.write_cache(days[0] + '.partial', {'foo': 'bar'})
+        with open(str(tmpdir.join('events_foo.pickle')), 'wb') as fh:
+            fh.write(b'foo')
+        size = os.stat(days[0]).st_size
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger') as logger_mock:
+            assert pdr.compact_cache(cache_dir, 7, now=self.now) == 2
+        assert logger_mock.info.call_count == 1
+        assert pdr.loads_cache(open(days[0], 'rb').read()) == pdr.compact_day_data(data)
+        assert pdr.loads_cache(open(days[1], 'rb').read()) == pdr.compact_day_data(data)
+        assert pdr.loads_cache(open(days[2], 'rb').read()) == data
+        assert os.stat(days[0]).st_size < size
+        assert [os.stat(fpath).st_mtime for fpath in days] == [self.now - 1, self.now - 20, self.now - 29]
+        # already compacted days aren't rewritten
+        assert pdr.compact_cache(cache_dir, 7, now=self.now) == 0
+
+    def test_no_dir(self, tmpdir):
+        assert pdr.compact_cache(str(tmpdir.join('foo')), 7) == 0
+
+    def test_buckets(self, tmpdir):
+        """ buckets are merged node by node, so they're never compacted """
+        data = {'nodes': self.day_data()['nodes']}
+        start = datetime.datetime(2014, 6, 1, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 1, hour=4, minute=59, second=59, tzinfo=pytz.utc)
+        pdr.write_cache(pdr.cache_path(str(tmpdir), 'foo', start, end), data)
+        pdr.SQLiteCache(pdr.sqlite_cache_path(str(tmpdir))).write_day('foo', start, end, data)
+        assert pdr.compact_cache(str(tmpdir), 7, now=self.now) == 0
+        assert pdr.read_cache(pdr.cache_path(str(tmpdir), 'foo', start, end)) == data
+
+    def test_sqlite(self, tmpdir):
+        cache = pdr.SQLiteCache(pdr.sqlite_cache_path(str(tmpdir)))
+        data = self.day_data()
+        start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+        cache.write_day('foo', start, end, data)
+        cache.write_day('foo', start + datetime.timedelta(days=19), end + datetime.timedelta(days=19), data)
+        assert pdr.compact_cache(str(tmpdir), 7, top=2, now=self.now) == 1
+        assert cache.read_day('foo', start, end) == pdr.compact_day_data(data, top=2)
+        assert cache.read_day('foo', start + datetime.timedelta(days=19), end + datetime.timedelta(days=19)) == data
+        assert cache.compact(7, now=self.now) == 0
+
+
+class Test_prune_cache:
+    """ tests for prune_cache() """
+
+    now = calendar.timegm((2014, 6, 11, 12, 0, 0))
+
+    def make(self, tmpdir, fname, size, used):
+        """ make a cache file of size bytes, last used used days ago """
+        fpath = str(tmpdir.join(fname))
+        with open(fpath, 'wb') as fh:
+            fh.write(b'x' * size)
+        os.utime(fpath, (self.now - used * 86400, self.now - used * 86400))
+        return fname
+
+    def day(self, host, day, ext='cache'):
+        start = datetime.datetime(2014, 6, day, hour=4, minute=0, second=0)
+        end = start + datetime.timedelta(hours=23, minutes=59, seconds=59)
+        return os.path.basename(pdr.cache_path('/', host, start, end)).replace('.cache', '.' + ext)
+
+    def test_no_dir(self, tmpdir):
+        assert pdr.prune_cache(str(tmpdir.join('foo'))) == 0
+
+    def test_no_limits(self, tmpdir):
+        self.make(tmpdir, self.day('foo', 1), 10, 10)
+        assert pdr.prune_cache(str(tmpdir), now=self.now) == 0
+        assert os.listdir(str(tmpdir)) == [self.day('foo', 1)]
+
+    def test_max_age(self, tmpdir):
+        """ by the day cached, not when it was last used; other files are left alone """
+        keep = [self.make(tmpdir, self.day('foo', 9), 10, 10),
+                self.make(tmpdir, self.day('foo', 10, 'pickle'), 10, 10),
+                self.make(tmpdir, 'events_foo.pickle', 10, 20),
+                self.make(tmpdir, 'foo.txt', 10, 20)]
+        self.make(tmpdir, self.day('foo', 1), 10, 0)
+        self.make(tmpdir, self.day('bar', 2, 'cache.partial'), 10, 0)
+        self.make(tmpdir, self.day('foo', 3, 'pickle'), 10, 0)
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger') as logger_mock:
+            assert pdr.prune_cache(str(tmpdir), max_age=3, now=self.now) == 3
+        assert sorted(os.listdir(str(tmpdir))) == sorted(keep)
+        assert logger_mock.info.call_args == mock.call("pruned 3 cache files (30 bytes) from {d}".format(d=str(tmpdir)))
+
+    def test_bucket_max_age(self, tmpdir):
+        """ buckets are pruned after bucket_max_age, days after max_age """
+        def bucket(host, day, ext='cache'):
+            start = datetime.datetime(2014, 6, day, hour=4, minute=0, second=0)
+            end = start + pdr.BUCKET_LENGTH - datetime.timedelta(seconds=1)
+            return os.path.basename(pdr.cache_path('/', host, start, end)).replace('.cache', '.' + ext)
+        keep = [self.make(tmpdir, self.day('foo', 1), 10, 0),
+                self.make(tmpdir, bucket('foo', 9), 10, 0)]
+        self.make(tmpdir, bucket('foo', 1), 10, 0)
+        self.make(tmpdir, bucket('bar', 2, 'pickle'), 10, 0)
+        assert pdr.prune_cache(str(tmpdir), max_age=30, bucket_max_age=3, now=self.now) == 2
+        assert sorted(os.listdir(str(tmpdir))) == sorted(keep)
+
+    def test_stale(self, tmpdir):
+        """ temporary and lock files left by crashed runs """
+        keep = [self.make(tmpdir, self.day('foo', 10, 'cache.123.456.tmp'), 10, 0.5),
+                self.make(tmpdir, 'manifest.json.lock', 10, 0.5)]
+        self.make(tmpdir, self.day('foo', 10, 'cache.789.456.tmp'), 10, 2)
+        self.make(tmpdir, self.day('foo', 10, 'cache.lock'), 0, 2)
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger') as logger_mock:
+            assert pdr.prune_cache(str(tmpdir), now=self.now) == 2
+        assert sorted(os.listdir(str(tmpdir))) == sorted(keep)
+        assert logger_mock.info.call_count == 0
+
+    def test_max_files(self, tmpdir):
+        """ least recently used files of each host """
+        keep = [self.make(tmpdir, self.day('foo', 1), 10, 1),
+                self.make(tmpdir, 'events_foo.pickle', 10, 0),
+                self.make(tmpdir, self.day('foo_bar', 1), 10, 5),
+                self.make(tmpdir, self.day('foo_bar', 2), 10, 4)]
+        self.make(tmpdir, self.day('foo', 2), 10, 2)
+        self.make(tmpdir, self.day('foo', 3), 10, 3)
+        assert pdr.prune_cache(str(tmpdir), max_files=2, now=self.now) == 2
+        assert sorted(os.listdir(str(tmpdir))) == sorted(keep)
+
+    def test_max_files_partial(self, tmpdir):
+        """ checkpoints don't count toward max_files """
+        keep = [self.make(tmpdir, self.day('foo', 1), 10, 1),
+                self.make(tmpdir, self.day('foo', 2), 10, 2),
+                self.make(tmpdir, self.day('foo', 3, 'cache.partial'), 10, 0),
+                self.make(tmpdir, self.day('foo', 4, 'cache.partial'), 10, 5)]
+        self.make(tmpdir, self.day('foo', 5), 10, 3)
+        assert pdr.prune_cache(str(tmpdir), max_files=2, now=self.now) == 1
+        assert sorted(os.listdir(str(tmpdir))) == sorted(keep)
+
+    def test_keep(self, tmpdir):
+        """ the entries used by this run aren't evicted for max_files or max_bytes, but still count """
+        start = datetime.datetime(2014, 6, 1, hour=4, minute=0, second=0)
+        used = [(host, start, start + datetime.timedelta(hours=23, minutes=59, seconds=59)) for host in ['foo', 'bar']]
+        keep = [self.make(tmpdir, self.day('foo', 1), 100, 9),
+                self.make(tmpdir, self.day('foo', 1, 'cache.partial'), 100, 9),
+                self.make(tmpdir, 'events_foo.pickle', 100, 8),
+                self.make(tmpdir, self.day('foo', 4), 100, 1),
+                self.make(tmpdir, self.day('bar', 1), 100, 9),
+                self.make(tmpdir, self.day('bar', 5), 100, 0)]
+        self.make(tmpdir, self.day('foo', 2), 100, 3)
+        self.make(tmpdir, self.day('foo', 3), 100, 2)
+        self.make(tmpdir, self.day('bar', 2), 100, 4)
+        assert pdr.prune_cache(str(tmpdir), max_files=3, now=self.now, keep=used) == 2
+        assert pdr.prune_cache(str(tmpdir), max_bytes=600, now=self.now, keep=used) == 1
+        assert sorted(os.listdir(str(tmpdir))) == sorted(keep)
+        assert pdr.prune_cache(str(tmpdir), max_bytes=1, now=self.now, keep=used) == 2
+        assert sorted(os.listdir(str(tmpdir))) == sorted(keep[:3] + keep[4:5])
+
+    def test_keep_any_host(self, tmpdir):
+        """ a keep timespan with no hostname keeps it, and the event caches, for every host """
+        start = datetime.datetime(2014, 6, 1, hour=4, minute=0, second=0)
+        used = [(None, start, start + datetime.timedelta(hours=23, minutes=59, seconds=59))]
+        keep = [self.make(tmpdir, self.day('foo', 1), 100, 9),
+                self.make(tmpdir, self.day('bar', 1), 100, 9),
+                self.make(tmpdir, 'events_foo.pickle', 100, 8)]
+        self.make(tmpdir, self.day('foo', 2), 100, 3)
+        assert pdr.prune_cache(str(tmpdir), max_bytes=1, now=self.now, keep=used) == 1
+        assert sorted(os.listdir(str(tmpdir))) == sorted(keep)
+
+    def test_max_bytes(self, tmpdir):
+        """ least recently used files until under the limit """
+        keep = [self.make(tmpdir, self.day('foo', 3), 100, 1),
+                self.make(tmpdir, self.day('bar', 3), 100, 2),
+                self.make(tmpdir, 'foo.txt', 1000, 5)]
+        self.make(tmpdir, self.day('foo', 2), 100, 3)
+        self.make(tmpdir, self.day('foo', 1), 100, 4)
+        assert pdr.prune_cache(str(tmpdir), max_bytes=250, now=self.now) == 2
+        assert sorted(os.listdir(str(tmpdir))) == sorted(keep)
+
+    def test_sqlite(self, tmpdir):
+        """ the SQLite cache is pruned with the same limits """
+        open(pdr.sqlite_cache_path(str(tmpdir)), 'wb').close()
+        cache_mock = mock.MagicMock()
+        cache_mock.return_value.prune.return_value = 4
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.SQLiteCache', cache_mock):
+            assert pdr.prune_cache(str(tmpdir), max_age=30, max_bytes=100, max_files=3, now=self.now) == 4
+        assert cache_mock.call_args == mock.call(pdr.sqlite_cache_path(str(tmpdir)))
+        assert cache_mock.return_value.prune.call_args == mock.call(max_age=30, max_bytes=100, max_files=3, now=self.now,
+                                                                    keep=[], bucket_max_age=None)
+
+    def test_read_touches(self, tmpdir):
+        """ reading a cache file marks it as used """
+        fpath = str(tmpdir.join(self.day('foo', 1)))
+        pdr.write_cache(fpath, {'nodes': {}})
+        os.utime(fpath, (self.now, self.now))
+        assert pdr.read_cache(fpath) == {'nodes': {}}
+        assert os.stat(fpath).st_mtime > self.now
+
+
+class Test_backfill_timespans:
+
+    timespans = [(datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                  datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                 (datetime.datetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                  datetime.datetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                 (datetime.datetime(2014, 6, 8, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                  datetime.datetime(2014, 6, 9, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                 ]
+
+    def test_no_cache(self):
+        """ no cache_dir, all timespans queried """
+        query_mock = mock.MagicMock(return_value=[{'day': 1}, {'day': 2}, {'day': 3}])
+        write_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespans', query_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.write_cache', write_mock):
+            foo = pdr.backfill_timespans('foobar', 'pdb', self.timespans, cache_dir=None, workers=2)
+        assert query_mock.call_args == mock.call('pdb', self.timespans, workers=2, snapshots=True, facts=None, checkpoint=None)
+        assert write_mock.call_count == 0
+        assert foo == {self.timespans[0]: {'day': 1}, self.timespans[1]: {'day': 2}, self.timespans[2]: {'day': 3}}
+
+    def test_partly_cached(self):
+        """ one timespan cached, the others queried and written """
+        cached = pdr.cache_path('/tmp/cache', 'foobar', self.timespans[1][0], self.timespans[1][1])
+
+        def exists_se(path):
+            return path in [cached, '/tmp/cache']
+        query_mock = mock.MagicMock(return_value=[{'day': 1}, {'day': 3}])
+        write_mock = mock.MagicMock()
+        manifest_mock = mock.MagicMock()
+        pdb_mock = mock.MagicMock()
+        pdb_mock.cache_manifest = manifest_mock
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespans', query_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.write_cache', write_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.CacheLock', mock.MagicMock()), \
+                mock.patch('time.time', mock.MagicMock(side_effect=[100.0, 110.0])), \
+                mock.patch('os.path.exists', mock.MagicMock(side_effect=exists_se)):
+            foo = pdr.backfill_timespans('foobar', pdb_mock, self.timespans, cache_dir='/tmp/cache')
+        assert manifest_mock.record_build.call_args_list == [
+            mock.call('foobar', self.timespans[0][0], self.timespans[0][1], 'files', 5.0),
+            mock.call('foobar', self.timespans[2][0], self.timespans[2][1], 'files', 5.0),
+        ]
+        assert query_mock.call_args == mock.call(pdb_mock, [self.timespans[0], self.timespans[2]], workers=1, snapshots=True, facts=None,
+                                                 checkpoint=mock.ANY)
+        assert write_mock.call_args_list == [
+            mock.call(pdr.cache_path('/tmp/cache', 'foobar', self.timespans[0][0], self.timespans[0][1]), {'day': 1}),
+            mock.call(pdr.cache_path('/tmp/cache', 'foobar', self.timespans[2][0], self.timespans[2][1]), {'day': 3}),
+        ]
+        assert foo == {self.timespans[0]: {'day': 1}, self.timespans[2]: {'day': 3}}
+
+    def test_sqlite(self):
+        """ with the sqlite cache backend, cached days come from and new days go to SQLiteCache """
+        cache_mock = mock.MagicMock()
+        cache_mock.return_value.cached_timespans.return_value = [self.timespans[1]]
+        query_mock = mock.MagicMock(return_value=[{'day': 1}, {'day': 3}])
+        write_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespans', query_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.write_cache', write_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.SQLiteCache', cache_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.CacheLock', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.NodeCheckpoint', mock.MagicMock()), \
+                mock.patch('os.path.exists', mock.MagicMock(return_value=True)):
+            foo = pdr.backfill_timespans('foobar', 'pdb', self.timespans, cache_dir='/tmp/cache', cache_backend='sqlite')
+        assert cache_mock.call_args == mock.call('/tmp/cache/pypuppetdb_daily_report.sqlite')
+        assert query_mock.call_args == mock.call('pdb', [self.timespans[0], self.timespans[2]], workers=1, snapshots=True, facts=None,
+                                                 checkpoint=mock.ANY)
+        assert write_mock.call_count == 0
+        assert cache_mock.return_value.write_day.call_args_list == [
+            mock.call('foobar', self.timespans[0][0], self.timespans[0][1], {'day': 1}),
+            mock.call('foobar', self.timespans[2][0], self.timespans[2][1], {'day': 3}),
+        ]
+        assert foo == {self.timespans[0]: {'day': 1}, self.timespans[2]: {'day': 3}}
+
+    def test_locked(self, tmpdir):
+        """ days another run is building are left to get_data_for_timespan() """
+        cache_dir = str(tmpdir)
+        other = pdr.CacheLock(pdr.lock_path(pdr.cache_path(cache_dir, 'foobar', self.timespans[1][0], self.timespans[1][1])))
+        other.acquire()
+        query_mock = mock.MagicMock(return_value=[{'day': 1}, {'day': 3}])
+        write_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespans', query_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.write_cache', write_mock):
+            foo = pdr.backfill_timespans('foobar', 'pdb', self.timespans, cache_dir=cache_dir)
+        other.release()
+        assert query_mock.call_args == mock.call('pdb', [self.timespans[0], self.timespans[2]], workers=1, snapshots=True, facts=None,
+                                                 checkpoint=mock.ANY)
+        assert foo == {self.timespans[0]: {'day': 1}, self.timespans[2]: {'day': 3}}
+        assert os.listdir(cache_dir) == []
+
+    def test_resume(self, tmpdir):
+        """ an interrupted backfill resumes from its checkpoint, which is removed once the timespans are cached """
+        cache_dir = str(tmpdir)
+        timespans = self.timespans[:2]
+        fpath = pdr.backfill_checkpoint_path(cache_dir, 'foobar', timespans)
+        assert fpath == os.path.join(cache_dir, 'data_foobar_2014-06-09_04-00-00_2014-06-11_03-59-59.backfill.partial')
+        pdb_mock = Test_query_data_for_timespans().pdb()
+        query_se = pdb_mock._query.side_effect
+
+        def crash_se(endpoint, query=None, **kwargs):
+            if 'node2' in query:
+                raise requests.exceptions.ConnectionError()
+            return query_se(endpoint, query=query, **kwargs)
+        pdb_mock._query.side_effect = crash_se
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger'), \
+                freeze_time("2014-06-14 08:15:43"):
+            with pytest.raises(requests.exceptions.ConnectionError):
+                pdr.backfill_uncached('foobar', pdb_mock, timespans, cache_dir=cache_dir)
+            assert os.listdir(cache_dir) == [os.path.basename(fpath)]
+            pdb_mock = Test_query_data_for_timespans().pdb()
+            foo = pdr.backfill_uncached('foobar', pdb_mock, timespans, cache_dir=cache_dir)
+            expected = pdr.query_data_for_timespans(Test_query_data_for_timespans().pdb(), timespans)
+        assert pdb_mock._query.call_count == 1
+        assert foo == dict(zip(timespans, expected))
+        assert sorted(os.listdir(cache_dir)) == sorted(os.path.basename(pdr.cache_path(cache_dir, 'foobar', start, end))
+                                                       for start, end in timespans)
+
+    def test_resume_grace(self, tmpdir):
+        """ checkpointed nodes whose data may have been missing reports aren't resumed for timespans to be cached """
+        cache_dir = str(tmpdir)
+        buckets = pdr.get_buckets(datetime.datetime(2014, 6, 11, hour=1, minute=0, second=0, tzinfo=pytz.utc),
+                                  datetime.datetime(2014, 6, 11, hour=2, minute=59, second=59, tzinfo=pytz.utc))
+        checkpoint = pdr.NodeCheckpoint(pdr.backfill_checkpoint_path(cache_dir, 'foobar', buckets))
+        # recorded right after the last bucket ended
+        written = calendar.timegm((2014, 6, 11, 3, 5, 0))
+        checkpoint.add('node1', (written, dict((bucket, {'node': 1}) for bucket in buckets)))
+        checkpoint.close()
+        query_mock = mock.MagicMock(return_value=[{'nodes': {}}, {'nodes': {}}])
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespans', query_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger'):
+            pdr.backfill_uncached('foobar', 'pdb', buckets, cache_dir=cache_dir, snapshots=False,
+                                  cache_before=datetime.datetime(2014, 6, 11, hour=2, minute=0, second=0, tzinfo=pytz.utc))
+            # the last bucket isn't cached, so its data is still good enough to show
+            assert 'node1' in query_mock.call_args[1]['checkpoint'].nodes
+            checkpoint = pdr.NodeCheckpoint(pdr.backfill_checkpoint_path(cache_dir, 'foobar', buckets))
+            checkpoint.add('node1', (written, dict((bucket, {'node': 1}) for bucket in buckets)))
+            checkpoint.close()
+            pdr.backfill_uncached('foobar', 'pdb', buckets, cache_dir=cache_dir, snapshots=False,
+                                  cache_before=datetime.datetime(2014, 6, 11, hour=4, minute=0, second=0, tzinfo=pytz.utc))
+            assert query_mock.call_args[1]['checkpoint'].nodes == {}
+
+    def test_one_uncached(self):
+        """ only one timespan not cached; nothing to backfill """
+        def exists_se(path):
+            return 'data_foobar_2014-06-10_04-00-00' not in path
+        query_mock = mock.MagicMock()
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_timespans', query_mock), \
+                mock.patch('os.path.exists', mock.MagicMock(side_effect=exists_se)):
+            foo = pdr.backfill_timespans('foobar', 'pdb', self.timespans, cache_dir='/tmp/cache')
+        assert foo == {}
+        assert query_mock.call_count == 0
+
+
+class Test_AdaptiveLimiter:
+    """ tests for the AdaptiveLimiter concurrency controller """
+
+    def test_init(self):
+        lim = pdr.AdaptiveLimiter(10)
+        assert lim.current_limit() == 5
+        assert pdr.AdaptiveLimiter(1).current_limit() == 1
+        assert pdr.AdaptiveLimiter(1, min_limit=4).min_limit == 1
+
+    def test_increase(self):
+        """ prompt responses raise the limit by about one per limit's worth, up to max_limit """
+        lim = pdr.AdaptiveLimiter(8)
+        for i in range(4):
+            lim.acquire()
+        for i in range(4):
+            lim.release(latency=0.1)
+        assert lim.current_limit() == 4
+        lim.acquire()
+        lim.release(latency=0.1)
+        assert lim.current_limit() == 5
+        for i in range(200):
+            lim.acquire()
+            lim.release(latency=0.1)
+        assert lim.current_limit() == 8
+        assert lim.backoffs == 0
+
+    def test_error_backoff(self):
+        """ errors halve the limit, but only once per limit's worth of requests """
+        lim = pdr.AdaptiveLimiter(16)
+        lim.since_backoff = 8
+        for i in range(3):
+            lim.acquire()
+        for i in range(3):
+            lim.release(error=True)
+        assert lim.current_limit() == 4
+        assert lim.backoffs == 1
+        for i in range(2):
+            lim.acquire()
+            lim.release(error=True)
+        assert lim.current_limit() == 2
+        assert lim.backoffs == 2
+        for i in range(10):
+            lim.acquire()
+            lim.release(error=True)
+        assert lim.current_limit() == 1
+
+    def test_latency_backoff(self):
+        """ back off once smoothed latency rises past the tolerance over the baseline """
+        lim = pdr.AdaptiveLimiter(10)
+        lim.since_backoff = 5
+        lim.acquire()
+        lim.release(latency=0.1)
+        assert lim.baseline == {None: 0.1}
+        for i in range(5):
+            lim.acquire()
+            lim.release(latency=0.15)
+        assert lim.backoffs == 0
+        for i in range(10):
+            lim.acquire()
+            lim.release(latency=2.0)
+        assert lim.backoffs >= 1
+        assert lim.current_limit() < 5
+
+    def test_mixed_latency(self):
+        """ fast and slow endpoints mixed together don't collapse the limit """
+        lim = pdr.AdaptiveLimiter(10)
+        rand = random.Random(1)
+        for i in range(4000):
+            fast = rand.random() < 0.5
+            lim.acquire()
+            lim.release(latency=(0.02 if fast else 0.3) * rand.uniform(0.8, 1.25),
+                        endpoint='reports' if fast else 'events')
+        assert lim.backoffs == 0
+        assert lim.current_limit() == 10
+        assert sorted(lim.baseline.keys()) == ['events', 'reports']
+        assert lim.baseline['reports'] < 0.03
+        assert lim.baseline['events'] > 0.2
+
+    def test_baseline_follows(self):
+        """ a lasting change in latency moves the baseline, so backoffs stop """
+        lim = pdr.AdaptiveLimiter(10)
+        for i in range(100):
+            lim.acquire()
+            lim.release(latency=0.01, endpoint='events')
+        for i in range(300):
+            lim.acquire()
+            lim.release(latency=0.1, endpoint='events')
+        assert lim.backoffs >= 1
+        assert lim.baseline['events'] > 0.09
+        backoffs = lim.backoffs
+        for i in range(100):
+            lim.acquire()
+            lim.release(latency=0.1, endpoint='events')
+        assert lim.backoffs == backoffs
+
+    def test_command_queue(self):
+        """ a deep command queue holds the limit at min_limit until it drains """
+        lim = pdr.AdaptiveLimiter(10, command_queue_limit=100)
+        lim.set_queue_depth(50)
+        assert lim.current_limit() == 5
+        lim.set_queue_depth(500)
+        assert lim.queue_overloaded() is True
+        assert lim.current_limit() == 1
+        for i in range(20):
+            lim.acquire()
+            lim.release(latency=0.1)
+        assert lim.limit == 5.0
+        lim.set_queue_depth(0)
+        assert lim.current_limit() == 5
+        assert pdr.AdaptiveLimiter(10).queue_overloaded() is False
+
+    def test_acquire_blocks(self):
+        """ acquire() waits for a release once the limit is reached """
+        lim = pdr.AdaptiveLimiter(2)
+        lim.acquire()
+        acquired = []
+
+        def worker():
+            lim.acquire()
+            acquired.append(True)
+
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        t.join(0.1)
+        assert acquired == []
+        lim.release(latency=0.1)
+        t.join(5)
+        assert acquired == [True]
+        assert lim.in_flight == 1
+
+
+class Test_PooledAPI:
+    """ tests for the PooledAPI pypuppetdb client """
+
+    def test_init(self):
+        pdb = pdr.PooledAPI(host='foo', port=1234, pool_size=3, connect_timeout=2, read_timeout=30)
+        assert pdb.timeout == (2, 30)
+        assert pdb._url('nodes') == 'http://foo:1234/v3/nodes'
+        adapter = pdb.session.get_adapter('http://foo:1234/v3/nodes')
+        assert adapter._pool_maxsize == 3
+        assert adapter._pool_block is True
+        assert pdb.session.headers['accept-encoding'] == 'gzip'
+        assert pdb.session.verify is False
+        assert pdb.session.cert is None
+
+    def test_init_ssl(self):
+        pdb = pdr.PooledAPI(host='foo', ssl_verify=True, ssl_key='/key', ssl_cert='/cert')
+        assert pdb.protocol == 'https'
+        assert pdb.session.verify is True
+        assert pdb.session.cert == ('/cert', '/key')
+
+    def test_query(self):
+        pdb = pdr.PooledAPI(host='foo')
+        resp = mock.MagicMock()
+        resp.json.return_value = [{'name': 'node1'}]
+        resp.headers = {'X-Records': '5'}
+        get_mock = mock.MagicMock(return_value=resp)
+        with mock.patch.object(pdb.session, 'get', get_mock):
+            res = pdb._query('reports', query='["=", "certname", "node1"]', order_by='foo', limit=10,
+                             include_total=True)
+        assert res == [{'name': 'node1'}]
+        assert pdb.total == 5
+        assert get_mock.call_args == mock.call('http://foo:8080/v3/reports',
+                                               params={'query': '["=", "certname", "node1"]',
+                                                       'order-by': 'foo',
+                                                       'limit': 10,
+                                                       'include-total': 'true'},
+                                               timeout=(10, 60),
+                                               stream=False)
+        assert resp.raise_for_status.call_count == 1
+
+    def test_query_empty(self):
+        pdb = pdr.PooledAPI(host='foo')
+        resp = mock.MagicMock()
+        resp.json.return_value = None
+        with mock.patch.object(pdb.session, 'get', mock.MagicMock(return_value=resp)), \
+                pytest.raises(pypuppetdb.errors.EmptyResponseError):
+            pdb._query('nodes')
+
+    def test_query_http_error(self):
+        pdb = pdr.PooledAPI(host='foo')
+        resp = mock.MagicMock()
+        resp.raise_for_status.side_effect = HTTPError("404")
+        with mock.patch.object(pdb.session, 'get', mock.MagicMock(return_value=resp)), \
+                pytest.raises(HTTPError):
+            pdb.metric('foo')
+
+    def test_query_timeout(self):
+        pdb = pdr.PooledAPI(host='foo')
+        get_mock = mock.MagicMock(side_effect=requests.exceptions.ConnectTimeout("timed out"))
+        with mock.patch.object(pdb.session, 'get', get_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger') as logger_mock, \
+                pytest.raises(requests.exceptions.Timeout):
+            pdb._query('nodes')
+        assert logger_mock.error.call_count == 1
+
+    def test_stream_query(self):
+        pdb = pdr.PooledAPI(host='foo')
+        resp = mock.MagicMock()
+        resp.encoding = None
+        resp.headers = {}
+        resp.iter_content.return_value = iter(['[{"a": 1}, {"b"', ': [2, 3]}', ']'])
+        get_mock = mock.MagicMock(return_value=resp)
+        with mock.patch.object(pdb.session, 'get', get_mock):
+            res = list(pdb.stream_query('reports', query='foo', limit=5))
+        assert res == [{'a': 1}, {'b': [2, 3]}]
+        assert get_mock.call_args == mock.call('http://foo:8080/v3/reports',
+                                               params={'query': 'foo', 'limit': 5},
+                                               timeout=(10, 60),
+                                               stream=True)
+        assert resp.encoding == 'utf-8'
+        assert resp.iter_content.call_args == mock.call(chunk_size=pdr.STREAM_CHUNK_SIZE, decode_unicode=True)
+        assert resp.close.call_count == 1
+
+    def test_stream_query_closed_early(self):
+        """ the response is released if the caller stops iterating """
+        pdb = pdr.PooledAPI(host='foo')
+        resp = mock.MagicMock()
+        resp.iter_content.return_value = iter(['[{"a": 1}, {"b": 2}]'])
+        with mock.patch.object(pdb.session, 'get', mock.MagicMock(return_value=resp)):
+            gen = pdb.stream_query('events')
+            assert next(gen) == {'a': 1}
+            gen.close()
+        assert resp.close.call_count == 1
+
+    def test_limiter(self):
+        """ requests go through the limiter, reporting their outcome """
+        limiter = mock.MagicMock(command_queue_limit=None)
+        pdb = pdr.PooledAPI(host='foo', limiter=limiter)
+        resp = mock.MagicMock()
+        resp.json.return_value = [{'name': 'node1'}]
+        with mock.patch.object(pdb.session, 'get', mock.MagicMock(return_value=resp)):
+            assert pdb._query('nodes') == [{'name': 'node1'}]
+        assert limiter.acquire.call_count == 1
+        assert limiter.release.call_count == 1
+        assert limiter.release.call_args[1]['latency'] >= 0
+        assert limiter.release.call_args[1]['endpoint'] == 'nodes'
+
+    def test_limiter_stream(self):
+        """ streamed requests release the limiter once the body is read """
+        limiter = mock.MagicMock(command_queue_limit=None)
+        pdb = pdr.PooledAPI(host='foo', limiter=limiter)
+        resp = mock.MagicMock()
+        resp.elapsed = datetime.timedelta(seconds=1)
+        resp.iter_content.return_value = iter(['[{"a": 1}, {"b": 2}]'])
+        with mock.patch.object(pdb.session, 'get', mock.MagicMock(return_value=resp)):
+            gen = pdb.stream_query('events')
+            assert next(gen) == {'a': 1}
+            assert limiter.release.call_count == 0
+            assert list(gen) == [{'b': 2}]
+        assert limiter.release.call_count == 1
+        assert limiter.release.call_args[1]['latency'] >= 1
+        assert limiter.release.call_args[1]['error'] is False
+        assert limiter.release.call_args[1]['endpoint'] == 'events'
+
+    @pytest.mark.parametrize('status,error', [(503, True), (429, True), (400, False), (404, False)])
+    def test_limiter_http_error(self, status, error):
+        """ only server errors and throttling count as errors for the limiter """
+        limiter = mock.MagicMock(command_queue_limit=None)
+        pdb = pdr.PooledAPI(host='foo', limiter=limiter)
+        resp = mock.MagicMock(status_code=status)
+        resp.raise_for_status.side_effect = HTTPError(str(status), response=resp)
+        with mock.patch.object(pdb.session, 'get', mock.MagicMock(return_value=resp)), \
+                pytest.raises(HTTPError):
+            pdb._query('nodes')
+        assert limiter.release.call_args[1]['error'] is error
+
+    def test_limiter_timeout(self):
+        limiter = mock.MagicMock(command_queue_limit=None)
+        pdb = pdr.PooledAPI(host='foo', limiter=limiter)
+        get_mock = mock.MagicMock(side_effect=requests.exceptions.ReadTimeout("timed out"))
+        with mock.patch.object(pdb.session, 'get', get_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger'), \
+                pytest.raises(requests.exceptions.Timeout):
+            pdb._query('nodes')
+        assert limiter.release.call_args == mock.call(error=True)
+
+    def test_command_queue(self):
+        """ the command queue depth is read at most every COMMAND_QUEUE_CHECK_INTERVAL seconds """
+        limiter = pdr.AdaptiveLimiter(4, command_queue_limit=10)
+        pdb = pdr.PooledAPI(host='foo', limiter=limiter)
+        queue_resp = mock.MagicMock()
+        queue_resp.json.return_value = {'QueueSize': 25}
+        nodes_resp = mock.MagicMock()
+        nodes_resp.json.return_value = []
+
+        def get(url, **kwargs):
+            if 'mbean' in url:
+                return queue_resp
+            return nodes_resp
+
+        get_mock = mock.MagicMock(side_effect=get)
+        with mock.patch.object(pdb.session, 'get', get_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.time.time') as time_mock:
+            time_mock.return_value = 1000.0
+            pdb._query('nodes')
+            pdb._query('nodes')
+            assert limiter.queue_depth == 25
+            assert limiter.current_limit() == 1
+            queue_resp.json.return_value = {'QueueSize': 0}
+            time_mock.return_value = 1000.0 + pdr.COMMAND_QUEUE_CHECK_INTERVAL
+            pdb._query('nodes')
+        assert len([c for c in get_mock.call_args_list if 'mbean' in c[0][0]]) == 2
+        assert get_mock.call_args_list[0] == mock.call(pdb._url('mbean', path=pdr.dashboard_metrics()['Command Queue']['path']),
+                                                       timeout=(10, 60))
+        assert limiter.current_limit() == 2
+
+    def test_command_queue_unreadable(self):
+        limiter = pdr.AdaptiveLimiter(4, command_queue_limit=10)
+        pdb = pdr.PooledAPI(host='foo', limiter=limiter)
+        queue_resp = mock.MagicMock()
+        queue_resp.raise_for_status.side_effect = HTTPError("404")
+        with mock.patch.object(pdb.session, 'get', mock.MagicMock(return_value=queue_resp)):
+            pdb._check_command_queue()
+        assert limiter.queue_depth is None
+
+    def test_connection_stats(self):
+        """ connections are reused across queries to a real (local) HTTP server """
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                body = b'[{"name": "node1"}]'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        pdb = pdr.PooledAPI(host='127.0.0.1', port=server.server_address[1])
+        try:
+            assert pdb.connection_stats() == {'opened': 0, 'requests': 0, 'reused': 0}
+            for i in range(3):
+                assert pdb._query('nodes') == [{'name': 'node1'}]
+            assert pdb.connection_stats() == {'opened': 1, 'requests': 3, 'reused': 2}
+        finally:
+            # the server is single-threaded, so drop our keep-alive connection first
+            pdb.session.close()
+            server.shutdown()
+            server.server_close()
+
 
 class Test_get_date_list:
     """ tests for get_date_list() function """
@@ -573,6 +2892,72 @@ class Test_get_date_list:
                                                     mock.call('end_date=2014-06-04 04:00:00+0000 UTC')
                                                     ]
 
+    def test_tz(self):
+        with freeze_time("2014-06-11 08:15:43"):
+            foo = pdr.get_date_list(2, tz=pytz.timezone('Asia/Tokyo'))
+        # it's already the afternoon of 06/11 in Tokyo
+        assert foo == [datetime.datetime(2014, 6, 10, hour=14, minute=59, second=59, tzinfo=pytz.utc),
+                       datetime.datetime(2014, 6, 9, hour=14, minute=59, second=59, tzinfo=pytz.utc)]
+
+
+class Test_get_window:
+
+    tz = pytz.timezone('America/New_York')
+
+    def test_since_until(self):
+        foo = pdr.get_window('2014-06-10 00:00', '2014-06-10T06:00', tz=self.tz)
+        assert foo == (datetime.datetime(2014, 6, 10, hour=4, tzinfo=pytz.utc),
+                       datetime.datetime(2014, 6, 10, hour=9, minute=59, second=59, tzinfo=pytz.utc))
+        assert pdr.get_window('2014-06-10', '2014-06-11', tz=pytz.utc)[1] == datetime.datetime(
+            2014, 6, 10, hour=23, minute=59, second=59, tzinfo=pytz.utc)
+
+    def test_rolling(self):
+        """ a number of hours until the start of the current hour """
+        with freeze_time("2014-06-11 08:15:43"):
+            foo = pdr.get_window('24h', tz=self.tz)
+        assert foo == (datetime.datetime(2014, 6, 10, hour=8, tzinfo=pytz.utc),
+                       datetime.datetime(2014, 6, 11, hour=7, minute=59, second=59, tzinfo=pytz.utc))
+
+    def test_errors(self):
+        with pytest.raises(ValueError) as excinfo:
+            pdr.get_window('2014-06-10 04:00', '2014-06-10 03:00', tz=self.tz)
+        assert str(excinfo.value) == "--until must be after --since"
+        # not on the hour in UTC
+        with pytest.raises(ValueError):
+            pdr.get_window('2014-06-10 00:00', tz=pytz.timezone('Asia/Kolkata'))
+        with pytest.raises(ValueError):
+            pdr.get_window('2014-06-10 00:30', '2014-06-11 00:00', tz=self.tz)
+
+
+class Test_buckets:
+    """ tests for get_buckets() and merge_buckets() """
+
+    def test_get_buckets(self):
+        start = datetime.datetime(2014, 6, 10, hour=4, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 10, hour=6, minute=59, second=59, tzinfo=pytz.utc)
+        assert pdr.get_buckets(start, end) == [
+            (start, datetime.datetime(2014, 6, 10, hour=4, minute=59, second=59, tzinfo=pytz.utc)),
+            (datetime.datetime(2014, 6, 10, hour=5, tzinfo=pytz.utc),
+             datetime.datetime(2014, 6, 10, hour=5, minute=59, second=59, tzinfo=pytz.utc)),
+            (datetime.datetime(2014, 6, 10, hour=6, tzinfo=pytz.utc), end)]
+        with pytest.raises(ValueError):
+            pdr.get_buckets(start, end - datetime.timedelta(minutes=30))
+
+    def test_merge_buckets(self):
+        def node(runs, failures, changes, total, longest, changed):
+            return {'reports': {'run_count': runs, 'with_failures': failures, 'with_changes': changes, 'with_skips': 0,
+                                'run_time_total': datetime.timedelta(seconds=total),
+                                'run_time_max': datetime.timedelta(seconds=longest)},
+                    'resources': {'failed': {}, 'changed': changed, 'skipped': {}}}
+        buckets = [{'nodes': {'node1': node(2, 1, 1, 30, 20, {('Service', 'foo'): 1}),
+                              'node2': node(0, 0, 0, 0, 0, {})}},
+                   {'nodes': {'node1': node(1, 0, 1, 50, 50, {('Service', 'foo'): 2, ('File', 'bar'): 1})}},
+                   {'nodes': {}}]
+        foo = pdr.merge_buckets(buckets)
+        assert foo == {'nodes': {'node1': node(3, 1, 2, 80, 50, {('Service', 'foo'): 3, ('File', 'bar'): 1}),
+                                 'node2': node(0, 0, 0, 0, 0, {})}}
+        assert type(foo['nodes']['node1']['resources']['changed']) is dict
+
 
 class Test_metric_value:
 
@@ -674,6 +3059,10 @@ class Test_query_data_for_timespan:
         node3.name = u'node3'
         pdb_mock = mock.MagicMock(spec=pypuppetdb.api.v3.API, autospec=True)
         pdb_mock.nodes.return_value = iter([node1, node2, node3])
+        pdb_mock.event_counts.return_value = [{'subject': {'title': 'node2'}, 'failures': 0, 'successes': 1,
+                                               'noops': 0, 'skips': 0},
+                                              {'subject': {'title': 'node3'}, 'failures': 0, 'successes': 0,
+                                               'noops': 2, 'skips': 0}]
         logger_mock = mock.MagicMock()
         get_metrics_mock = mock.MagicMock()
         query_node_mock = mock.MagicMock()
@@ -700,16 +3089,20 @@ class Test_query_data_for_timespan:
                                 'node2': {'reports': {'foo': 'bar'}},
                                 'node3': {'reports': {'foo': 'bar'}}
                                 }
-        assert logger_mock.debug.call_count == 7
-        assert logger_mock.info.call_count == 1
+        assert logger_mock.debug.call_count == 8
+        assert logger_mock.info.call_count == 2
         assert get_metrics_mock.call_count == 1
         assert get_metrics_mock.call_args == mock.call(pdb_mock)
         assert get_facts_mock.call_count == 1
-        assert get_facts_mock.call_args == mock.call(pdb_mock)
+        assert get_facts_mock.call_args == mock.call(pdb_mock, None)
+        assert pdb_mock.event_counts.call_args_list == [
+            mock.call('["and", [">=", "timestamp", "2014-06-10T04:00:00.000000Z"], '
+                      '["<=", "timestamp", "2014-06-11T04:59:59.000000Z"]]', summarize_by='certname')]
+        # only node2 had any (non-noop) events
         assert query_node_mock.call_count == 3
-        assert query_node_mock.call_args_list == [mock.call(pdb_mock, node1, start, end),
-                                                  mock.call(pdb_mock, node2, start, end),
-                                                  mock.call(pdb_mock, node3, start, end)
+        assert query_node_mock.call_args_list == [mock.call(pdb_mock, node1, start, end, has_events=False),
+                                                  mock.call(pdb_mock, node2, start, end, has_events=True),
+                                                  mock.call(pdb_mock, node3, start, end, has_events=False)
                                                   ]
         assert agg_mock.call_count == 1
         agg_arg = foo
@@ -752,20 +3145,479 @@ class Test_query_data_for_timespan:
                                 'node2': {'reports': {'foo': 'bar'}},
                                 'node3': {'reports': {'foo': 'bar'}}
                                 }
-        assert logger_mock.debug.call_count == 6
-        assert logger_mock.info.call_count == 1
+        assert logger_mock.debug.call_count == 7
+        assert logger_mock.info.call_count == 2
         assert get_metrics_mock.call_count == 0
         assert get_facts_mock.call_count == 0
         assert query_node_mock.call_count == 3
-        assert query_node_mock.call_args_list == [mock.call(pdb_mock, node1, start, end),
-                                                  mock.call(pdb_mock, node2, start, end),
-                                                  mock.call(pdb_mock, node3, start, end)
+        assert query_node_mock.call_args_list == [mock.call(pdb_mock, node1, start, end, has_events=False),
+                                                  mock.call(pdb_mock, node2, start, end, has_events=False),
+                                                  mock.call(pdb_mock, node3, start, end, has_events=False)
                                                   ]
         assert agg_mock.call_count == 1
         agg_arg = foo
         agg_arg.pop('aggregate')
         assert agg_mock.call_args == mock.call(agg_arg)
 
+    def test_workers(self):
+        """ with workers, result is the same as the serial path """
+        nodes = []
+        for n in range(10):
+            node = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+            node.name = u'node{n}'.format(n=n)
+            nodes.append(node)
+        pdb_mock = mock.MagicMock(spec=pypuppetdb.api.v3.API, autospec=True)
+        pdb_mock.nodes.return_value = iter(nodes)
+
+        def query_node_se(pdb, node, start, end, has_events=True):
+            return {'reports': {'name': node.name}}
+        query_node_mock = mock.MagicMock(side_effect=query_node_se)
+
+        start = datetime.datetime(2014, 6, 7, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 8, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_node', query_node_mock), \
+                freeze_time("2014-06-11 08:15:43"):
+            foo = pdr.query_data_for_timespan(pdb_mock, start, end, workers=3)
+        assert query_node_mock.call_count == 10
+        assert list(foo['nodes'].keys()) == [n.name for n in nodes]
+        for node in nodes:
+            assert foo['nodes'][node.name] == {'reports': {'name': node.name}}
+        assert foo['aggregate'] == pdr.aggregate_data_for_timespan({'nodes': foo['nodes']})
+
+    def test_checkpoint(self):
+        """ nodes already in the checkpoint aren't queried; the rest are recorded in it """
+        node1 = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+        node1.name = u'node1'
+        node2 = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+        node2.name = u'node2'
+        node3 = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+        node3.name = u'node3'
+        pdb_mock = mock.MagicMock(spec=pypuppetdb.api.v3.API, autospec=True)
+        pdb_mock.nodes.return_value = iter([node1, node2, node3])
+        checkpoint = mock.MagicMock(nodes={'node2': {'reports': {'done': True}}, 'gone': {'reports': {}}})
+        query_node_mock = mock.MagicMock(return_value={'reports': {'foo': 'bar'}})
+
+        start = datetime.datetime(2014, 6, 7, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 8, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_data_for_node', query_node_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.aggregate_data_for_timespan', mock.MagicMock()):
+            foo = pdr.query_data_for_timespan(pdb_mock, start, end, checkpoint=checkpoint)
+        assert query_node_mock.call_args_list == [mock.call(pdb_mock, node1, start, end, has_events=False),
+                                                  mock.call(pdb_mock, node3, start, end, has_events=False)]
+        assert checkpoint.add.call_args_list == [mock.call('node1', {'reports': {'foo': 'bar'}}),
+                                                 mock.call('node3', {'reports': {'foo': 'bar'}})]
+        assert foo['nodes'] == {'node1': {'reports': {'foo': 'bar'}},
+                                'node2': {'reports': {'done': True}},
+                                'node3': {'reports': {'foo': 'bar'}}}
+
+    def test_checkpoint_event_counts(self):
+        """ with the event-counts engine, nodes are checkpointed a chunk at a time """
+        nodes = []
+        for i in range(5):
+            node = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+            node.name = 'node{i}'.format(i=i)
+            nodes.append(node)
+        pdb_mock = mock.MagicMock(spec=pypuppetdb.api.v3.API, autospec=True)
+        pdb_mock.nodes.return_value = iter(nodes)
+        checkpoint = mock.MagicMock(nodes={})
+        counts_mock = mock.MagicMock(side_effect=lambda pdb, chunk, **kwargs: dict((n.name, {}) for n in chunk))
+
+        start = datetime.datetime(2014, 6, 7, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 8, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.query_nodes_event_counts', counts_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.aggregate_data_for_timespan', mock.MagicMock()), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.CHECKPOINT_CHUNK_SIZE', 2):
+            foo = pdr.query_data_for_timespan(pdb_mock, start, end, engine='counters', checkpoint=checkpoint)
+        assert [c[0][1] for c in counts_mock.call_args_list] == [nodes[0:2], nodes[2:4], nodes[4:]]
+        assert counts_mock.call_args[1] == {'start': start, 'end': end, 'workers': 1, 'resources': False}
+        assert checkpoint.add.call_count == 5
+        assert sorted(foo['nodes'].keys()) == ['node0', 'node1', 'node2', 'node3', 'node4']
+
+
+class Test_query_data_for_timespans:
+
+    def reports(self, certname):
+        """ reports for a node, newest first """
+        res = []
+        for n, (start, secs) in enumerate([('2014-06-11T05:00:00.000Z', 10),  # after all timespans
+                                           ('2014-06-11T03:59:59.000Z', 100),
+                                           ('2014-06-10T04:00:00.000Z', 20),
+                                           ('2014-06-10T03:59:59.000Z', 300),
+                                           ('2014-06-09T10:00:00.000Z', 40),
+                                           ('2014-06-08T10:00:00.000Z', 50),  # before all timespans
+                                           ]):
+            end = (datetime.datetime.strptime(start, '%Y-%m-%dT%H:%M:%S.%fZ') + datetime.timedelta(seconds=secs)).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            res.append({'certname': certname,
+                        'hash': '{c}-hash{n}'.format(c=certname, n=n),
+                        'start-time': start,
+                        'end-time': end,
+                        'receive-time': end,
+                        'configuration-version': '1',
+                        'report-format': 4,
+                        'puppet-version': '3.6.1',
+                        'transaction-uuid': 'uuid',
+                        })
+        return res
+
+    def pdb(self):
+        """ mock pdb serving reports and events, honoring queries """
+        node1 = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+        node1.name = u'node1'
+        node2 = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+        node2.name = u'node2'
+        pdb_mock = mock.MagicMock(spec=pypuppetdb.api.v3.API, autospec=True)
+        pdb_mock.nodes.side_effect = lambda: iter([node1, node2])
+
+        def query_se(endpoint, query=None, order_by=None, limit=None, offset=None):
+            q = json.loads(query)
+            certname = q[1][2]
+            return [r for r in self.reports(certname) if q[2][2][:19] <= r['start-time'][:19] <= q[3][2][:19]]
+        pdb_mock._query.side_effect = query_se
+
+        def events_se(query):
+            q = json.loads(query)
+            clauses = q[1:] if q[0] == 'or' else [q]
+            res = []
+            for clause in clauses:
+                hash_ = clause[2]
+                n = int(hash_[-1])
+                res.append(pypuppetdb.types.Event(hash_.split('-')[0], 'success', '2014-06-10T05:00:00.000Z', hash_,
+                                                  'title{n}'.format(n=n % 2), None, None, None, None, 'Service'))
+                if n % 2 == 0:
+                    res.append(pypuppetdb.types.Event(hash_.split('-')[0], 'failure', '2014-06-10T05:00:00.000Z', hash_,
+                                                      'other', None, None, None, None, 'Package'))
+            return res
+        pdb_mock.events.side_effect = events_se
+
+        def event_counts_se(query, summarize_by):
+            # ["and", [">=", "timestamp", s], ["<=", "timestamp", e]]; every report has events
+            q = json.loads(query)
+            assert summarize_by == 'certname' and q[1][1] == 'timestamp'
+            return [{'subject': {'title': name}, 'failures': 1, 'successes': 1, 'noops': 0, 'skips': 0}
+                    for name in ['node1', 'node2']
+                    if any(q[1][2][:19] <= r['start-time'][:19] <= q[2][2][:19] for r in self.reports(name))]
+        pdb_mock.event_counts.side_effect = event_counts_se
+        return pdb_mock
+
+    def test_same_as_per_day(self):
+        """ backfilled data is the same as querying each day """
+        timespans = [(datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                      datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                     (datetime.datetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                      datetime.datetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                     ]
+        with freeze_time("2014-06-14 08:15:43"):
+            pdb_mock = self.pdb()
+            expected = [pdr.query_data_for_timespan(pdb_mock, start, end) for start, end in timespans]
+            pdb_mock = self.pdb()
+            foo = pdr.query_data_for_timespans(pdb_mock, timespans)
+            pdb_mock2 = self.pdb()
+            foo2 = pdr.query_data_for_timespans(pdb_mock2, timespans, workers=2)
+        assert foo == expected
+        assert foo2 == expected
+        assert foo[0]['nodes']['node1']['reports']['run_count'] == 2
+        assert foo[1]['nodes']['node1']['reports']['run_count'] == 2
+        # one reports query and one events query per node
+        assert pdb_mock._query.call_count == 2
+        assert pdb_mock.events.call_count == 2
+
+    def test_yesterday(self):
+        """ metrics and facts are only fetched for yesterday """
+        timespans = [(datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                      datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                     (datetime.datetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                      datetime.datetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                     ]
+        metrics_mock = mock.MagicMock(return_value={'metric': 1})
+        facts_mock = mock.MagicMock(return_value={'fact': 1})
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_dashboard_metrics', metrics_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_facts', facts_mock), \
+                freeze_time("2014-06-11 08:15:43"):
+            foo = pdr.query_data_for_timespans(self.pdb(), timespans)
+        assert metrics_mock.call_count == 1
+        assert foo[0]['metrics'] == {'metric': 1}
+        assert foo[0]['facts'] == {'fact': 1}
+        assert 'metrics' not in foo[1]
+
+    def test_checkpoint(self, tmpdir):
+        """ each node is checkpointed for all of the timespans; nodes already in the checkpoint aren't queried """
+        timespans = [(datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                      datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                     (datetime.datetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+                      datetime.datetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc)),
+                     ]
+        fpath = str(tmpdir.join('checkpoint'))
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger'), \
+                freeze_time("2014-06-14 08:15:43"):
+            expected = pdr.query_data_for_timespans(self.pdb(), timespans)
+            checkpoint = pdr.NodeCheckpoint(fpath)
+            checkpoint.add('node1', (0, {timespans[0]: expected[0]['nodes']['node1'],
+                                         timespans[1]: expected[1]['nodes']['node1']}))
+            # for another set of timespans
+            checkpoint.add('node2', (0, {timespans[0]: expected[0]['nodes']['node2']}))
+            checkpoint.close()
+            checkpoint = pdr.NodeCheckpoint(fpath)
+            pdb_mock = self.pdb()
+            foo = pdr.query_data_for_timespans(pdb_mock, timespans, checkpoint=checkpoint)
+            checkpoint.close()
+        assert foo == expected
+        assert pdb_mock._query.call_count == 1
+        checkpoint = pdr.NodeCheckpoint(fpath)
+        assert checkpoint.nodes['node2'] == (mock.ANY, {timespans[0]: expected[0]['nodes']['node2'],
+                                                        timespans[1]: expected[1]['nodes']['node2']})
+        checkpoint.close()
+
+
+class Test_get_data_for_windows:
+
+    day = (datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc),
+           datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc))
+
+    def get(self, pdb_mock, windows, now="2014-06-14 08:15:43", **kwargs):
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_dashboard_metrics',
+                        mock.MagicMock(return_value={'metric': 1})), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_facts', mock.MagicMock(return_value={'fact': 1})), \
+                freeze_time(now):
+            return pdr.get_data_for_windows('foobar', pdb_mock, windows, **kwargs)
+
+    def test_same_as_per_day(self):
+        """ a day merged from buckets is the same as querying the day """
+        with freeze_time("2014-06-14 08:15:43"):
+            expected = pdr.query_data_for_timespan(Test_query_data_for_timespans().pdb(), self.day[0], self.day[1])
+        pdb_mock = Test_query_data_for_timespans().pdb()
+        foo = self.get(pdb_mock, [self.day])
+        assert foo[0]['nodes'] == expected['nodes']
+        assert foo[0]['aggregate'] == expected['aggregate']
+        assert foo[0]['metrics'] == {'metric': 1}
+        assert foo[0]['facts'] == {'fact': 1}
+        # all of the buckets in one pass
+        assert pdb_mock._query.call_count == 2
+
+    @pytest.mark.parametrize('cache_backend', ['files', 'sqlite'])
+    def test_cached(self, tmpdir, cache_backend):
+        """ overlapping windows are built from the cache, querying only the uncovered hours """
+        cache_dir = str(tmpdir)
+        manifest = pdr.CacheManifest(cache_dir)
+        backfill = pdr.backfill_uncached
+        backfill_mock = mock.MagicMock(side_effect=backfill)
+        pdb_mock = Test_query_data_for_timespans().pdb()
+        pdb_mock.cache_manifest = manifest
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_uncached', backfill_mock):
+            foo = self.get(pdb_mock, [self.day], cache_dir=cache_dir, cache_backend=cache_backend)
+            assert len(backfill_mock.call_args[0][2]) == 24
+            assert backfill_mock.call_args[1]['snapshots'] is False
+            # the day before, and a rolling 24 hours ending an hour later
+            later = (self.day[0] + datetime.timedelta(hours=1), self.day[1] + datetime.timedelta(hours=1))
+            before = (self.day[0] - datetime.timedelta(days=1), self.day[1] - datetime.timedelta(days=1))
+            pdb_mock = Test_query_data_for_timespans().pdb()
+            pdb_mock.cache_manifest = manifest
+            bar = self.get(pdb_mock, [later, before, self.day], cache_dir=cache_dir, cache_backend=cache_backend)
+        assert len(backfill_mock.call_args[0][2]) == 25
+        assert backfill_mock.call_args[0][2][-1] == (self.day[1] + datetime.timedelta(seconds=1), later[1])
+        assert bar[2]['nodes'] == foo[0]['nodes']
+        assert bar[0]['nodes']['node1']['reports']['run_count'] == 1
+        assert bar[1]['nodes']['node1']['reports']['run_count'] == 2
+        assert 'metrics' in bar[0]
+        assert 'metrics' not in bar[2]
+        assert manifest.counts == {'foobar': {'hits': 24, 'misses': 24 + 25}}
+        if cache_backend == 'files':
+            assert len(os.listdir(cache_dir)) == 24 + 25
+
+    def test_recent_not_cached(self, tmpdir):
+        """ buckets ending within BUCKET_CACHE_GRACE of now are returned, but not cached """
+        cache_dir = str(tmpdir)
+        foo = self.get(Test_query_data_for_timespans().pdb(), [self.day], now="2014-06-11 04:30:00", cache_dir=cache_dir)
+        expected = self.get(Test_query_data_for_timespans().pdb(), [self.day])
+        assert foo[0]['nodes'] == expected[0]['nodes']
+        last = pdr.get_buckets(self.day[0], self.day[1])[-1]
+        assert len(os.listdir(cache_dir)) == 23
+        assert not os.path.exists(pdr.cache_path(cache_dir, 'foobar', last[0], last[1]))
+        # and it's queried again next time
+        backfill_mock = mock.MagicMock(side_effect=pdr.backfill_uncached)
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_uncached', backfill_mock):
+            self.get(Test_query_data_for_timespans().pdb(), [self.day], cache_dir=cache_dir)
+        assert backfill_mock.call_args[0][2] == [last]
+        assert len(os.listdir(cache_dir)) == 24
+
+    def test_locked(self, tmpdir):
+        """ a bucket another run is building is waited for, and not queried again """
+        cache_dir = str(tmpdir)
+        bucket = pdr.get_buckets(self.day[0], self.day[1])[5]
+        other = pdr.CacheLock(pdr.lock_path(pdr.cache_path(cache_dir, 'foobar', bucket[0], bucket[1])))
+        other.acquire()
+        backfill_mock = mock.MagicMock(side_effect=pdr.backfill_uncached)
+        res = []
+
+        def run():
+            res.append(self.get(Test_query_data_for_timespans().pdb(), [self.day], cache_dir=cache_dir))
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.backfill_uncached', backfill_mock):
+            t = threading.Thread(target=run)
+            t.start()
+            t.join(0.5)
+            assert t.is_alive()
+            pdr.write_cache(pdr.cache_path(cache_dir, 'foobar', bucket[0], bucket[1]), {'nodes': {'node3': {}}})
+            other.release()
+            t.join(5)
+        assert len(backfill_mock.call_args[0][2]) == 23
+        assert bucket not in backfill_mock.call_args[0][2]
+        assert sorted(res[0][0]['nodes'].keys()) == ['node1', 'node2', 'node3']
+
+
+class Test_query_nodes_event_counts:
+
+    start = datetime.datetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+    end = datetime.datetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+
+    def pdb(self):
+        """ mock pdb also serving event-counts, summarized from the same events """
+        pdb_mock = Test_query_data_for_timespans().pdb()
+        events_se = pdb_mock.events.side_effect
+        reports_se = pdb_mock._query.side_effect
+        nodes_se = pdb_mock.event_counts.side_effect
+
+        def event_counts_se(query, summarize_by):
+            q = json.loads(query)
+            if q[0] == 'and' and q[1][1] == 'timestamp':
+                return nodes_se(query, summarize_by)
+            if summarize_by == 'resource':
+                # ["and", ["=", "certname", c], [">=", "run-start-time", s], ["<=", "run-start-time", e]]
+                reports_q = json.dumps(["and", q[1], [">=", "start-time", q[2][2]], ["<=", "start-time", q[3][2]]])
+                hashes = [r['hash'] for r in reports_se('reports', query=reports_q)]
+                events = events_se(json.dumps(["or"] + [["=", "report", h] for h in hashes])) if hashes else []
+                keyed = [((e.item['type'], e.item['title']), e) for e in events]
+            else:
+                keyed = [(e.node, e) for e in events_se(query)]
+            rows = OrderedDict()
+            for key, e in keyed:
+                if key not in rows:
+                    rows[key] = {'failures': 0, 'successes': 0, 'noops': 0, 'skips': 0}
+                rows[key][{'failure': 'failures', 'success': 'successes', 'skipped': 'skips'}[e.status]] += 1
+            if summarize_by == 'resource':
+                return [dict(subject={'type': k[0], 'title': k[1]}, **v) for k, v in rows.items()]
+            # subject of a certname summary only has a title
+            return [dict(subject={'title': k}, **v) for k, v in rows.items()]
+        pdb_mock.event_counts.side_effect = event_counts_se
+        return pdb_mock
+
+    def test_same_as_events(self):
+        """ the event-counts engine gets the same data as the events engine """
+        with freeze_time("2014-06-14 08:15:43"):
+            expected = pdr.query_data_for_timespan(self.pdb(), self.start, self.end)
+            pdb_mock = self.pdb()
+            foo = pdr.query_data_for_timespan(pdb_mock, self.start, self.end, engine='event-counts')
+            foo2 = pdr.query_data_for_timespan(self.pdb(), self.start, self.end, workers=2, engine='event-counts')
+        assert foo == expected
+        assert foo2 == expected
+        assert foo['nodes']['node1']['reports']['with_failures'] == 1
+        assert foo['nodes']['node1']['resources']['failed'] == {('Package', 'other'): 1}
+        assert pdb_mock.events.call_count == 0
+        # one summarized by resource per node, and one by certname per report depth
+        assert [c[1]['summarize_by'] for c in pdb_mock.event_counts.call_args_list] == ['resource', 'resource',
+                                                                                        'certname', 'certname']
+
+    def test_counters(self):
+        """ the counters engine gets the same report counters, but no resources """
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger') as mock_logger, \
+                freeze_time("2014-06-14 08:15:43"):
+            expected = pdr.query_data_for_timespan(self.pdb(), self.start, self.end)
+            pdb_mock = self.pdb()
+            foo = pdr.query_data_for_timespan(pdb_mock, self.start, self.end, engine='counters')
+            pdr.query_data_for_timespan(pdb_mock, self.start, self.end, engine='counters')
+        # v3 reports have no metrics; warned about the fallback, once per client
+        assert mock_logger.warning.call_count == 1
+        assert pdb_mock.counters_fallback_warned is True
+        for name in ['node1', 'node2']:
+            assert foo['nodes'][name]['reports'] == expected['nodes'][name]['reports']
+            assert foo['nodes'][name]['resources'] == {'failed': {}, 'changed': {}, 'skipped': {}}
+        assert pdb_mock.events.call_count == 0
+        assert [c[1]['summarize_by'] for c in pdb_mock.event_counts.call_args_list] == ['certname'] * 4
+
+    def test_report_metrics(self):
+        """ reports with embedded metrics aren't queried for event counts """
+        reports = [pdr.ReportSummary('h1', self.start, datetime.timedelta(seconds=10),
+                                     {'skipped': 0, 'success': 3, 'failure': 0}),
+                   pdr.ReportSummary('h2', self.start, datetime.timedelta(seconds=20), None),
+                   ]
+        pdb_mock = mock.MagicMock()
+        pdb_mock.event_counts.return_value = [{'subject': {'title': 'node1'}, 'failures': 1, 'successes': 0,
+                                               'noops': 0, 'skips': 1}]
+        node = mock.MagicMock()
+        node.name = 'node1'
+        pdb_mock.counters_fallback_warned = True
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_reports_for_node',
+                        mock.MagicMock(return_value=reports)):
+            foo = pdr.query_nodes_event_counts(pdb_mock, [node], self.start, self.end, resources=False)
+        assert pdb_mock.event_counts.call_args_list == [mock.call('["=", "report", "h2"]', summarize_by='certname')]
+        assert foo['node1']['reports'] == {'run_count': 2,
+                                           'with_failures': 1,
+                                           'with_changes': 1,
+                                           'with_skips': 1,
+                                           'run_time_total': datetime.timedelta(seconds=30),
+                                           'run_time_max': datetime.timedelta(seconds=20),
+                                           }
+
+    def test_report_event_counts_batches(self):
+        """ each query has at most one report per node """
+        pdb_mock = mock.MagicMock()
+        pdb_mock.event_counts.return_value = [{'subject': {'title': 'node1'}, 'failures': 1, 'successes': 2,
+                                               'noops': 0, 'skips': 0}]
+        foo = pdr.get_report_event_counts(pdb_mock, {'node1': ['h1', 'h2'], 'node2': ['h3'], 'node3': []})
+        assert pdb_mock.event_counts.call_args_list == [
+            mock.call('["or", ["=", "report", "h1"], ["=", "report", "h3"]]', summarize_by='certname'),
+            mock.call('["=", "report", "h2"]', summarize_by='certname'),
+        ]
+        assert foo == {'h1': {'failure': 1, 'success': 2, 'skipped': 0},
+                       'h2': {'failure': 1, 'success': 2, 'skipped': 0}}
+
+    def test_no_reports(self):
+        """ nodes without reports aren't queried for event counts """
+        pdb_mock = mock.MagicMock()
+        node = mock.MagicMock()
+        node.name = 'node1'
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_reports_for_node',
+                        mock.MagicMock(return_value=[])):
+            foo = pdr.query_nodes_event_counts(pdb_mock, [node], self.start, self.end)
+        assert pdb_mock.event_counts.call_count == 0
+        assert foo['node1']['reports']['run_count'] == 0
+        assert foo['node1']['resources'] == {'failed': {}, 'changed': {}, 'skipped': {}}
+
+
+class Test_query_nodes_parallel:
+
+    def test_chunks(self):
+        """ nodes are split into chunks and merged back in order """
+        nodes = []
+        for n in range(7):
+            node = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+            node.name = u'node{n}'.format(n=n)
+            nodes.append(node)
+        query_nodes_mock = mock.MagicMock()
+
+        def query_nodes_se(chunk):
+            return dict((node.name, len(chunk)) for node in chunk)
+        query_nodes_mock.side_effect = query_nodes_se
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.NODE_CHUNKS_PER_WORKER', 1):
+            foo = pdr.query_nodes_parallel(query_nodes_mock, nodes, 2)
+        assert query_nodes_mock.call_count == 2
+        assert list(foo.keys()) == ['node0', 'node1', 'node2', 'node3', 'node4', 'node5', 'node6']
+        assert foo == {'node0': 4, 'node1': 4, 'node2': 4, 'node3': 4, 'node4': 3, 'node5': 3, 'node6': 3}
+
+    def test_exception(self):
+        """ an exception in a worker is raised """
+        node = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+        node.name = u'node1'
+
+        def query_nodes_se(chunk):
+            raise HTTPError('foo')
+        query_nodes_mock = mock.MagicMock(side_effect=query_nodes_se)
+
+        with pytest.raises(HTTPError):
+            pdr.query_nodes_parallel(query_nodes_mock, [node], 2)
+
 
 class Test_query_data_for_node:
 
@@ -813,6 +3665,7 @@ class Test_query_data_for_node:
         start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
         end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
 
+        pdb_mock.reports_range_query = False
         with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger', logger_mock):
             foo = pdr.query_data_for_node(pdb_mock,
                                           node_mock,
@@ -828,14 +3681,12 @@ class Test_query_data_for_node:
         assert foo['reports']['run_count'] == 4
         assert foo['reports']['run_time_total'] == datetime.timedelta(seconds=1111)
         assert foo['reports']['run_time_max'] == datetime.timedelta(seconds=1000)
-        assert pdb_mock.events.call_args_list == [mock.call('["=", "report", "hash3"]'),
-                                                  mock.call('["=", "report", "hash4"]'),
-                                                  mock.call('["=", "report", "hash5"]'),
-                                                  mock.call('["=", "report", "hash6"]')
+        assert pdb_mock.events.call_args_list == [mock.call('["or", ["=", "report", "hash3"], ["=", "report", "hash4"], '
+                                                            '["=", "report", "hash5"], ["=", "report", "hash6"]]')
                                                   ]
 
     def test_iterate_events(self):
-        """ test iterating over events """
+        """ test iterating over events, one query per report """
         pdb_mock = mock.MagicMock(spec=pypuppetdb.api.v3.API, autospec=True)
         logger_mock = mock.MagicMock()
         node_mock = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
@@ -867,7 +3718,9 @@ class Test_query_data_for_node:
         start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
         end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
 
-        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger', logger_mock):
+        pdb_mock.reports_range_query = False
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger', logger_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.EVENTS_BATCH_SIZE', 1):
             foo = pdr.query_data_for_node(pdb_mock,
                                           node_mock,
                                           start,
@@ -896,48 +3749,598 @@ class Test_query_data_for_node:
         assert foo['resources']['changed'][('Service', 'winbind')] == 1
         assert foo['resources']['changed'][('Service', 'zookeeper-server')] == 2
 
+    def test_iterate_events_batched(self):
+        """ test iterating over events from one batched query """
+        pdb_mock = mock.MagicMock(spec=pypuppetdb.api.v3.API, autospec=True)
+        logger_mock = mock.MagicMock()
+        node_mock = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+        node_mock.name = 'node1.example.com'
+        r1 = mock.MagicMock()
+        r1.start = datetime.datetime(2014, 6, 10, hour=5, minute=0, second=2, tzinfo=pytz.utc)
+        r1.run_time = datetime.timedelta(seconds=1000)
+        r1.hash_ = 'hash1'
+        r2 = mock.MagicMock()
+        r2.start = datetime.datetime(2014, 6, 10, hour=5, minute=10, second=2, tzinfo=pytz.utc)
+        r2.run_time = datetime.timedelta(seconds=10)
+        r2.hash_ = 'hash2'
+        r3 = mock.MagicMock()
+        r3.start = datetime.datetime(2014, 6, 10, hour=5, minute=11, second=2, tzinfo=pytz.utc)
+        r3.run_time = datetime.timedelta(seconds=10)
+        r3.hash_ = 'hash3'
+        r4 = mock.MagicMock()
+        r4.start = datetime.datetime(2014, 6, 10, hour=5, minute=12, second=2, tzinfo=pytz.utc)
+        r4.run_time = datetime.timedelta(seconds=10)
+        r4.hash_ = 'hash4'
+        node_mock.reports.return_value = [r1, r2, r3, r4]
+
+        event_data = deepcopy(test_data.EVENT_DATA)
+
+        def event_se(query):
+            q = json.loads(query)
+            assert q[0] == 'or'
+            res = []
+            for clause in q[1:]:
+                res.extend(event_data.get(json.dumps(clause), []))
+            return res
+        pdb_mock.events.side_effect = event_se
+
+        start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+
+        pdb_mock.reports_range_query = False
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger', logger_mock):
+            foo = pdr.query_data_for_node(pdb_mock,
+                                          node_mock,
+                                          start,
+                                          end
+                                          )
+        assert node_mock.reports.call_count == 1
+        assert logger_mock.debug.call_count == 2
+        assert pdb_mock.event_counts.call_count == 0
+        assert pdb_mock.events.call_count == 1
+        assert foo['reports']['run_count'] == 4
+        assert foo['reports']['run_time_total'] == datetime.timedelta(seconds=1030)
+        assert foo['reports']['run_time_max'] == datetime.timedelta(seconds=1000)
+        assert foo['reports']['with_failures'] == 2
+        assert foo['reports']['with_changes'] == 2
+        assert foo['reports']['with_skips'] == 1
+        assert foo['resources']['failed'][('Package', 'srvadmin-idrac7')] == 2
+        assert foo['resources']['skipped'][('Service', 'dataeng')] == 1
+        assert foo['resources']['failed'][('Package', 'libsmbios')] == 1
+        assert foo['resources']['skipped'][('Augeas', 'disable dell yum plugin once OM is installed')] == 1
+        assert foo['resources']['changed'][('Exec', 'zookeeper ensemble check')] == 1
+        assert foo['resources']['changed'][('Service', 'winbind')] == 1
+        assert foo['resources']['changed'][('Service', 'zookeeper-server')] == 2
+
+
+class Test_get_reports_for_node:
+
+    def raw_report(self, n, start, end):
+        return {'certname': 'node1.example.com',
+                'hash': 'hash{n}'.format(n=n),
+                'start-time': start,
+                'end-time': end,
+                'receive-time': end,
+                'configuration-version': '1402459200',
+                'report-format': 4,
+                'puppet-version': '3.6.1',
+                'transaction-uuid': 'uuid{n}'.format(n=n),
+                }
+
+    def test_range_query(self):
+        """ server-side range query, paged """
+        pdb_mock = mock.MagicMock(spec=pypuppetdb.api.v3.API, autospec=True)
+        node_mock = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+        node_mock.name = 'node1.example.com'
+        pages = [[self.raw_report(1, '2014-06-11T03:55:00.000Z', '2014-06-11T03:55:01.000Z'),
+                  self.raw_report(2, '2014-06-10T17:00:00.000Z', '2014-06-10T17:01:40.000Z')],
+                 [self.raw_report(3, '2014-06-10T05:00:02.000Z', '2014-06-10T05:16:42.000Z')],
+                 ]
+        pdb_mock._query.side_effect = pages
+
+        start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.REPORTS_PAGE_SIZE', 2):
+            foo = pdr.get_reports_for_node(pdb_mock, node_mock, start, end)
+        assert node_mock.reports.call_count == 0
+        query_s = ('["and", ["=", "certname", "node1.example.com"], '
+                   '[">=", "start-time", "2014-06-10T04:00:00.000000Z"], '
+                   '["<=", "start-time", "2014-06-11T03:59:59.000000Z"]]')
+        order_by = '[{"field": "start-time", "order": "desc"}]'
+        assert pdb_mock._query.call_args_list == [mock.call('reports', query=query_s, order_by=order_by, limit=2, offset=0),
+                                                  mock.call('reports', query=query_s, order_by=order_by, limit=2, offset=2),
+                                                  ]
+        assert [r.hash_ for r in foo] == ['hash1', 'hash2', 'hash3']
+        assert foo[2].run_time == datetime.timedelta(seconds=1000)
+
+    def test_range_query_rejected(self):
+        """ server rejects the range query, fall back to node.reports() """
+        pdb_mock = mock.MagicMock(spec=pypuppetdb.api.v3.API, autospec=True)
+        node_mock = mock.MagicMock(spec=pypuppetdb.types.Node, autospec=True)
+        node_mock.name = 'node1.example.com'
+        node_mock.reports.return_value = Test_query_data_for_node.reports
+        logger_mock = mock.MagicMock()
+
+        def se_query(*args, **kwargs):
+            raise HTTPError('400 Client Error')
+        pdb_mock._query.side_effect = se_query
+
+        start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger', logger_mock):
+            foo = pdr.get_reports_for_node(pdb_mock, node_mock, start, end)
+            assert pdb_mock.reports_range_query is False
+            pdr.get_reports_for_node(pdb_mock, node_mock, start, end)
+        assert pdb_mock._query.call_count == 1
+        assert node_mock.reports.call_count == 2
+        assert logger_mock.warning.call_count == 1
+        assert [r.hash_ for r in foo] == ['hash3', 'hash4', 'hash5', 'hash6']
+
+
+class Test_hashes_needing_events:
+
+    until = datetime.datetime(2014, 6, 11, hour=4, minute=59, second=59, tzinfo=pytz.utc)
+
+    def report(self, hash_, start, secs):
+        return pdr.ReportSummary(hash_, start, datetime.timedelta(seconds=secs), None)
+
+    def reports(self):
+        return [self.report('h1', datetime.datetime(2014, 6, 10, 5, tzinfo=pytz.utc), 100),
+                self.report('h2', datetime.datetime(2014, 6, 11, 3, 59, 59, tzinfo=pytz.utc), 600),
+                # still running when get_nodes_with_events() stopped looking
+                self.report('h3', datetime.datetime(2014, 6, 11, 3, 59, 59, tzinfo=pytz.utc), 3601),
+                ]
+
+    def test_has_events(self):
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger') as logger_mock:
+            foo = pdr.hashes_needing_events(self.reports(), until=self.until)
+        assert foo == ['h1', 'h2', 'h3']
+        assert logger_mock.debug.call_count == 0
+
+    def test_no_events(self):
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.EVENTS_BATCH_SIZE', 1), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger') as logger_mock:
+            foo = pdr.hashes_needing_events(self.reports(), has_events=False, until=self.until)
+        assert foo == ['h3']
+        assert logger_mock.debug.call_args == mock.call("skipping events for 2 of 3 reports with no events; "
+                                                        "avoided 2 events queries")
+
+
+class Test_get_nodes_with_events:
+
+    def test_skips_quiet_nodes(self):
+        """ nodes without events in the time period aren't queried for events """
+        start = datetime.datetime(2014, 6, 9, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        end = datetime.datetime(2014, 6, 10, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+        with freeze_time("2014-06-14 08:15:43"):
+            expected = pdr.query_data_for_timespan(Test_query_data_for_timespans().pdb(), start, end)
+            pdb_mock = Test_query_data_for_timespans().pdb()
+            pdb_mock.event_counts.side_effect = None
+            pdb_mock.event_counts.return_value = [{'subject': {'title': 'node1'}, 'failures': 1, 'successes': 1,
+                                                   'noops': 0, 'skips': 0},
+                                                  {'subject': {'title': 'node2'}, 'failures': 0, 'successes': 0,
+                                                   'noops': 3, 'skips': 0}]
+            with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger') as logger_mock:
+                foo = pdr.query_data_for_timespan(pdb_mock, start, end)
+        assert pdb_mock.event_counts.call_count == 1
+        assert [c[0][0] for c in pdb_mock.events.call_args_list] == [
+            '["or", ["=", "report", "node1-hash3"], ["=", "report", "node1-hash4"]]']
+        assert foo['nodes']['node1'] == expected['nodes']['node1']
+        assert foo['nodes']['node2']['reports']['run_count'] == 2
+        assert foo['nodes']['node2']['reports']['with_changes'] == 0
+        assert foo['nodes']['node2']['resources'] == {'failed': {}, 'changed': {}, 'skipped': {}}
+        assert mock.call("skipped events queries for 2 reports of 1 of 2 nodes, which had no events") in \
+            logger_mock.info.call_args_list
+
+
+class Test_get_events_for_reports:
+
+    raw = {'certname': 'node1', 'status': 'success', 'timestamp': '2014-06-10T05:00:02.000Z',
+           'report': 'hash1', 'resource-title': 'bar', 'property': 'ensure', 'message': None,
+           'new-value': None, 'old-value': None, 'resource-type': 'Service'}
+
+    def test_pooled(self):
+        """ summaries are built straight from the streamed JSON """
+        pdb = pdr.PooledAPI(host='foo')
+        stream_mock = mock.MagicMock(return_value=iter([self.raw]))
+        with mock.patch.object(pdb, 'stream_query', stream_mock), \
+                mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.EVENTS_BATCH_SIZE', 2):
+            res = list(pdr.get_events_for_reports(pdb, ['hash1', 'hash2']))
+        assert res == [pdr.EventSummary('hash1', 'success', 'Service', 'bar')]
+        assert stream_mock.call_args_list == [mock.call('events', query='["or", ["=", "report", "hash1"], ["=", "report", "hash2"]]')]
+
+    def test_pypuppetdb(self):
+        """ summaries are built from pypuppetdb Event objects """
+        pdb = mock.MagicMock()
+        pdb.events.return_value = [pypuppetdb.types.Event('node1', 'failure', '2014-06-10T05:00:02.000Z', 'hash1',
+                                                          'foo', 'ensure', None, None, None, 'Package')]
+        res = list(pdr.get_events_for_reports(pdb, ['hash1']))
+        assert res == [pdr.EventSummary('hash1', 'failure', 'Package', 'foo')]
+
+
+class Test_get_events_for_reports_cached:
+
+    def test_no_cache(self):
+        get_events_mock = mock.MagicMock(return_value=iter([pdr.EventSummary('hash1', 'success', 'Service', 'bar')]))
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_events_for_reports', get_events_mock):
+            res = list(pdr.get_events_for_reports_cached('pdb', ['hash1']))
+        assert res == [pdr.EventSummary('hash1', 'success', 'Service', 'bar')]
+        assert get_events_mock.call_args == mock.call('pdb', ['hash1'])
+
+    def test_cache(self, tmpdir):
+        """ only reports not already in the cache are queried; nothing is queried twice """
+        cache = pdr.EventCache(str(tmpdir.join('events_foo.pickle')))
+        cache.store(['hash1'], [pdr.EventSummary('hash1', 'failure', 'Package', 'foo')])
+        events = {'hash2': [pdr.EventSummary('hash2', 'success', 'Service', 'bar'),
+                            pdr.EventSummary('hash2', 'noop', 'Service', 'baz')],
+                  'hash3': []}
+        get_events_mock = mock.MagicMock(side_effect=lambda pdb, hashes: iter([e for h in hashes for e in events[h]]))
+        pdb = mock.MagicMock()
+        pdb.event_cache = cache
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_events_for_reports', get_events_mock):
+            res = list(pdr.get_events_for_reports_cached(pdb, ['hash1', 'hash2', 'hash3']))
+            assert get_events_mock.call_args_list == [mock.call(pdb, ['hash2', 'hash3'])]
+            assert res == [pdr.EventSummary('hash1', 'failure', 'Package', 'foo'),
+                           pdr.EventSummary('hash2', 'success', 'Service', 'bar'),
+                           pdr.EventSummary('hash2', 'noop', 'Service', 'baz')]
+            res = list(pdr.get_events_for_reports_cached(pdb, ['hash3', 'hash2', 'hash1']))
+            assert get_events_mock.call_count == 1
+            assert res == [pdr.EventSummary('hash2', 'success', 'Service', 'bar'),
+                           pdr.EventSummary('hash1', 'failure', 'Package', 'foo')]
+        cache.close()
+
+    def test_streams_batches(self, tmpdir):
+        """ events are yielded as they're read, and each batch is cached once it's complete """
+        cache = pdr.EventCache(str(tmpdir.join('events_foo.pickle')))
+        hashes = ['hash{n}'.format(n=n) for n in range(pdr.EVENTS_BATCH_SIZE + 1)]
+
+        def get_events(pdb, batch):
+            for hash_ in batch:
+                yield pdr.EventSummary(hash_, 'success', 'Service', 'bar')
+                yield pdr.EventSummary(hash_, 'noop', 'Service', 'baz')
+
+        get_events_mock = mock.MagicMock(side_effect=get_events)
+        pdb = mock.MagicMock()
+        pdb.event_cache = cache
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_events_for_reports', get_events_mock):
+            gen = pdr.get_events_for_reports_cached(pdb, hashes)
+            assert next(gen) == pdr.EventSummary('hash0', 'success', 'Service', 'bar')
+            assert cache.reports == {}
+            res = [next(gen) for i in range(2 * pdr.EVENTS_BATCH_SIZE - 1)]
+            assert cache.reports == {}
+            res.append(next(gen))
+            assert sorted(cache.reports.keys()) == sorted(hashes[:-1])
+            assert cache.reports['hash0'] == (('success', 'Service', 'bar'),)
+            assert len(list(gen)) == 1
+        assert get_events_mock.call_args_list == [mock.call(pdb, hashes[:-1]), mock.call(pdb, hashes[-1:])]
+        assert sorted(cache.reports.keys()) == sorted(hashes)
+        cache.close()
+
+
+class Test_EventCache:
+
+    def test_store_and_load(self, tmpdir):
+        fpath = str(tmpdir.join('cache', 'events_foo.pickle'))
+        cache = pdr.EventCache(fpath)
+        assert cache.lookup(['hash1']) == ([], ['hash1'])
+        cache.store(['hash1', 'hash2'], [pdr.EventSummary('hash1', 'failure', 'Package', 'foo'),
+                                         pdr.EventSummary('hash1', 'noop', 'Package', 'bar'),
+                                         pdr.EventSummary('hash1', 'skipped', 'Exec', 'baz'),
+                                         pdr.EventSummary('hash9', 'success', 'Exec', 'baz')])
+        cache.close()
+        cache = pdr.EventCache(fpath)
+        assert cache.reports == {'hash1': (('failure', 'Package', 'foo'), ('skipped', 'Exec', 'baz')),
+                                 'hash2': ()}
+        assert cache.lookup(['hash2', 'hash1', 'hash3']) == ([pdr.EventSummary('hash1', 'failure', 'Package', 'foo'),
+                                                              pdr.EventSummary('hash1', 'skipped', 'Exec', 'baz')],
+                                                             ['hash3'])
+        cache.store(['hash3'], [])
+        cache.close()
+        assert sorted(pdr.EventCache(fpath).reports.keys()) == ['hash1', 'hash2', 'hash3']
+
+    def test_truncated(self, tmpdir):
+        fpath = str(tmpdir.join('events_foo.pickle'))
+        cache = pdr.EventCache(fpath)
+        cache.store(['hash1'], [])
+        cache.close()
+        with open(fpath, 'ab') as fh:
+            fh.write(pickle.dumps({'hash2': ()}, pickle.HIGHEST_PROTOCOL)[:-3])
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger'):
+            cache = pdr.EventCache(fpath)
+        assert cache.reports == {'hash1': ()}
+        cache.store(['hash2'], [])
+        cache.close()
+        assert pdr.EventCache(fpath).reports == {'hash1': (), 'hash2': ()}
+
+    def test_compact(self, tmpdir):
+        """ the file is rewritten without the reports stored more than max_age days ago and not used this run """
+        fpath = str(tmpdir.join('events_foo.pickle'))
+        now = calendar.timegm((2014, 6, 11, 12, 0, 0))
+        cache = pdr.EventCache(fpath)
+        with mock.patch('time.time', mock.MagicMock(return_value=now - 10 * 86400)):
+            cache.store(['hash1', 'hash2', 'hash3'], [pdr.EventSummary('hash1', 'failure', 'Package', 'foo')])
+        with mock.patch('time.time', mock.MagicMock(return_value=now - 2 * 86400)):
+            cache.store(['hash4'], [])
+        cache.close()
+        cache = pdr.EventCache(fpath)
+        assert cache.compact(now=now) == 0
+        assert cache.compact(max_age=30, now=now) == 0
+        cache.lookup(['hash2', 'hash9'])
+        cache.store(['hash5'], [])
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger'):
+            assert cache.compact(max_age=7, now=now) == 2
+        assert cache.reports == {'hash2': (), 'hash4': (), 'hash5': ()}
+        cache.store(['hash6'], [])
+        cache.close()
+        cache = pdr.EventCache(fpath)
+        assert sorted(cache.reports.keys()) == ['hash2', 'hash4', 'hash5', 'hash6']
+        assert cache.stored['hash2'] == now - 10 * 86400
+        assert cache.stored['hash4'] == now - 2 * 86400
+        assert os.listdir(str(tmpdir)) == ['events_foo.pickle']
+
+    def test_legacy_records(self, tmpdir):
+        """ records written before they were timestamped were stored no later than the file was last written """
+        fpath = str(tmpdir.join('events_foo.pickle'))
+        with open(fpath, 'wb') as fh:
+            fh.write(pickle.dumps({'hash1': ()}, pickle.HIGHEST_PROTOCOL))
+        os.utime(fpath, (1000, 1000))
+        cache = pdr.EventCache(fpath)
+        cache.store(['hash2'], [])
+        assert cache.stored['hash1'] == 1000
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger'):
+            assert cache.compact() == 0
+        cache.close()
+        cache = pdr.EventCache(fpath)
+        assert cache.reports == {'hash1': (), 'hash2': ()}
+        assert cache.stored['hash1'] == 1000
+        assert cache.legacy is False
+
+    def test_cached_days_kept(self, tmpdir):
+        """ reports of days read from the day cache by later runs are kept, so re-querying those days queries no events """
+        fpath = str(tmpdir.join('events_foo.pickle'))
+        now = calendar.timegm((2014, 6, 11, 12, 0, 0))
+        days = {1: ['hash1', 'hash2'], 2: ['hash3'], 3: ['hash4']}
+        get_events_mock = mock.MagicMock(side_effect=lambda pdb, hashes: iter([]))
+
+        def run(day_nums, when):
+            cache = pdr.EventCache(fpath)
+            pdb = mock.MagicMock()
+            pdb.event_cache = cache
+            with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.get_events_for_reports', get_events_mock), \
+                    mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.logger'), \
+                    mock.patch('time.time', mock.MagicMock(return_value=when)):
+                for day in day_nums:
+                    list(pdr.get_events_for_reports_cached(pdb, days[day]))
+                cache.compact(max_age=7, now=when)
+            cache.close()
+
+        # a cold run queries every day; the next only queries the new day,
+        # reading the others from the day cache
+        run([1, 2], now - 86400)
+        run([3], now)
+        assert get_events_mock.call_count == 3
+        # day 1 lost from the day cache, and rebuilt
+        run([1], now)
+        assert get_events_mock.call_count == 3
+
+    def test_event_cache_path(self):
+        assert pdr.event_cache_path('/tmp/cache', 'foo') == '/tmp/cache/events_foo.pickle'
+
+
+class Test_report_from_json:
+
+    def test_report_from_json(self):
+        raw = {'certname': 'node1', 'hash': 'hash1', 'start-time': '2014-06-10T17:00:00.000Z',
+               'end-time': '2014-06-10T17:01:40.250Z', 'receive-time': '2014-06-10T17:01:41.000Z',
+               'configuration-version': '1402459200', 'report-format': 4, 'puppet-version': '3.6.1',
+               'transaction-uuid': 'uuid'}
+        res = pdr.report_from_json(raw)
+        assert res == pdr.ReportSummary('hash1',
+                                        datetime.datetime(2014, 6, 10, 17, 0, 0, tzinfo=pytz.utc),
+                                        datetime.timedelta(seconds=100, microseconds=250000),
+                                        None)
+        # same as the pypuppetdb Report it replaces
+        rep = pypuppetdb.types.Report(*[raw[k] for k in ['certname', 'hash', 'start-time', 'end-time', 'receive-time',
+                                                         'configuration-version', 'report-format', 'puppet-version',
+                                                         'transaction-uuid']])
+        assert (res.hash_, res.start, res.run_time) == (rep.hash_, rep.start, rep.run_time)
+
+
+class Test_event_counts_from_metrics:
+
+    metrics = [{'category': 'resources', 'name': 'skipped', 'value': 2},
+               {'category': 'resources', 'name': 'total', 'value': 30},
+               {'category': 'events', 'name': 'failure', 'value': 1},
+               {'category': 'events', 'name': 'success', 'value': 0},
+               {'category': 'events', 'name': 'total', 'value': 1},
+               ]
+
+    def test_list(self):
+        foo = pdr.event_counts_from_metrics({'hash': 'hash1', 'metrics': self.metrics})
+        assert foo == {'skipped': 2, 'success': 0, 'failure': 1}
+
+    def test_expanded(self):
+        foo = pdr.event_counts_from_metrics({'hash': 'hash1', 'metrics': {'data': self.metrics, 'href': '/foo'}})
+        assert foo == {'skipped': 2, 'success': 0, 'failure': 1}
+
+    def test_none(self):
+        assert pdr.event_counts_from_metrics({'hash': 'hash1'}) is None
+        assert pdr.event_counts_from_metrics({'hash': 'hash1', 'metrics': {'href': '/foo'}}) is None
+        assert pdr.event_counts_from_metrics({'hash': 'hash1', 'metrics': []}) is None
+        assert pdr.event_counts_from_metrics({'hash': 'hash1', 'metrics': self.metrics[:2]}) is None
+
+    def test_report_from_json(self):
+        raw = {'hash': 'hash1', 'start-time': '2014-06-10T17:00:00.000Z', 'end-time': '2014-06-10T17:01:40.000Z',
+               'metrics': self.metrics}
+        assert pdr.report_from_json(raw).event_counts == {'skipped': 2, 'success': 0, 'failure': 1}
+
+
+class Test_parse_timestamp:
+
+    def test_parse(self):
+        assert pdr.parse_timestamp('2014-06-10T05:00:02.000Z') == datetime.datetime(2014, 6, 10, 5, 0, 2, tzinfo=pytz.utc)
+        assert pdr.parse_timestamp('2014-06-10T05:00:02.123Z') == datetime.datetime(2014, 6, 10, 5, 0, 2, 123000, tzinfo=pytz.utc)
+        expected = datetime.datetime(2014, 6, 10, 5, 0, 2, 123456, tzinfo=pytz.utc)
+        assert pdr.parse_timestamp('2014-06-10T05:00:02.1234567Z') == expected
+
+    def test_same_as_pypuppetdb(self):
+        s = '2014-12-31T23:59:59.999Z'
+        assert pdr.parse_timestamp(s) == pypuppetdb.utils.json_to_datetime(s)
+
+    def test_fallback(self):
+        with pytest.raises(ValueError):
+            pdr.parse_timestamp('2014-06-10 05:00:02')
+        with pytest.raises(ValueError):
+            pdr.parse_timestamp('2014-06-10T05:xx:02.000Z')
+
+
+class Test_query_rows:
+
+    def test_pooled(self):
+        pdb = pdr.PooledAPI(host='foo')
+        with mock.patch.object(pdb, 'stream_query', mock.MagicMock(return_value=iter([1, 2]))) as stream_mock, \
+                mock.patch.object(pdb, '_query', mock.MagicMock()) as query_mock:
+            res = list(pdr.query_rows(pdb, 'reports', query='foo'))
+        assert res == [1, 2]
+        assert stream_mock.call_args == mock.call('reports', query='foo')
+        assert query_mock.call_count == 0
+
+    def test_other(self):
+        pdb = mock.MagicMock()
+        pdb._query.return_value = [1, 2]
+        res = list(pdr.query_rows(pdb, 'reports', query='foo'))
+        assert res == [1, 2]
+        assert pdb._query.call_args == mock.call('reports', query='foo')
+
+
+class Test_iter_json_array:
+
+    data = [{'a': 1, 'b': [1, 2, {'c': None}]}, {'s': 'x, ] y \\" }'}, 12345, -1.5e3, True, None, 'str', []]
+
+    def test_one_chunk(self):
+        assert list(pdr.iter_json_array([json.dumps(self.data)])) == self.data
+
+    def test_chunk_sizes(self):
+        raw = json.dumps(self.data, indent=2)
+        for size in [1, 2, 3, 7, 64]:
+            chunks = [raw[i:i + size] for i in range(0, len(raw), size)]
+            assert list(pdr.iter_json_array(chunks)) == self.data
+
+    def test_many_per_chunk(self):
+        data = [{'a': i} for i in range(20000)]
+        raw = json.dumps(data)
+        assert list(pdr.iter_json_array([raw[:len(raw) // 2], raw[len(raw) // 2:]])) == data
+
+    def test_empty(self):
+        assert list(pdr.iter_json_array(['  [', ' ', ']  '])) == []
+
+    def test_incremental(self):
+        """ elements are yielded before the rest of the response is read """
+        def chunks():
+            yield '[{"a": 1}, '
+            raise AssertionError("read too far")
+        gen = pdr.iter_json_array(chunks())
+        assert next(gen) == {'a': 1}
+
+    def test_not_array(self):
+        with pytest.raises(ValueError):
+            list(pdr.iter_json_array(['{"a": 1}']))
+
+    def test_truncated(self):
+        with pytest.raises(ValueError):
+            list(pdr.iter_json_array(['[{"a": 1}, {"b"']))
+        with pytest.raises(ValueError):
+            list(pdr.iter_json_array(['[{"a": 1}']))
+        with pytest.raises(ValueError):
+            list(pdr.iter_json_array(['']))
+
+
+class Test_datetime_to_json:
+
+    def test_utc(self):
+        dt = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+        assert pdr.datetime_to_json(dt) == '2014-06-10T04:00:00.000000Z'
+
+    def test_local(self):
+        dt = pytz.timezone('US/Eastern').localize(datetime.datetime(2014, 6, 10, hour=0, minute=0, second=0))
+        assert pdr.datetime_to_json(dt) == '2014-06-10T04:00:00.000000Z'
+
+    def test_naive(self):
+        dt = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, microsecond=123)
+        assert pdr.datetime_to_json(dt) == '2014-06-10T04:00:00.000123Z'
+
+
+class Test_get_events_queries:
+
+    def test_empty(self):
+        assert pdr.get_events_queries([]) == []
+
+    def test_single(self):
+        assert pdr.get_events_queries(['hash1']) == ['["=", "report", "hash1"]']
+
+    def test_batch_size(self):
+        hashes = ['hash{n}'.format(n=n) for n in range(5)]
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.EVENTS_BATCH_SIZE', 2):
+            foo = pdr.get_events_queries(hashes)
+        assert foo == ['["or", ["=", "report", "hash0"], ["=", "report", "hash1"]]',
+                       '["or", ["=", "report", "hash2"], ["=", "report", "hash3"]]',
+                       '["=", "report", "hash4"]',
+                       ]
+
+    def test_max_len(self):
+        """ the limit is on the query as sent, URL-encoded """
+        hashes = ['a' * 40 for n in range(10)]
+        with mock.patch('pypuppetdb_daily_report.pypuppetdb_daily_report.EVENTS_QUERY_MAX_LEN', 200):
+            foo = pdr.get_events_queries(hashes)
+        assert len(foo) == 5
+        for q in foo:
+            assert len(urlencode({'query': q})) <= 200
+        clauses = []
+        for q in foo:
+            q = json.loads(q)
+            if q[0] == 'or':
+                clauses.extend(q[1:])
+            else:
+                clauses.append(q)
+        assert clauses == [['=', 'report', 'a' * 40] for n in range(10)]
+
 
 class Test_get_facts:
 
     def test_get_facts(self):
         """ defaults """
-        def fact_getter(name):
-            if name == 'puppetversion':
-                return [FactObject('a'),
-                        FactObject('a'),
-                        FactObject('a'),
-                        FactObject('b'),
-                        FactObject('b'),
-                        FactObject('c')
-                        ]
-            if name == 'facterversion':
-                return [FactObject('one'),
-                        FactObject('two'),
-                        FactObject('two')
-                        ]
-            if name == 'lsbdistdescription':
-                return [FactObject('1'),
-                        FactObject('1'),
-                        FactObject('1'),
-                        FactObject('1'),
-                        FactObject('2'),
-                        FactObject('3'),
-                        FactObject('4'),
-                        FactObject('5')
-                        ]
-            return []
+        rows = []
+        for name, values in [('puppetversion', ['a', 'a', 'a', 'b', 'b', 'c']),
+                             ('facterversion', ['one', 'two', 'two']),
+                             ('lsbdistdescription', ['1', '1', '1', '1', '2', '3', '4', '5']),
+                             ('other', ['x'])]:
+            for n, value in enumerate(values):
+                rows.append({'certname': 'node{n}'.format(n=n), 'name': name, 'value': value})
         expected = {'puppetversion': {'a': 3, 'b': 2, 'c': 1},
                     'facterversion': {'one': 1, 'two': 2},
                     'lsbdistdescription': {'1': 4, '2': 1, '3': 1, '4': 1, '5': 1}
                     }
 
         pdb_mock = mock.MagicMock()
-        pdb_mock.facts.side_effect = fact_getter
+        pdb_mock._query.return_value = rows
         foo = pdr.get_facts(pdb_mock)
-        assert pdb_mock.facts.call_count == 3
+        assert pdb_mock._query.call_count == 1
+        assert pdb_mock._query.call_args == mock.call('facts', query='["or", ["=", "name", "puppetversion"], '
+                                                      '["=", "name", "facterversion"], ["=", "name", "lsbdistdescription"]]')
+        assert pdb_mock.facts.call_count == 0
         assert isinstance(foo, dict)
         assert foo == expected
 
+    def test_no_values(self):
+        """ facts no node has are still in the result """
+        pdb_mock = mock.MagicMock()
+        pdb_mock._query.return_value = []
+        foo = pdr.get_facts(pdb_mock, ['foo'])
+        assert pdb_mock._query.call_args == mock.call('facts', query='["=", "name", "foo"]')
+        assert foo == {'foo': {}}
+
 
 class Test_filter_report_metric_name:
 
@@ -0,0 +1,261 @@
+"""
+tests for pypuppetdb_daily_report.async_backend
+
+The latest version of this package is available at:
+<https://github.com/jantman/pypuppetdb-daily-report>
+
+##################################################################################
+Copyright 2013 Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+    This file is part of pypuppetdb-daily-report.
+
+    pypuppetdb-puppet-report is licensed under the Apache License version 2.0.
+    please see LICENSE file for full text.
+##################################################################################
+
+AUTHORS:
+Jason Antman <jason@jasonantman.com> <http://www.jasonantman.com>
+
+"""
+
+import pytest
+import asyncio
+import datetime
+import json
+import pytz
+from freezegun import freeze_time
+
+aiohttp = pytest.importorskip('aiohttp')
+
+from aiohttp import web  # noqa
+from aiohttp.test_utils import TestServer  # noqa
+
+from pypuppetdb_daily_report import async_backend  # noqa
+from pypuppetdb_daily_report import pypuppetdb_daily_report as pdr  # noqa
+
+
+def raw_report(certname, hash_, start, end):
+    return {'certname': certname,
+            'hash': hash_,
+            'start-time': start,
+            'end-time': end,
+            'receive-time': end,
+            'configuration-version': '1402459200',
+            'report-format': 4,
+            'puppet-version': '3.6.1',
+            'transaction-uuid': 'uuid',
+            }
+
+
+def raw_event(certname, hash_, status, type_, title):
+    return {'certname': certname,
+            'status': status,
+            'timestamp': '2014-06-10T05:00:02.000Z',
+            'report': hash_,
+            'resource-title': title,
+            'resource-type': type_,
+            'property': 'ensure',
+            'message': None,
+            'new-value': None,
+            'old-value': None,
+            }
+
+
+class FakeClient(object):
+    """ stands in for AsyncPuppetDB, serving canned API responses """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+        self.reports_range_query = True
+        self.event_cache = None
+        self.cache_manifest = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def query(self, endpoint, path=None, **params):
+        self.calls.append((endpoint, path, params))
+        res = self.responses(endpoint, path, params)
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+
+def responses(endpoint, path, params):
+    if endpoint == 'nodes':
+        return [{'name': 'node1'}, {'name': 'node2'}]
+    if endpoint == 'reports':
+        q = json.loads(params['query'])
+        if q[1][2] == 'node1':
+            return [raw_report('node1', 'hash1', '2014-06-10T17:00:00.000Z', '2014-06-10T17:01:40.000Z'),
+                    raw_report('node1', 'hash2', '2014-06-10T05:00:02.000Z', '2014-06-10T05:16:42.000Z')]
+        return []
+    if endpoint == 'events':
+        return [raw_event('node1', 'hash1', 'failure', 'Package', 'foo'),
+                raw_event('node1', 'hash1', 'success', 'Service', 'bar'),
+                raw_event('node1', 'hash2', 'success', 'Service', 'bar'),
+                raw_event('node1', 'hash2', 'noop', 'Service', 'baz')]
+    if endpoint == 'event-counts':
+        assert params['summarize_by'] == 'certname'
+        return [{'subject': {'title': 'node1'}, 'failures': 1, 'successes': 2, 'noops': 1, 'skips': 0}]
+    if endpoint == 'facts':
+        q = json.loads(params['query'])
+        clauses = q[1:] if q[0] == 'or' else [q]
+        return [{'certname': certname, 'name': clause[2], 'value': '1'}
+                for clause in clauses for certname in ['node1', 'node2']]
+    if endpoint == 'metrics/mbean':
+        if 'duplicate-pct' in path:
+            return aiohttp.ClientResponseError(None, (), status=404)
+        return {'Value': 2.0}
+    raise Exception("unexpected endpoint: " + endpoint)
+
+
+class Test_query_data_for_timespan:
+
+    start = datetime.datetime(2014, 6, 10, hour=4, minute=0, second=0, tzinfo=pytz.utc)
+    end = datetime.datetime(2014, 6, 11, hour=3, minute=59, second=59, tzinfo=pytz.utc)
+
+    def test_yesterday(self):
+        client = FakeClient(responses)
+        with freeze_time("2014-06-11 08:15:43"):
+            foo = async_backend.query_data_for_timespan(client, self.start, self.end)
+        assert sorted(foo.keys()) == ['aggregate', 'facts', 'metrics', 'nodes']
+        assert foo['nodes']['node1'] == {'reports': {'run_count': 2,
+                                                     'with_failures': 1,
+                                                     'with_changes': 2,
+                                                     'with_skips': 0,
+                                                     'run_time_total': datetime.timedelta(seconds=1100),
+                                                     'run_time_max': datetime.timedelta(seconds=1000),
+                                                     },
+                                         'resources': {'failed': {('Package', 'foo'): 1},
+                                                       'changed': {('Service', 'bar'): 2},
+                                                       'skipped': {},
+                                                       },
+                                         }
+        assert foo['nodes']['node2']['reports']['run_count'] == 0
+        assert foo['aggregate'] == pdr.aggregate_data_for_timespan({'nodes': foo['nodes']})
+        assert foo['facts'] == {'puppetversion': {'1': 2}, 'facterversion': {'1': 2}, 'lsbdistdescription': {'1': 2}}
+        assert foo['metrics']['Nodes']['formatted'] == 2
+        assert foo['metrics']['Catalog duplication']['formatted'] is None
+        assert len([c for c in client.calls if c[0] == 'facts']) == 1
+        events_calls = [c for c in client.calls if c[0] == 'events']
+        assert events_calls == [('events', None, {'query': '["or", ["=", "report", "hash1"], ["=", "report", "hash2"]]'})]
+        assert [c for c in client.calls if c[0] == 'event-counts'] == [
+            ('event-counts', None, {'query': pdr.nodes_with_events_query(self.start, self.end), 'summarize_by': 'certname'})]
+
+    def test_no_events(self):
+        """ nodes without events in the time period aren't queried for events """
+        def quiet(endpoint, path, params):
+            if endpoint == 'event-counts':
+                return [{'subject': {'title': 'node1'}, 'failures': 0, 'successes': 0, 'noops': 4, 'skips': 0}]
+            return responses(endpoint, path, params)
+        client = FakeClient(quiet)
+        with freeze_time("2014-06-14 08:15:43"):
+            foo = async_backend.query_data_for_timespan(client, self.start, self.end)
+        assert [c for c in client.calls if c[0] == 'events'] == []
+        assert foo['nodes']['node1']['reports']['run_count'] == 2
+        assert foo['nodes']['node1']['reports']['with_failures'] == 0
+
+    def test_facts(self):
+        client = FakeClient(responses)
+        with freeze_time("2014-06-11 08:15:43"):
+            foo = async_backend.query_data_for_timespan(client, self.start, self.end, facts=['kernel'])
+        assert foo['facts'] == {'kernel': {'1': 2}}
+        assert [c for c in client.calls if c[0] == 'facts'] == [('facts', None, {'query': '["=", "name", "kernel"]'})]
+
+    def test_before_yesterday(self):
+        client = FakeClient(responses)
+        with freeze_time("2014-06-14 08:15:43"):
+            foo = async_backend.query_data_for_timespan(client, self.start, self.end)
+        assert sorted(foo.keys()) == ['aggregate', 'nodes']
+
+    def test_range_query_rejected(self):
+        def rejecting(endpoint, path, params):
+            if endpoint == 'reports' and 'order_by' in params:
+                return aiohttp.ClientResponseError(None, (), status=400)
+            if endpoint == 'reports':
+                q = json.loads(params['query'])
+                assert q == ['=', 'certname', 'node1']
+                return [raw_report('node1', 'hash0', '2014-06-11T05:00:00.000Z', '2014-06-11T05:01:00.000Z'),
+                        raw_report('node1', 'hash1', '2014-06-10T17:00:00.000Z', '2014-06-10T17:01:40.000Z'),
+                        raw_report('node1', 'hash9', '2014-06-09T17:00:00.000Z', '2014-06-09T17:01:40.000Z')]
+            return responses(endpoint, path, params)
+        client = FakeClient(rejecting)
+        loop = asyncio.new_event_loop()
+        foo = loop.run_until_complete(async_backend.get_reports_for_node(client, 'node1', self.start, self.end))
+        assert client.reports_range_query is False
+        loop.close()
+        assert [r.hash_ for r in foo] == ['hash1']
+
+    def test_event_cache(self, tmpdir):
+        """ reports already in the event cache aren't queried for events """
+        cache = pdr.EventCache(str(tmpdir.join('events_foo.pickle')))
+        cache.store(['hash1'], [pdr.EventSummary('hash1', 'failure', 'Package', 'foo'),
+                                pdr.EventSummary('hash1', 'success', 'Service', 'bar')])
+
+        def by_report(endpoint, path, params):
+            res = responses(endpoint, path, params)
+            if endpoint == 'events':
+                hashes = [clause[2] for clause in json.loads(params['query'])[1:]]
+                if params['query'].startswith('["="'):
+                    hashes = [json.loads(params['query'])[2]]
+                res = [e for e in res if e['report'] in hashes]
+            return res
+        client = FakeClient(by_report)
+        client.event_cache = cache
+        loop = asyncio.new_event_loop()
+        foo = loop.run_until_complete(async_backend.query_data_for_node(client, 'node1', self.start, self.end))
+        assert [c for c in client.calls if c[0] == 'events'] == [('events', None, {'query': '["=", "report", "hash2"]'})]
+        client.calls = []
+        bar = loop.run_until_complete(async_backend.query_data_for_node(client, 'node1', self.start, self.end))
+        assert [c for c in client.calls if c[0] == 'events'] == []
+        loop.close()
+        cache.close()
+        assert foo['reports']['with_failures'] == 1
+        assert foo['resources']['changed'] == {('Service', 'bar'): 2}
+        assert bar == foo
+
+
+class Test_AsyncPuppetDB:
+
+    def test_query(self):
+        """ query a real (local) HTTP server """
+        seen = []
+
+        async def handler(request):
+            seen.append((request.path, dict(request.query)))
+            return web.json_response([{'name': 'node1'}])
+
+        async def run():
+            app = web.Application()
+            app.router.add_get('/v3/{tail:.*}', handler)
+            server = TestServer(app)
+            await server.start_server()
+            try:
+                client = async_backend.AsyncPuppetDB(host=server.host, port=server.port, concurrency=2,
+                                                     connect_timeout=5, read_timeout=30)
+                async with client:
+                    assert client.semaphore is not None
+                    # no limit on a whole request, only on each connect and read
+                    assert client.session.timeout == aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=30)
+                    res = await client.query('reports', query='["=", "certname", "node1"]', order_by='foo',
+                                             limit=10, offset=None)
+                assert client.session is None
+                return res
+            finally:
+                await server.close()
+
+        loop = asyncio.new_event_loop()
+        foo = loop.run_until_complete(run())
+        loop.close()
+        assert foo == [{'name': 'node1'}]
+        assert seen == [('/v3/reports', {'query': '["=", "certname", "node1"]', 'order-by': 'foo', 'limit': '10'})]
+
+    def test_base_url(self):
+        client = async_backend.AsyncPuppetDB(host='foo', port=1234)
+        assert client.base_url == 'http://foo:1234/v3'
+        assert client._ssl_context() is None
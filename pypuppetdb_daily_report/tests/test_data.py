@@ -380,7 +380,7 @@ EVENT_DATA = {
             u'node1.example.com',
             u'otherstatus',
             u'2014-06-18T13:02:54.122000Z',
-            u'14eaf89f52496f94bae336d454b60fac6189ff1b',
+            u'hash1',
             u'srvadmin-idrac7',
             u'ensure',
             u'failure message here',
@@ -394,7 +394,7 @@ EVENT_DATA = {
             u'node1.example.com',
             u'failure',
             u'2014-06-18T13:02:54.122000Z',
-            u'14eaf89f52496f94bae336d454b60fac6189ff1b',
+            u'hash2',
             u'srvadmin-idrac7',
             u'ensure',
             u'failure message here',
@@ -406,7 +406,7 @@ EVENT_DATA = {
             u'node1.example.com',
             u'skipped',
             u'2014-06-18T13:03:03.099000Z',
-            u'14eaf89f52496f94bae336d454b60fac6189ff1b',
+            u'hash2',
             u'dataeng',
             None,
             None,
@@ -418,7 +418,7 @@ EVENT_DATA = {
             u'node1.example.com',
             u'failure',
             u'2014-06-18T13:03:02.995000Z',
-            u'14eaf89f52496f94bae336d454b60fac6189ff1b',
+            u'hash2',
             u'libsmbios',
             u'ensure',
             u'failure message here',
@@ -430,7 +430,7 @@ EVENT_DATA = {
             u'node1.example.com',
             u'skipped',
             u'2014-06-18T13:03:03.100000Z',
-            u'14eaf89f52496f94bae336d454b60fac6189ff1b',
+            u'hash2',
             u'disable dell yum plugin once OM is installed',
             None,
             None,
@@ -444,7 +444,7 @@ EVENT_DATA = {
             u'node1.example.com',
             u'success',
             u'2014-06-18T13:00:55.300000Z',
-            u'c5a40c3068f295966541d7e51d3e6fe76e56870c',
+            u'hash3',
             u'zookeeper ensemble check',
             u'returns',
             u'executed successfully',
@@ -456,7 +456,7 @@ EVENT_DATA = {
             u'node1.example.com',
             u'success',
             u'2014-06-18T13:01:00.122000Z',
-            u'c5a40c3068f295966541d7e51d3e6fe76e56870c',
+            u'hash3',
             u'winbind',
             u'ensure',
             u"ensure changed 'stopped' to 'running'",
@@ -468,7 +468,7 @@ EVENT_DATA = {
             u'node1.example.com',
             u'success',
             u'2014-06-18T13:00:54.129000Z',
-            u'c5a40c3068f295966541d7e51d3e6fe76e56870c',
+            u'hash3',
             u'zookeeper-server',
             u'ensure',
             u"ensure changed 'stopped' to 'running'",
@@ -482,7 +482,7 @@ EVENT_DATA = {
             u'node1.example.com',
             u'failure',
             u'2014-06-18T13:02:54.122000Z',
-            u'14eaf89f52496f94bae336d454b60fac6189ff1b',
+            u'hash4',
             u'srvadmin-idrac7',
             u'ensure',
             u'failure message here',
@@ -494,7 +494,7 @@ EVENT_DATA = {
             u'node1.example.com',
             u'success',
             u'2014-06-18T13:00:54.129000Z',
-            u'c5a40c3068f295966541d7e51d3e6fe76e56870c',
+            u'hash4',
             u'zookeeper-server',
             u'ensure',
             u"ensure changed 'stopped' to 'running'",
@@ -21,7 +21,11 @@ classifiers = [
     'Natural Language :: English',
     'Operating System :: POSIX',
     'Programming Language :: Python',
+    'Programming Language :: Python :: 2',
+    'Programming Language :: Python :: 2.7',
     'Programming Language :: Python :: 3',
+    'Programming Language :: Python :: 3.3',
+    'Programming Language :: Python :: 3.6',
 ]
 
 setup(
@@ -40,6 +44,7 @@ setup(
     description='Daily run summary report for PuppetDB, written in Python using nedap\'s pypuppetdb module.',
     long_description=long_description,
     install_requires=pyver_requires,
+    extras_require={'async': ['aiohttp>=3.0'], 'zstd': ['zstandard']},
     keywords="puppet puppetdb report summary",
     classifiers=classifiers
 )